@@ -20,8 +20,8 @@ import sys
  #
  # These are the required imports for Fauna.
  #
-from faunadb.client import FaunaClient
 from faunadb import query as q
+from ledger.client import create_admin_client
 
 
 def main(argv):
@@ -32,14 +32,14 @@ def main(argv):
     domain = "127.0.0.1"
     port = "8443"
     secret = "secret"
-    adminClient = FaunaClient(secret=secret, domain=domain, scheme=scheme, port=port)
+    adminClient = create_admin_client(scheme, domain, port, secret)
 
     #
     # If you are using the the FaunaDB-Cloud use these lines to create the connection.
     # Change the secret to your value and comment out the lines above
     #
     # secret = "Your Secret Goes here"
-    # adminClient = FaunaClient(secret=secret)
+    # adminClient = create_admin_client("https", "db.fauna.com", 443, secret)
 
     dbName = "TestDB"
 
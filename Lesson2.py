@@ -16,60 +16,40 @@
 #
 
 import sys
+import time
+import argparse
+import threading
+from collections import OrderedDict
 
  #
  # These are the required imports for Fauna.
  #
-from faunadb.client import FaunaClient
 from faunadb import query as q
+from faunadb.errors import NotFound
+from ledger.client import create_database, create_db_client
+from ledger.schema import sync_schema
 
-def create_database(scheme, domain, port, secret, db_name):
-    #
-    # Create an admin client. This is the client we will use to create the database.
-    #
-    # If you are using the the FaunaDB-Cloud you will need to replace the value of the
-    # 'secret' in the command below with your "secret".
-    #
-    adminClient = FaunaClient(secret=secret, domain=domain, scheme=scheme, port=port)
-    print("Connected to FaunaDB as admin!")
-
-
-    #
-    # The code below creates the Database that will be used for this example. Please note that
-    # the existence of the database is evaluated, deleted if it exists and recreated with a single
-    # call to the Fauna DB.
-    #
-    res = adminClient.query(
-        q.if_(
-            q.exists(q.database(db_name)),
-            [q.delete(q.database(db_name)), q.create_database({"name": db_name})],
-            q.create_database({"name": db_name}))
-    )
-    print('DB {0} created: {1}'.format(db_name, res))
-
-    #
-    # Create a key specific to the database we just created. We will use this to
-    # create a new client we will use in the remainder of the examples.
-    #
-    res = adminClient.query(q.select(["secret"], q.create_key({"database": q.database(db_name), "role": "server"})))
-    print('DB {0} secret: {1}'.format(db_name, res))
-
-    return res
-
-def create_db_client(scheme, domain, port, secret):
-    #
-    # Create the DB specific DB client using the DB specific key just created.
-    #
-    client = FaunaClient(secret=secret, domain="127.0.0.1", scheme="http", port=8443)
+#
+# The schema of this lesson: a class to hold customers and an index to access customer
+# records by id.
+#
+CLASSES = [{"name": "customers"}]
 
-    return client
+INDEXES = [
+    {
+        "name": "customer_by_id",
+        "source": q.class_("customers"),
+        "unique": True,
+        "terms": {"field": ["data", "id"]}
+    }
+]
 
 def create_schema(client):
     #
     # Create an class to hold customers
     #
     res = client.query(
-        q.create_class({"name": "customers"})
+        q.create_class(CLASSES[0])
     )
     print('Create \'customer\' class: {0}'.format(res))
 
@@ -77,53 +57,169 @@ def create_schema(client):
     # Create an index to access customer records by id
     #
     res = client.query(
-        q.create_index({
-            "name": "customer_by_id",
-            "source": q.class_("customers"),
-            "unique": True,
-            "terms": {"field": ["data", "id"]}
-        })
+        q.create_index(INDEXES[0])
     )
     print('Create \'customer_by_id\' index: {0}'.format(res))
 
-def create_customer(client, cust_id, balance):
+class CustomerCache(object):
+    #
+    # A client side cache in front of the 'customer_by_id' lookups. It maps a customer id to
+    # the customer's Ref and, when we have it, to the full document. Entries are evicted in
+    # least recently used order once there are more than 'max_size' of them, and expire
+    # 'ttl' seconds after they were stored.
+    #
+    # Our own writes refresh the cache with the document they return, and an entry is only
+    # ever replaced by a document with the same or a newer 'ts', so a slow response can not
+    # overwrite a more recent version. A deleted customer leaves a tombstone carrying the
+    # 'ts' of its last version, so a read that fetched the document before the delete can
+    # not put it back afterwards.
+    #
+    def __init__(self, max_size=1024, ttl=60.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _lookup(self, cust_id):
+        entry = self.entries.get(cust_id)
+        if entry is not None and entry["expires"] < time.time():
+            del self.entries[cust_id]
+            entry = None
+        if entry is not None:
+            self.entries.move_to_end(cust_id)
+        return entry
+
+    def get_ref(self, cust_id):
+        with self.lock:
+            entry = self._lookup(cust_id)
+            if entry is None or entry["ref"] is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry["ref"]
+
+    def get_document(self, cust_id):
+        with self.lock:
+            entry = self._lookup(cust_id)
+            if entry is None or entry["doc"] is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry["doc"]
+
+    def put(self, cust_id, doc):
+        with self.lock:
+            entry = self.entries.get(cust_id)
+            if entry is not None and entry["ts"] is not None:
+                if entry["ts"] > doc["ts"] or (entry["doc"] is None and entry["ts"] == doc["ts"]):
+                    return
+            self._store(cust_id, {"ref": doc["ref"], "doc": doc, "ts": doc["ts"]})
+
+    def delete(self, cust_id, ts):
+        #
+        # Record that the customer was deleted; 'ts' is the timestamp of the version the
+        # delete removed.
+        #
+        with self.lock:
+            entry = self.entries.get(cust_id)
+            if entry is not None and entry["ts"] is not None and entry["ts"] > ts:
+                return
+            self._store(cust_id, {"ref": None, "doc": None, "ts": ts})
+
+    def _store(self, cust_id, entry):
+        entry["expires"] = time.time() + self.ttl
+        self.entries[cust_id] = entry
+        self.entries.move_to_end(cust_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, cust_id):
+        with self.lock:
+            self.entries.pop(cust_id, None)
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.entries), "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions}
+
+def create_customer(client, cust_id, balance, cache=None):
     #
     # Create a customer (record)
     #
     res = client.query(
         q.create(q.class_("customers"), {"data": {"id": cust_id, "balance": balance}})
     )
+    if cache is not None:
+        cache.put(cust_id, res)
     print('Create \'customer\' {0}: {1}'.format(cust_id, res))
 
-def read_customer(client, cust_id):
+def read_customer(client, cust_id, cache=None):
     #
-    # Read the customer we just created
+    # Read the customer we just created. With a cache a repeated read is answered without
+    # going to the database.
     #
-    res = client.query(
-        q.select("data", q.get(q.match(q.index("customer_by_id"), cust_id)))
-    )
+    doc = cache.get_document(cust_id) if cache is not None else None
+    if doc is None:
+        doc = client.query(q.get(q.match(q.index("customer_by_id"), cust_id)))
+        if cache is not None:
+            cache.put(cust_id, doc)
+    res = doc["data"]
     print('Read \'customer\' {0}: {1}'.format(cust_id, res))
 
-def update_customer(client, cust_id, new_balance):
+def customer_ref(client, cust_id, cache=None):
+    #
+    # The Ref of a customer. When the cache knows it we can address the customer directly,
+    # otherwise it is looked up through the 'customer_by_id' index.
+    #
+    ref = cache.get_ref(cust_id) if cache is not None else None
+    if ref is None:
+        ref = q.select("ref", q.get(q.match(q.index("customer_by_id"), cust_id)))
+    return ref
+
+def update_customer(client, cust_id, new_balance, cache=None):
     #
     # Update the customer we just created
     #
-    balance = 200.0
-    res = client.query(
-        q.update(
-            q.select("ref", q.get(q.match(q.index("customer_by_id"), cust_id))),
-            {"data": {"balance": new_balance}}
+    try:
+        res = client.query(
+            q.update(customer_ref(client, cust_id, cache), {"data": {"balance": new_balance}})
         )
-    )
+    except NotFound:
+        if cache is None:
+            raise
+        #
+        # The cached ref is stale (the customer was deleted by someone else), drop it
+        # and go through the index.
+        #
+        cache.invalidate(cust_id)
+        res = client.query(
+            q.update(customer_ref(client, cust_id), {"data": {"balance": new_balance}})
+        )
+    if cache is not None:
+        cache.put(cust_id, res)
     print('Update \'customer\' {0}: {1}'.format(cust_id, res))
 
-def delete_customer(client, cust_id):
+def delete_customer(client, cust_id, cache=None):
     #
     # Delete the customer
     #
-    res = client.query(
-        q.delete(q.select("ref", q.get(q.match(q.index("customer_by_id"), cust_id))))
-    )
+    try:
+        res = client.query(
+            q.delete(customer_ref(client, cust_id, cache))
+        )
+    except NotFound:
+        if cache is None:
+            raise
+        cache.invalidate(cust_id)
+        res = client.query(
+            q.delete(customer_ref(client, cust_id))
+        )
+    if cache is not None:
+        cache.delete(cust_id, res["ts"])
     print('Delete \'customer\' {0}: {1}'.format(cust_id, res))
 
 
@@ -139,24 +235,42 @@ def main(argv):
 
     db_name = "LedgerExample"
 
-    db_secret = create_database(scheme, domain, port, secret, db_name)
+    #
+    # With --keep-database an existing database and its data are kept and only the missing
+    # parts of the schema are created. Pass the secret printed by the first run as
+    # --db-secret to reuse its key.
+    #
+    parser = argparse.ArgumentParser(prog=argv[0])
+    parser.add_argument("--keep-database", action="store_true")
+    parser.add_argument("--db-secret", default=None)
+    args = parser.parse_args(argv[1:])
+
+    db_secret = create_database(scheme, domain, port, secret, db_name, recreate=not args.keep_database,
+                                db_secret=args.db_secret)
 
     client = create_db_client(scheme, domain, port, db_secret)
 
-    create_schema(client)
+    if args.keep_database:
+        sync_schema(client, CLASSES, INDEXES)
+    else:
+        create_schema(client)
+
+    cache = CustomerCache()
 
     cust_id = 0
     balance = 100.0
-    create_customer(client, cust_id, balance)
+    create_customer(client, cust_id, balance, cache)
 
-    read_customer(client, cust_id)
+    read_customer(client, cust_id, cache)
 
     new_balance = 200.0
-    update_customer(client, cust_id, new_balance)
+    update_customer(client, cust_id, new_balance, cache)
+
+    read_customer(client, cust_id, cache)
 
-    read_customer(client, cust_id)
+    delete_customer(client, cust_id, cache)
 
-    delete_customer(client, cust_id)
+    print('Customer cache: {0}'.format(cache.stats()))
 
 if __name__ == "__main__":
     main(sys.argv)
@@ -16,88 +16,77 @@
 #
 
 import sys
-from faunadb.client import FaunaClient
+import time
+import argparse
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from faunadb import query as q
+from faunadb._json import to_json
+from ledger.balances import customer_data
+from ledger.client import create_database, create_db_client
+from ledger.schema import sync_schema
 
-def create_database(scheme, domain, port, secret, db_name):
-    #
-    # Create an admin client. This is the client we will use to create the database.
-    #
-    # If you are using the the FaunaDB-Cloud you will need to replace the value of the
-    # 'secret' in the command below with your "secret".
-    #
-    adminClient = FaunaClient(secret=secret, domain=domain, scheme=scheme, port=port)
-    print("Connected to FaunaDB as admin!")
-
-
-    #
-    # The code below creates the Database that will be used for this example. Please note that
-    # the existence of the database is evaluated, deleted if it exists and recreated with a single
-    # call to the Fauna DB.
-    #
-    res = adminClient.query(
-        q.if_(
-            q.exists(q.database(db_name)),
-            [q.delete(q.database(db_name)), q.create_database({"name": db_name})],
-            q.create_database({"name": db_name}))
-    )
-    print('DB {0} created: {1}'.format(db_name, res))
-
-    #
-    # Create a key specific to the database we just created. We will use this to
-    # create a new client we will use in the remainder of the examples.
-    #
-    res = adminClient.query(q.select(["secret"], q.create_key({"database": q.database(db_name), "role": "server"})))
-    print('DB {0} secret: {1}'.format(db_name, res))
-
-    return res
-
-def create_db_client(scheme, domain, port, secret):
-    #
-    # Create the DB specific DB client using the DB specific key just created.
-    #
-    client = FaunaClient(secret=secret, domain="127.0.0.1", scheme="http", port=8443)
+#
+# Larger than any customer id, as a cursor to page backwards from the end of an index.
+#
+MAX_ID = 2 ** 62
 
-    return client
+#
+# The schema of this lesson. The first index is to query customers when you know specific
+# id's. The second is used to query customers by range. The third also covers the balance so
+# that range queries can read the customer fields straight from the index.
+#
+CLASSES = [{"name": "customers"}]
+
+INDEXES = [
+    {
+        "name": "customer_by_id",
+        "source": q.class_("customers"),
+        "unique": True,
+        "terms": {"field": ["data", "id"]}
+    },
+    {
+        "name": "customer_id_filter",
+        "source": q.class_("customers"),
+        "unique": True,
+        "values": [{"field": ["data", "id"]}, {"field": ["ref"]}]
+    },
+    {
+        "name": "customer_id_balance_filter",
+        "source": q.class_("customers"),
+        "values": [{"field": ["data", "id"]}, {"field": ["data", "balance"]}]
+    }
+]
 
 def create_schema(client):
     #
     # Create an class to hold customers
     #
     res = client.query(
-        q.create_class({"name": "customers"})
+        q.create_class(CLASSES[0])
     )
     print('Create \'customer\' class: {0}'.format(res))
 
     #
-    # Create two indexes here. The first index is to query customers when you know specific id's.
-    # The second is used to query customers by range. Examples of each type of query are presented
-    # below.
+    # Create the three indexes described in INDEXES. Examples of each type of query are
+    # presented below.
     #
-    res = client.query([
-        q.create_index({
-            "name": "customer_by_id",
-            "source": q.class_("customers"),
-            "unique": True,
-            "terms": {"field": ["data", "id"]}
-        }),
-        q.create_index({
-            "name": "customer_id_filter",
-            "source": q.class_("customers"),
-            "unique": True,
-            "values": [{"field": ["data", "id"]}, {"field": ["ref"]}]
-        })
-    ])
-    print('Create \'customer_by_id\' index & \'customer_id_filter\' index : {0}'.format(res))
+    res = client.query([q.create_index(definition) for definition in INDEXES])
+    print('Create \'customer_by_id\', \'customer_id_filter\' & \'customer_id_balance_filter\' indexes : {0}'.format(res))
 
 def create_customers(client):
     #
-    # Create 20 customer records with ids from 1 to 20
+    # Create 20 customer records with ids from 1 to 20. Customers that already exist, in a
+    # database kept from an earlier run, are left as they are.
     #
     client.query(
         q.map_(
-            lambda id: q.create(q.class_("customers"),
-                                {"data": {"id": id, "balance": 100.0}}),
+            lambda id: q.if_(
+                q.exists(q.match(q.index("customer_by_id"), id)),
+                None,
+                q.create(q.class_("customers"),
+                         {"data": {"id": id, "balance": 100.0}})),
             list(range(1, 21)))
     )
 
@@ -106,7 +95,7 @@ def read_customer(client, cust_id):
     # Read the customer we just created
     #
     res = client.query(
-        q.select("data", q.get(q.match(q.index("customer_by_id"), cust_id)))
+        customer_data(q.get(q.match(q.index("customer_by_id"), cust_id)))
     )
     print('Read \'customer\' {0}: {1}'.format(cust_id, res))
 
@@ -116,7 +105,7 @@ def read_three_customers(client, cust_id1, cust_id2, cust_id3):
     # by id and return the actual data underlying them.
     #
     res = client.query(
-        q.map_(lambda x: q.select("data", q.get(x)),
+        q.map_(lambda x: customer_data(q.get(x)),
                q.paginate(
                    q.union(
                        q.match(q.index("customer_by_id"), cust_id1),
@@ -127,21 +116,42 @@ def read_three_customers(client, cust_id1, cust_id2, cust_id3):
     )
     print('Union specific \'customer\' 1, 3, 8: {0}'.format(res))
 
+def get_customers(client, cust_ids, chunk_size=256, max_workers=4):
+    #
+    # Look up any number of customers by id. The ids are deduplicated and split into chunks
+    # of at most 'chunk_size', each chunk is one query reading its customers through the
+    # 'customer_by_id' index, and up to 'max_workers' chunks are read at the same time.
+    #
+    # The result has one entry per id in 'cust_ids', in the same order, duplicates
+    # included: the customer's data, or None when there is no customer with that id.
+    #
+    unique_ids = list(dict.fromkeys(cust_ids))
+    chunks = [unique_ids[i:i + chunk_size] for i in range(0, len(unique_ids), chunk_size)]
+
+    def read_chunk(chunk):
+        return client.query(
+            q.map_(lambda cust_id: q.let(
+                {"match": q.match(q.index("customer_by_id"), cust_id)},
+                q.if_(q.exists(q.var("match")), customer_data(q.get(q.var("match"))), None)),
+                chunk)
+        )
+
+    customers = {}
+    if chunks:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(chunks))) as executor:
+            for chunk, res in zip(chunks, executor.map(read_chunk, chunks)):
+                customers.update(zip(chunk, res))
+
+    return [customers[cust_id] for cust_id in cust_ids]
+
 def read_list_of_customers(client, cust_list):
     #
     # Finally a much more general use case where we can supply any number of id values
-    # and return the data for each.
+    # and return the data for each, in the order of the list. Long lists are read in
+    # a few concurrent chunks.
     #
-    res = client.query(
-        q.map_(lambda x: q.select("data", q.get(x)),
-               q.paginate(
-                   q.union(
-                       q.map_(lambda y: q.match(q.index("customer_by_id"), y), cust_list)
-                   )
-               )
-               )
-    )
-    print('Union variable \'customer\' {0}: {1}'.format(cust_list, res))
+    res = get_customers(client, cust_list)
+    print('Lookup variable \'customer\' {0}: {1}'.format(cust_list, res))
 
 def read_customers_less_than(client, max_cust_id):
     #
@@ -151,51 +161,266 @@ def read_customers_less_than(client, max_cust_id):
     # 'before' to yield the expected results.
     #
     res = client.query(
-        q.map_(lambda x: q.select("data", q.get(q.select(1, x))),
+        q.map_(lambda x: customer_data(q.get(q.select(1, x))),
                q.paginate(q.match(q.index("customer_id_filter")), before=[max_cust_id])
                )
     )
     print('Query for id\'s < {0} : {1}'.format(max_cust_id, res))
 
+def iterate_pages(client, set_expr, map_lambda=None, after=None, before=None, page_size=8, prefetch=2,
+                  target_page_ms=None, target_page_bytes=None, min_page_size=1, max_page_size=1024):
+    #
+    # A reusable generator over any set that can be paginated, 'set_expr' being for example
+    # q.match(q.index("customer_id_filter")). Each page is returned as the list of its rows,
+    # after 'map_lambda' (if given) has been applied to them on the server.
+    #
+    # A background thread follows the "after" cursor and keeps up to 'prefetch' pages
+    # waiting in a bounded queue, so page N+1 is already on its way while the caller is
+    # still working on page N. Memory is bounded by 'prefetch' pages of 'max_page_size' rows.
+    # The thread starts as soon as iterate_pages is called, not on the first next(), so
+    # several iterators created up front fetch at the same time. Close the returned
+    # PageIterator (or read it to the end) to stop the thread.
+    #
+    # The page size starts at 'page_size' and, when 'target_page_ms' or 'target_page_bytes'
+    # are given, is adjusted after every page to get closer to that response time or
+    # response size. It changes by at most a factor of two per page.
+    #
+    # 'after' and 'before' bound the rows returned, the way the paginate cursors do. The
+    # 'before' bound is compared to the first value of each row, so it can only be used
+    # on an index with several values. Rows past it are dropped on the server and the
+    # iteration stops at the first page that reaches it.
+    #
+    # NOTE: after is inclusive of the value, before is exclusive.
+    #
+    pages = queue.Queue(maxsize=max(1, prefetch))
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fetch():
+        cursor = after
+        size = page_size
+        try:
+            while not stop.is_set():
+                page = q.paginate(set_expr, after=cursor, size=size)
+                if before is not None:
+                    page = q.filter_(lambda row: q.lt(q.select(0, row), before[0]), page)
+                if map_lambda is not None:
+                    page = q.map_(map_lambda, page)
+
+                start_time = time.time()
+                res = client.query(page)
+                elapsed_ms = (time.time() - start_time) * 1000
+
+                if not put(("page", res['data'])):
+                    return
+                if 'after' not in res or (before is not None and res['after'][0] >= before[0]):
+                    break
+                cursor = res['after']
+
+                scale = None
+                if target_page_ms:
+                    scale = target_page_ms / max(elapsed_ms, 1.0)
+                if target_page_bytes:
+                    byte_scale = target_page_bytes / float(max(len(to_json(res['data'])), 1))
+                    scale = byte_scale if scale is None else min(scale, byte_scale)
+                if scale is not None:
+                    size = int(size * min(2.0, max(0.5, scale)))
+                    size = min(max_page_size, max(min_page_size, size))
+        except Exception as error:
+            put(("error", error))
+            return
+        put(("done", None))
+
+    fetcher = threading.Thread(target=fetch)
+    fetcher.daemon = True
+    fetcher.start()
+
+    return PageIterator(pages, stop)
+
+class PageIterator(object):
+    #
+    # The pages fetched by the background thread of iterate_pages, in order.
+    #
+    def __init__(self, pages, stop):
+        self.pages = pages
+        self.stop = stop
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.stop.is_set():
+            raise StopIteration
+        kind, value = self.pages.get()
+        if kind == "page":
+            return value
+        self.close()
+        if kind == "error":
+            raise value
+        raise StopIteration
+
+    def close(self):
+        self.stop.set()
+
+def iterate_rows(client, set_expr, map_lambda=None, **kwargs):
+    #
+    # Same as iterate_pages, one row at a time.
+    #
+    pages = iterate_pages(client, set_expr, map_lambda, **kwargs)
+    try:
+        for page in pages:
+            for row in page:
+                yield row
+    finally:
+        pages.close()
+
+def scan_customers_between(client, min_cust_id, max_cust_id, page_size=64, **kwargs):
+    #
+    # Lazily stream the customers with min_cust_id <= id < max_cust_id. The scan starts
+    # right at 'min_cust_id' with the "after" cursor and ends at 'max_cust_id', and the
+    # fields are read straight from the 'customer_id_balance_filter' index with no get per
+    # row, so the cost only depends on the number of customers in the range.
+    #
+    # Sharded customers (ledger.sharding) have no balance in this index, read theirs with
+    # ledger.sharding.read_sharded_balance.
+    #
+    for cust_id, balance in iterate_rows(client, q.match(q.index("customer_id_balance_filter")),
+                                         after=[min_cust_id], before=[max_cust_id],
+                                         page_size=page_size, **kwargs):
+        yield {"id": cust_id, "balance": balance}
+
 def read_customers_between(client, min_cust_id, max_cust_id):
     #
-    # Extending the previous example to show getting a range between two values.
+    # Extending the previous example to show getting a range between two values. Using
+    # both a lower ("after") and an upper ("before") bound on a covering index means
+    # only the customers in the range are read.
     #
-    res = client.query(
-        q.map_(lambda x: q.select("data", q.get(q.select(1, x))),
-               q.filter_(lambda y: q.lte(min_cust_id, q.select(0, y)),
-                         q.paginate(q.match(q.index("customer_id_filter")), before=[max_cust_id])
-                         )
-               )
-    )
-    print('Query for id\'s > {0} and < {1} : {2}'.format(min_cust_id, max_cust_id, res))
+    res = list(scan_customers_between(client, min_cust_id, max_cust_id))
+    print('Query for id\'s >= {0} and < {1} : {2}'.format(min_cust_id, max_cust_id, res))
 
 def read_all_customers(client):
     #
     # Read all the records that we created. This is a more generalized usage of the
-    # paginate functionality. Notice the capture and passing of the "after" cursor
-    # that is part of the return of the paginate if records are remaining.
-    #
-    # Use a small'ish page size so that we can demonstrate a paging example.
+    # paginate functionality. The iterator captures and passes the "after" cursor that is
+    # part of the return of the paginate if records are remaining, fetching the next page
+    # while the current one is being printed.
     #
-    # NOTE: after is inclusive of the value.
+    # Start with a small'ish page size so that we can demonstrate a paging example, the
+    # iterator then grows or shrinks it to aim at a 50ms response time.
     #
-    pageSize = 8
-    cursorPos = None
-    while True:
-        res = client.query(
-            q.map_(lambda x: q.select("data", q.get(q.select(1,x))),
-                       q.paginate(q.match(q.index("customer_id_filter")), after=cursorPos, size=pageSize)
-                       )
-        )
+    for row in iterate_rows(client, q.match(q.index("customer_id_filter")),
+                            lambda x: customer_data(q.get(q.select(1, x))),
+                            page_size=8, target_page_ms=50):
+        print(row)
 
-        for i in res['data']:
-            print(i)
+def first_value_bounds(client, set_expr):
+    #
+    # The first value of the first and of the last row of a set, e.g. the lowest and the
+    # highest customer id of 'customer_id_filter', or None if the set is empty.
+    #
+    res = client.query([
+        q.paginate(set_expr, size=1),
+        q.paginate(set_expr, before=[MAX_ID], size=1)
+    ])
+    if not res[0]['data']:
+        return None
+    return res[0]['data'][0][0], res[1]['data'][0][0]
 
-        if 'after' in res:
-            cursorPos = res['after']
-        else:
-            break
+def scan_partitioned(client, set_expr, map_lambda=None, num_partitions=4, ordered=True, page_size=64, prefetch=2):
+    #
+    # Scan a whole set whose rows start with an integer id, like 'customer_id_filter', as
+    # 'num_partitions' disjoint id ranges read at the same time. The ranges are cut evenly
+    # between the lowest and the highest id found in the set, and each is read with
+    # iterate_pages using the "after" and "before" cursors.
+    #
+    # With 'ordered' the rows come out in index order: every range starts fetching right
+    # away, up to 'prefetch' pages ahead, and the ranges are consumed one after the other.
+    # Otherwise rows come out as soon as any range has them, which keeps every range busy
+    # and suits aggregations where the order does not matter.
+    #
+    bounds = first_value_bounds(client, set_expr)
+    if bounds is None:
+        return
+    lower, upper = bounds[0], bounds[1] + 1
+    splits = sorted(set(lower + (upper - lower) * i // num_partitions for i in range(0, num_partitions + 1)))
+    ranges = list(zip(splits, splits[1:]))
+
+    def partition(range_):
+        return iterate_pages(client, set_expr, map_lambda, after=[range_[0]], before=[range_[1]],
+                             page_size=page_size, prefetch=prefetch)
+
+    if ordered:
+        partitions = [partition(range_) for range_ in ranges]
+        try:
+            for pages in partitions:
+                for page in pages:
+                    for row in page:
+                        yield row
+        finally:
+            for pages in partitions:
+                pages.close()
+        return
+
+    pages = queue.Queue(maxsize=max(1, prefetch) * len(ranges))
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def scan(range_):
+        range_pages = partition(range_)
+        try:
+            for page in range_pages:
+                if not put(("page", page)):
+                    return
+        except Exception as error:
+            put(("error", error))
+            return
+        finally:
+            range_pages.close()
+        put(("done", None))
+
+    workers = [threading.Thread(target=scan, args=(range_,)) for range_ in ranges]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    try:
+        remaining = len(workers)
+        while remaining:
+            kind, value = pages.get()
+            if kind == "page":
+                for row in value:
+                    yield row
+            elif kind == "error":
+                raise value
+            else:
+                remaining -= 1
+    finally:
+        stop.set()
+
+def read_all_customers_partitioned(client, num_partitions=4):
+    #
+    # read_all_customers with the id range split between 'num_partitions' concurrent scans,
+    # still printed in id order.
+    #
+    for row in scan_partitioned(client, q.match(q.index("customer_id_filter")),
+                                lambda x: customer_data(q.get(q.select(1, x))),
+                                num_partitions=num_partitions, page_size=8):
+        print(row)
 
 
 def main(argv):
@@ -210,11 +435,25 @@ def main(argv):
 
     db_name = "LedgerExample"
 
-    db_secret = create_database(scheme, domain, port, secret, db_name)
+    #
+    # With --keep-database an existing database and its data are kept and only the missing
+    # parts of the schema are created. Pass the secret printed by the first run as
+    # --db-secret to reuse its key.
+    #
+    parser = argparse.ArgumentParser(prog=argv[0])
+    parser.add_argument("--keep-database", action="store_true")
+    parser.add_argument("--db-secret", default=None)
+    args = parser.parse_args(argv[1:])
+
+    db_secret = create_database(scheme, domain, port, secret, db_name, recreate=not args.keep_database,
+                                db_secret=args.db_secret)
 
     client = create_db_client(scheme, domain, port, db_secret)
 
-    create_schema(client)
+    if args.keep_database:
+        sync_schema(client, CLASSES, INDEXES)
+    else:
+        create_schema(client)
 
     create_customers(client)
 
@@ -222,7 +461,7 @@ def main(argv):
 
     read_three_customers(client, 1, 3, 8)
 
-    cust_list = [1, 3, 6, 7]
+    cust_list = [7, 3, 6, 1, 3, 42]
     read_list_of_customers(client, cust_list)
 
     read_customers_less_than(client, 5)
@@ -231,5 +470,7 @@ def main(argv):
 
     read_all_customers(client)
 
+    read_all_customers_partitioned(client)
+
 if __name__ == "__main__":
     main(sys.argv)
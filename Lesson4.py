@@ -16,94 +16,136 @@
 #
 
 import sys
+import time
+import argparse
 import pprint
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from uuid import uuid4
-from random import randint
-from faunadb.client import FaunaClient
+from random import randint, uniform
+from requests.exceptions import ConnectionError as RequestsConnectionError, Timeout
+from faunadb.errors import BadRequest, FaunaError, UnavailableError
 from faunadb import query as q
+from faunadb._json import to_json
+from ledger.balances import customer_balance
+from ledger.client import create_database, create_db_client
+from ledger.schema import sync_schema
 
-def create_database(scheme, domain, port, secret, db_name):
-    #
-    # Create an admin client. This is the client we will use to create the database.
-    #
-    # If you are using the the FaunaDB-Cloud you will need to replace the value of the
-    # 'secret' in the command below with your "secret".
-    #
-    adminClient = FaunaClient(secret=secret, domain=domain, scheme=scheme, port=port)
-    print("Connected to FaunaDB as admin!")
+INSUFFICIENT_FUNDS = "Error. Insufficient funds."
 
+#
+# What a transfer evaluates to when a transaction with its uuid has already been recorded as
+# applied, i.e. when it is the retry of a transfer that was applied.
+#
+ALREADY_APPLIED = "Transfer already applied."
 
-    #
-    # The code below creates the Database that will be used for this example. Please note that
-    # the existence of the database is evaluated, deleted if it exists and recreated with a single
-    # call to the Fauna DB.
-    #
-    res = adminClient.query(
-        q.if_(
-            q.exists(q.database(db_name)),
-            [q.delete(q.database(db_name)), q.create_database({"name": db_name})],
-            q.create_database({"name": db_name}))
-    )
-    print('DB {0} created:'.format(db_name))
-    pprint.pprint(res)
-
-    #
-    # Create a key specific to the database we just created. We will use this to
-    # create a new client we will use in the remainder of the examples.
-    #
-    res = adminClient.query(q.select(["secret"], q.create_key({"database": q.database(db_name), "role": "server"})))
-    print('DB {0} secret: {1}'.format(db_name, res))
+#
+# The status of a transaction record: the transfer moved the money, or it was rejected for
+# insufficient funds and nothing but the record was written.
+#
+APPLIED = "applied"
+REJECTED = "rejected"
 
-    return res
+#
+# Keep batched requests comfortably below the request size accepted by FaunaDB.
+#
+MAX_BATCH_BYTES = 256 * 1024
 
-def create_db_client(scheme, domain, port, secret):
-    #
-    # Create the DB specific DB client using the DB specific key just created.
-    #
-    client = FaunaClient(secret=secret, domain="127.0.0.1", scheme="http", port=8443)
+#
+# The stored transfer function and a prebuilt reference to it, shared by every call. The
+# version is part of the name because sync_schema only creates missing functions: a
+# database kept from an earlier run still has the old body under the old name, so a change
+# to transfer_expr must come with a new version.
+#
+TRANSFER_FUNCTION_NAME = "transfer_v2"
+TRANSFER_FUNCTION = q.function(TRANSFER_FUNCTION_NAME)
 
-    return client
+#
+# The schema of the ledger. 'customer_by_id' is to query customers when you know specific
+# id's. 'customer_id_filter' is used to query customers by range. 'customer_id_balance_filter'
+# covers the balance as well so that balances can be aggregated straight from the index
+# without reading the customers. 'customers_by_balance' and 'customers_by_balance_desc' list
+# the customers by balance, lowest or highest first, and cover the id and ref so that the
+# richest or poorest customers can be read without reading the others. Examples of each type
+# of query are presented below.
+#
+# 'transaction_by_uuid' finds a transaction by its uuid and, being unique, makes sure that a
+# transfer can only ever be recorded once (see transfer_expr). 'transactions_by_ts' lists the
+# transactions in the order they were committed, with all their fields and their status
+# (see ledger.export).
+#
+CLASSES = [
+    {"name": "customers"},
+    {"name": "transactions"}
+]
+
+INDEXES = [
+    {
+        "name": "customer_by_id",
+        "source": q.class_("customers"),
+        "unique": True,
+        "terms": {"field": ["data", "id"]}
+    },
+    {
+        "name": "customer_id_filter",
+        "source": q.class_("customers"),
+        "unique": True,
+        "values": [{"field": ["data", "id"]}, {"field": ["ref"]}]
+    },
+    {
+        "name": "customer_id_balance_filter",
+        "source": q.class_("customers"),
+        "values": [{"field": ["data", "id"]}, {"field": ["data", "balance"]}]
+    },
+    {
+        "name": "customers_by_balance",
+        "source": q.class_("customers"),
+        "values": [{"field": ["data", "balance"]}, {"field": ["data", "id"]}, {"field": ["ref"]}]
+    },
+    {
+        "name": "customers_by_balance_desc",
+        "source": q.class_("customers"),
+        "values": [{"field": ["data", "balance"], "reverse": True}, {"field": ["data", "id"]}, {"field": ["ref"]}]
+    },
+    {
+        "name": "transaction_by_uuid",
+        "source": q.class_("transactions"),
+        "unique": True,
+        "terms": {"field": ["data", "uuid"]}
+    },
+    {
+        "name": "transaction_uuid_filter",
+        "source": q.class_("transactions"),
+        "values": [{"field": ["data", "uuid"]}, {"field": ["ref"]}]
+    },
+    {
+        "name": "transactions_by_ts",
+        "source": q.class_("transactions"),
+        "values": [{"field": ["ts"]}, {"field": ["data", "uuid"]}, {"field": ["data", "sourceCust"]},
+                   {"field": ["data", "destCust"]}, {"field": ["data", "amount"]}, {"field": ["ref"]},
+                   {"field": ["data", "status"]}]
+    }
+]
 
 def create_classes(client):
     #
     # Create an class to hold customers and transactions
     #
     res = client.query(
-        [
-            q.create_class({"name": "customers"}),
-            q.create_class({"name": "transactions"})
-        ]
+        [q.create_class(definition) for definition in CLASSES]
     )
     print('Create \'customer\' and \'transaction\' classes.')
     pprint.pprint(res)
 
 def create_indices(client):
     #
-    # Create two indexes here. The first index is to query customers when you know specific id's.
-    # The second is used to query customers by range. Examples of each type of query are presented
-    # below.
-    #
-    res = client.query([
-        q.create_index({
-            "name": "customer_by_id",
-            "source": q.class_("customers"),
-            "unique": True,
-            "terms": {"field": ["data", "id"]}
-        }),
-        q.create_index({
-            "name": "customer_id_filter",
-            "source": q.class_("customers"),
-            "unique": True,
-            "values": [{"field": ["data", "id"]}, {"field": ["ref"]}]
-        }),
-        q.create_index({
-            "name": "transaction_uuid_filter",
-            "source": q.class_("transactions"),
-            "unique": True,
-            "values": [{"field": ["data", "id"]}, {"field": ["ref"]}]
-        })
-    ])
-    print('Create \'customer_by_id\', \'customer_id_filter\' and \'transaction_uuid_filter\' indices')
+    # Create the indexes described in INDEXES.
+    #
+    res = client.query(
+        [q.create_index(definition) for definition in INDEXES]
+    )
+    print('Create {0} indices'.format(', '.join('\'{0}\''.format(d["name"]) for d in INDEXES)))
     pprint.pprint(res)
 
 def create_customer(client, cust_id, balance):
@@ -146,46 +188,282 @@ def create_customers(client, num_customers, init_balance):
 
     return cust_refs
 
+def create_missing_customers(client, num_customers, init_balance, max_chunk_size=500):
+    #
+    # Make sure customers 1 to 'num_customers' exist, creating only the ones that do not,
+    # e.g. to finish loading a database that was only partly loaded. Each chunk of ids is
+    # checked and filled in one query. Returns the refs of all the customers, in id order.
+    #
+    cust_refs = []
+    created = 0
+    for start in range(1, num_customers + 1, max_chunk_size):
+        res = client.query(
+            q.map_(
+                lambda cust_id: q.let(
+                    {"match": q.match(q.index("customer_by_id"), cust_id)},
+                    q.if_(q.exists(q.var("match")),
+                          [q.select("ref", q.get(q.var("match"))), False],
+                          [q.select("ref", q.create(q.class_("customers"),
+                                                    {"data": {"id": cust_id, "balance": init_balance}})), True])),
+                list(range(start, min(num_customers, start + max_chunk_size - 1) + 1)))
+        )
+        for cust_ref, is_new in res:
+            cust_refs.append(cust_ref)
+            created += 1 if is_new else 0
+    print('Create {0} missing customers of {1}'.format(created, num_customers))
+
+    return cust_refs
+
+def sum_balance_range(client, min_cust_id, max_cust_id, page_size=1024, server_side=True,
+                      index_name="customer_id_balance_filter"):
+    #
+    # Sum the balances of the customers with min_cust_id <= id < max_cust_id by paging
+    # through the 'customer_id_balance_filter' index, which covers the balance, so no
+    # customer document is ever read.
+    #
+    # With 'server_side' each page is filtered to the range and summed by FaunaDB and only
+    # the sum and the next cursor come back. Otherwise the [id, balance] tuples of the range
+    # are returned and summed here.
+    #
+    # Any index whose values are [id, balance] can be summed the same way by naming it in
+    # 'index_name'.
+    #
+    balance_sum = 0
+    if min_cust_id >= max_cust_id:
+        return balance_sum
+    cursor = [min_cust_id]
+    while True:
+        page = q.filter_(lambda cust_id, balance: q.lt(cust_id, max_cust_id),
+                         q.paginate(q.match(q.index(index_name)), after=cursor, size=page_size))
+        if server_side:
+            res = client.query(
+                q.let(
+                    {"page": page},
+                    {"sum": q.sum(q.map_(lambda cust_id, balance: balance, q.select("data", q.var("page")))),
+                     "after": q.select_with_default("after", q.var("page"), None)}
+                )
+            )
+            balance_sum = balance_sum + res['sum']
+        else:
+            res = client.query(page)
+            for cust_id, balance in res['data']:
+                balance_sum = balance_sum + balance
+
+        cursor = res.get('after')
+        if cursor is None or cursor[0] >= max_cust_id:
+            return balance_sum
+
+def sum_customer_balances_indexed(client, min_cust_id, max_cust_id, num_partitions=4, page_size=1024,
+                                  server_side=True, index_name="customer_id_balance_filter"):
+    #
+    # Aggregate all the balances for customers with ids from min_cust_id to max_cust_id
+    # (inclusive) using the covering index. The id range is split into 'num_partitions'
+    # ranges that are summed in parallel.
+    #
+    bounds = [min_cust_id + (max_cust_id + 1 - min_cust_id) * i // num_partitions
+              for i in range(0, num_partitions + 1)]
+    ranges = [(lower, upper) for lower, upper in zip(bounds, bounds[1:]) if lower < upper]
+
+    # An empty or inverted id range has no ranges to sum.
+    balance_sum = 0
+    if ranges:
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            balance_sum = sum(executor.map(
+                lambda r: sum_balance_range(client, r[0], r[1], page_size, server_side, index_name), ranges))
+
+    print('Customer Balance Sum (index): {0}'.format(balance_sum))
+
+    return balance_sum
+
+def scan_customers_by_balance(client, index_name="customers_by_balance", after=None, before=None, limit=None,
+                              page_size=1024):
+    #
+    # Read customers in balance order from one of the balance indexes, starting at the
+    # 'after' cursor (e.g. [min_balance]) and stopping at balance 'before' (exclusive, only
+    # for the ascending index) or after 'limit' customers. No page asks for more rows than
+    # are still wanted, so reading N customers costs about N index entries whatever the
+    # number of customers.
+    #
+    customers = []
+    cursor = after
+    while limit is None or len(customers) < limit:
+        size = page_size if limit is None else min(page_size, limit - len(customers))
+        page = q.paginate(q.match(q.index(index_name)), after=cursor, size=size)
+        if before is not None:
+            page = q.filter_(lambda balance, cust_id, ref: q.lt(balance, before), page)
+        res = client.query(page)
+
+        for balance, cust_id, ref in res['data']:
+            customers.append({"id": cust_id, "balance": balance, "ref": ref})
+
+        cursor = res.get('after')
+        if cursor is None or (before is not None and cursor[0] >= before):
+            break
+
+    return customers
+
+def top_customers_by_balance(client, n, richest=True):
+    #
+    # The 'n' customers with the highest (or, with richest=False, the lowest) balances.
+    #
+    index_name = "customers_by_balance_desc" if richest else "customers_by_balance"
+    return scan_customers_by_balance(client, index_name, limit=n)
+
+def customers_below_balance(client, threshold, limit=None):
+    #
+    # The customers whose balance is below 'threshold', lowest first.
+    #
+    return scan_customers_by_balance(client, before=threshold, limit=limit)
+
+def customers_at_or_above_balance(client, threshold, limit=None):
+    #
+    # The customers whose balance is at least 'threshold', lowest first.
+    #
+    return scan_customers_by_balance(client, after=[threshold], limit=limit)
+
+def customers_in_balance_range(client, min_balance, max_balance, limit=None):
+    #
+    # The customers with min_balance <= balance < max_balance, lowest first.
+    #
+    return scan_customers_by_balance(client, after=[min_balance], before=max_balance, limit=limit)
+
+def generate_customers(num_customers, init_balance):
+    #
+    # Lazily produce the customer dictionaries with ids from 1 to 'num_customers' so that
+    # they never all have to be held in memory at once.
+    #
+    for cust_id in range(1, num_customers + 1):
+        yield {"id": cust_id, "balance": init_balance}
+
+def customer_chunks(customers, max_chunk_size=500, max_chunk_bytes=MAX_BATCH_BYTES):
+    #
+    # Split an iterable of customer dictionaries into lists of at most 'max_chunk_size'
+    # customers whose encoded size stays under 'max_chunk_bytes'.
+    #
+    chunk = []
+    chunk_bytes = 0
+    for customer in customers:
+        customer_bytes = len(to_json(customer))
+        if chunk and (len(chunk) >= max_chunk_size or chunk_bytes + customer_bytes > max_chunk_bytes):
+            yield chunk
+            chunk = []
+            chunk_bytes = 0
+        chunk.append(customer)
+        chunk_bytes += customer_bytes
+    if chunk:
+        yield chunk
+
+def bulk_load_customers(client, customers, max_chunk_size=500, max_chunk_bytes=MAX_BATCH_BYTES,
+                        max_in_flight=4, report_every=10000):
+    #
+    # Load any number of customers from an iterable (typically a generator such as
+    # generate_customers) and yield the Fauna RefV of each one as it is created.
+    #
+    # The customers are sent in size bounded chunks with at most 'max_in_flight' requests
+    # outstanding at a time. Only the refs are returned by each request, and nothing is kept
+    # once it has been yielded, so memory stays flat no matter how many customers there are.
+    # Refs are yielded in the order the customers were given.
+    #
+    start_time = time.time()
+    loaded = 0
+    next_report = report_every
+
+    def load_chunk(chunk):
+        return client.query(
+            q.map_(
+                lambda customer: q.select("ref", q.create(q.class_("customers"), {"data": customer})),
+                chunk)
+        )
+
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        for chunk in customer_chunks(customers, max_chunk_size, max_chunk_bytes):
+            pending.append(executor.submit(load_chunk, chunk))
+            if len(pending) < max_in_flight:
+                continue
+
+            for cust_ref in pending.popleft().result():
+                loaded += 1
+                yield cust_ref
+            if report_every and loaded >= next_report:
+                print('Loaded {0} customers ({1:.0f} rows/sec)'.format(loaded, loaded / (time.time() - start_time)))
+                next_report = loaded + report_every
+
+        while pending:
+            for cust_ref in pending.popleft().result():
+                loaded += 1
+                yield cust_ref
+
+    elapsed = time.time() - start_time
+    print('Loaded {0} customers in {1:.2f} seconds ({2:.0f} rows/sec)'.format(
+        loaded, elapsed, loaded / elapsed if elapsed > 0 else 0.0))
+
 def sum_customer_balanaces(client, cust_refs):
     #
     # This is going to take the customer references that were created during the
     # createCustomers routine and aggregate all the balances for them. We could so this,
     # and probably would, with class index. In this case we want to take this approach to show
-    # how to use references.
+    # how to use references. The balance of a sharded customer (see ledger.sharding) is
+    # summed over its shards.
     #
     balance_sum = 0
 
     res = client.query(
         q.map_(
-            lambda cust_ref: q.select("data", q.get(cust_ref)),
+            lambda cust_ref: customer_balance(q.get(cust_ref)),
             cust_refs)
     )
 
-    for customer in res:
-        balance_sum = balance_sum + customer['balance']
+    for balance in res:
+        balance_sum = balance_sum + balance
 
     print('Customer Balance Sum: {0}'.format(balance_sum))
 
     return balance_sum
 
-def create_transaction(client, num_customers, max_txn_amount):
+def random_transfer(num_customers, max_txn_amount, rng=None):
     #
-    # This method is going to create a random transaction that moves a random amount
-    # from a source customer to a destination customer. Prior to committing the transaction
-    # a check will be performed to insure that the source customer has a sufficient balance
-    # to cover the amount and not go into an overdrawn state.
+    # Pick a random amount to move from a random source customer to a different random
+    # destination customer. The transfer is described with a python dictionary which is also
+    # the 'data' payload of the transaction record that is written when it is applied.
+    #
+    # Passing a seeded random.Random as 'rng' makes the customers and amounts reproducible.
+    # The uuid is always a new one, so a repeated run is not taken for a retry of the
+    # transfers of the earlier run and answered with ALREADY_APPLIED.
     #
     uuid = uuid4().urn[9:]
+    rand = randint if rng is None else rng.randint
 
-    source_id = randint(1, num_customers)
-    dest_id = randint(1, num_customers)
+    source_id = rand(1, num_customers)
+    dest_id = rand(1, num_customers)
     while dest_id == source_id:
-        dest_id = randint(1, num_customers)
-    amount = randint(1, max_txn_amount)
+        dest_id = rand(1, num_customers)
+    amount = rand(1, max_txn_amount)
 
-    transaction = {"uuid": uuid, "sourceCust": source_id, "destCust": dest_id , "amount": amount}
+    return {"uuid": uuid, "sourceCust": source_id, "destCust": dest_id, "amount": amount}
 
-    res = client.query(
+def transfer_expr(uuid, source_id, dest_id, amount):
+    #
+    # Build the expression for a single transfer. Prior to committing the transaction a check
+    # is performed to insure that the source customer has a sufficient balance to cover the
+    # amount and not go into an overdrawn state. If it does not the query evaluates to the
+    # string INSUFFICIENT_FUNDS and nothing is written.
+    #
+    # The four arguments can be plain values or variables, which lets the same expression
+    # serve as the body of the stored transfer function (see create_functions).
+    #
+    # A transfer is decided at most once per uuid. Whether it is applied or rejected, a
+    # transaction record with that outcome as its 'status' is written under its uuid, and if
+    # the record of 'uuid' is already there the query evaluates to the recorded outcome
+    # (ALREADY_APPLIED or INSUFFICIENT_FUNDS) and nothing is written. So a transfer whose
+    # answer was lost can simply be sent again and gets the answer of the first attempt,
+    # even if the balances have changed since. Two attempts racing each other can not both
+    # commit either, the unique 'transaction_by_uuid' index rejects the second transaction
+    # record (see transfer_outcome).
+    #
+    return q.if_(
+        q.exists(q.match(q.index("transaction_by_uuid"), uuid)),
+        recorded_outcome(q.get(q.match(q.index("transaction_by_uuid"), uuid))),
         q.let(
             {"source_customer": q.get(q.match(q.index("customer_by_id"), source_id)),
              "dest_customer": q.get(q.match(q.index("customer_by_id"), dest_id))},
@@ -198,19 +476,326 @@ def create_transaction(client, num_customers, max_txn_amount):
                     q.if_(
                         q.gte(q.var("new_source_balance"), 0),
                         q.do(
-                            q.create(q.class_("transactions"), {"data": transaction}),
+                            q.create(q.class_("transactions"),
+                                     {"data": {"uuid": uuid, "sourceCust": source_id, "destCust": dest_id,
+                                               "amount": amount, "status": APPLIED}}),
                             q.update(q.select("ref", q.var("source_customer")),
                                      {"data": {"txnID": uuid, "balance": q.var("new_source_balance")}}),
                             q.update(q.select("ref", q.var("dest_customer")),
                                      {"data": {"txnID": uuid, "balance": q.var("new_dest_balance")}})
                         ),
-                        "Error. Insufficient funds."
+                        q.do(
+                            q.create(q.class_("transactions"),
+                                     {"data": {"uuid": uuid, "sourceCust": source_id, "destCust": dest_id,
+                                               "amount": amount, "status": REJECTED}}),
+                            INSUFFICIENT_FUNDS
+                        )
                     )
                 )
             )
         )
     )
 
+def recorded_outcome(transaction_record):
+    #
+    # What a repeated transfer evaluates to, given the transaction record of the first one.
+    # Records without a status (written by ledger.sharding) are applied transfers.
+    #
+    return q.if_(
+        q.equals(q.select_with_default(["data", "status"], transaction_record, APPLIED), REJECTED),
+        INSUFFICIENT_FUNDS,
+        ALREADY_APPLIED
+    )
+
+def transfer_outcome(client, uuid):
+    #
+    # The outcome recorded for the transfer 'uuid', as a repeat of it would return it.
+    #
+    return client.query(recorded_outcome(q.get(q.match(q.index("transaction_by_uuid"), uuid))))
+
+def transfer_query(transaction):
+    #
+    # The full query for a transfer described by a transaction dictionary.
+    #
+    return transfer_expr(transaction["uuid"], transaction["sourceCust"], transaction["destCust"],
+                         transaction["amount"])
+
+def function_definitions():
+    #
+    # Store the transfer logic in the database once as a user defined function, named
+    # TRANSFER_FUNCTION_NAME. A transfer is then just a call of that function with four
+    # arguments instead of the whole nested let expression being built, encoded and sent
+    # every time.
+    #
+    return [{
+        "name": TRANSFER_FUNCTION_NAME,
+        "body": q.query(lambda uuid, source_id, dest_id, amount: transfer_expr(uuid, source_id, dest_id, amount))
+    }]
+
+def create_functions(client):
+    #
+    # Create the functions of function_definitions().
+    #
+    res = client.query(
+        [q.create_function(definition) for definition in function_definitions()]
+    )
+    print('Create \'{0}\' function'.format(TRANSFER_FUNCTION_NAME))
+    pprint.pprint(res)
+
+def transfer_call(transaction):
+    #
+    # The query for a transfer through the stored transfer function.
+    #
+    return q.call(TRANSFER_FUNCTION, transaction["uuid"], transaction["sourceCust"], transaction["destCust"],
+                  transaction["amount"])
+
+def create_transaction(client, num_customers, max_txn_amount):
+    #
+    # This method is going to create a random transaction that moves a random amount
+    # from a source customer to a destination customer. Prior to committing the transaction
+    # a check will be performed to insure that the source customer has a sufficient balance
+    # to cover the amount and not go into an overdrawn state.
+    #
+    transaction = random_transfer(num_customers, max_txn_amount)
+
+    return client.query(transfer_query(transaction))
+
+def create_transaction_with_function(client, num_customers, max_txn_amount):
+    #
+    # Same as create_transaction, through the stored transfer function.
+    #
+    transaction = random_transfer(num_customers, max_txn_amount)
+
+    return client.query(transfer_call(transaction))
+
+def is_contention_error(error):
+    #
+    # FaunaDB answers a transaction that lost a serialization race on a hot document with
+    # HTTP 409 (contended transaction). The driver surfaces that as an UnexpectedError, so
+    # look at the status code of the request rather than at the exception type. A 503 means
+    # the cluster is temporarily unable to serve the request and is equally safe to retry.
+    #
+    if isinstance(error, UnavailableError):
+        return True
+    request_result = getattr(error, "request_result", None)
+    return request_result is not None and request_result.status_code == 409
+
+class TransferStats(object):
+    #
+    # Thread safe counters shared by the workers of a concurrent transfer run.
+    #
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.applied = 0
+        self.insufficient = 0
+        self.conflicts = 0
+        self.retries = 0
+        self.failed = 0
+        self.duplicates = 0
+        self.start_time = time.time()
+        self.end_time = None
+
+    def add(self, **counts):
+        with self.lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def summary(self):
+        elapsed = (self.end_time or time.time()) - self.start_time
+        completed = self.applied + self.insufficient
+        return {
+            "transfers": completed,
+            "applied": self.applied,
+            "insufficient": self.insufficient,
+            "conflicts": self.conflicts,
+            "retries": self.retries,
+            "failed": self.failed,
+            "duplicates": self.duplicates,
+            "seconds": elapsed,
+            "transfers_per_sec": completed / elapsed if elapsed > 0 else 0.0
+        }
+
+def query_with_retry(client, expr, stats, max_retries=8, base_backoff=0.01, max_backoff=1.0):
+    #
+    # Run a query and retry it when it fails because of contention. Each retry waits for a
+    # random time up to an exponentially growing cap ("full jitter") so that workers that
+    # collided on the same customer do not collide again on the next attempt.
+    #
+    attempt = 0
+    while True:
+        try:
+            return client.query(expr)
+        except FaunaError as error:
+            if not is_contention_error(error):
+                raise
+            stats.add(conflicts=1)
+            if attempt >= max_retries:
+                raise
+            attempt += 1
+            stats.add(retries=1)
+            time.sleep(uniform(0, min(max_backoff, base_backoff * (2 ** attempt))))
+
+def is_duplicate_transfer_error(error):
+    #
+    # The transaction record could not be created because another attempt of the same
+    # transfer created it first: the transfer was decided by that attempt.
+    #
+    return isinstance(error, BadRequest) and any(e.code == "instance not unique" for e in error.errors)
+
+def apply_idempotent_transfer(client, transaction, stats, use_function=False, max_retries=8, base_backoff=0.01,
+                              max_backoff=1.0, query=None):
+    #
+    # Apply a transfer, retrying not only on contention but also when the request timed out
+    # or the connection failed, in which case it is unknown whether the transfer was applied.
+    # That is safe because a transfer is decided at most once per uuid: an attempt that
+    # comes after the transfer was applied returns ALREADY_APPLIED (counted in
+    # stats.duplicates) instead of moving the money again, and one that comes after it was
+    # rejected returns INSUFFICIENT_FUNDS even if the source could cover it by now. An
+    # attempt that lost the race against another one reads the outcome the other recorded.
+    #
+    # 'query' replaces client.query for sending the transfer, e.g. with hedged requests
+    # (see ledger.hedging).
+    #
+    expr = transfer_call(transaction) if use_function else transfer_query(transaction)
+    run = query or client.query
+    attempt = 0
+    while True:
+        try:
+            res = run(expr)
+            break
+        except FaunaError as error:
+            if is_duplicate_transfer_error(error):
+                res = transfer_outcome(client, transaction["uuid"])
+                break
+            if not is_contention_error(error):
+                raise
+            stats.add(conflicts=1)
+            if attempt >= max_retries:
+                raise
+        except (Timeout, RequestsConnectionError):
+            if attempt >= max_retries:
+                raise
+        attempt += 1
+        stats.add(retries=1)
+        time.sleep(uniform(0, min(max_backoff, base_backoff * (2 ** attempt))))
+
+    if res == ALREADY_APPLIED:
+        stats.add(duplicates=1)
+    return res
+
+def run_concurrent_transactions(client, num_customers, max_txn_amount, num_txns, num_workers=8,
+                                max_retries=8, base_backoff=0.01, use_function=False, apply_transfer=None):
+    #
+    # Drive 'num_txns' random transfers through 'num_workers' threads that share a single
+    # client. Every worker keeps taking the next transfer number until all of them have been
+    # handed out, so the work is spread evenly no matter how long individual transfers take.
+    #
+    # Transfers are applied with apply_idempotent_transfer. Transfers that still conflict
+    # after 'max_retries' attempts are counted as failed, any other error stops the run. With
+    # 'use_function' the transfers call the stored transfer function.
+    #
+    # 'apply_transfer' replaces the way a transfer is applied. It is called with the client,
+    # the transaction dictionary and the TransferStats, must retry contention itself and
+    # returns the result of the transfer.
+    #
+    stats = TransferStats()
+    remaining = [num_txns]
+    remaining_lock = threading.Lock()
+
+    def worker():
+        while True:
+            with remaining_lock:
+                if remaining[0] == 0:
+                    return
+                remaining[0] -= 1
+
+            transaction = random_transfer(num_customers, max_txn_amount)
+            try:
+                if apply_transfer is not None:
+                    res = apply_transfer(client, transaction, stats)
+                else:
+                    res = apply_idempotent_transfer(client, transaction, stats, use_function,
+                                                    max_retries=max_retries, base_backoff=base_backoff)
+            except FaunaError as error:
+                if not is_contention_error(error):
+                    raise
+                stats.add(failed=1)
+                continue
+
+            if res == INSUFFICIENT_FUNDS:
+                stats.add(insufficient=1)
+            else:
+                stats.add(applied=1)
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(worker) for _ in range(num_workers)]
+        for future in futures:
+            future.result()
+    stats.end_time = time.time()
+
+    summary = stats.summary()
+    print('Ran {0} transfers with {1} workers: {2:.1f} transfers/sec, {3} conflicts, {4} retries, {5} failed'
+          .format(summary["transfers"], num_workers, summary["transfers_per_sec"],
+                  summary["conflicts"], summary["retries"], summary["failed"]))
+
+    return summary
+
+
+def transfer_batches(transfers, max_batch_size=50, max_batch_bytes=MAX_BATCH_BYTES, use_function=False):
+    #
+    # Group transfers into batches of at most 'max_batch_size' transfers whose encoded
+    # queries add up to no more than 'max_batch_bytes', so that large batches stay well
+    # under the request size limit. A single transfer that is larger than the limit on its
+    # own is still sent, in a batch by itself.
+    #
+    build_query = transfer_call if use_function else transfer_query
+    batch = []
+    batch_bytes = 0
+    for transaction in transfers:
+        expr = build_query(transaction)
+        expr_bytes = len(to_json(expr))
+        if batch and (len(batch) >= max_batch_size or batch_bytes + expr_bytes > max_batch_bytes):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append((transaction, expr))
+        batch_bytes += expr_bytes
+    if batch:
+        yield batch
+
+def create_transactions_batch(client, transfers, max_batch_size=50, max_batch_bytes=MAX_BATCH_BYTES,
+                              stats=None, use_function=False):
+    #
+    # Apply many independent transfers with one client.query round-trip per batch. The
+    # queries of a batch are sent as an array, which FaunaDB evaluates in order inside a
+    # single transaction, so each transfer keeps its own insufficient funds check and sees
+    # the balances left by the transfers before it in the same batch.
+    #
+    # The return is one result per transfer, in the order given, telling whether it was
+    # applied or rejected. Note that an error in any transfer (an unknown customer id for
+    # example) fails the whole batch it is in.
+    #
+    if stats is None:
+        stats = TransferStats()
+
+    results = []
+    num_batches = 0
+    for batch in transfer_batches(transfers, max_batch_size, max_batch_bytes, use_function):
+        res = query_with_retry(client, [expr for transaction, expr in batch], stats)
+        num_batches += 1
+        for (transaction, expr), txn_res in zip(batch, res):
+            applied = txn_res != INSUFFICIENT_FUNDS
+            if applied:
+                stats.add(applied=1)
+            else:
+                stats.add(insufficient=1)
+            results.append({"transaction": transaction, "applied": applied})
+
+    print('Applied {0} of {1} transfers in {2} batches'.format(
+        sum(1 for r in results if r["applied"]), len(results), num_batches))
+
+    return results
+
 
 def main(argv):
     #
@@ -224,25 +809,53 @@ def main(argv):
 
     db_name = "LedgerExample"
 
-    db_secret = create_database(scheme, domain, port, secret, db_name)
+    #
+    # With --keep-database an existing database and its data are kept: only the missing
+    # parts of the schema and the missing customers are created. Pass the secret printed by
+    # the first run as --db-secret to reuse its key.
+    #
+    parser = argparse.ArgumentParser(prog=argv[0])
+    parser.add_argument("--keep-database", action="store_true")
+    parser.add_argument("--db-secret", default=None)
+    args = parser.parse_args(argv[1:])
+
+    db_secret = create_database(scheme, domain, port, secret, db_name, recreate=not args.keep_database,
+                                db_secret=args.db_secret)
 
     client = create_db_client(scheme, domain, port, db_secret)
 
-    create_classes(client)
+    if args.keep_database:
+        sync_schema(client, CLASSES, INDEXES, function_definitions())
+
+        cust_refs = create_missing_customers(client, 50, 100)
+    else:
+        create_classes(client)
 
-    create_indices(client)
+        create_indices(client)
 
-    # create_customer(client, 0, 101)
+        create_functions(client)
 
-    cust_refs = create_customers(client, 50, 100)
+        # create_customer(client, 0, 101)
+
+        cust_refs = create_customers(client, 50, 100)
 
     sum_customer_balanaces(client, cust_refs)
 
-    for i in range(0, 1000):
-        create_transaction(client, 50, 10)
+    run_concurrent_transactions(client, 50, 10, 1000, num_workers=8, use_function=True)
+
+    transfers = [random_transfer(50, 10) for i in range(0, 1000)]
+    create_transactions_batch(client, transfers, max_batch_size=50, use_function=True)
 
     sum_customer_balanaces(client, cust_refs)
 
+    sum_customer_balances_indexed(client, 1, 50)
+
+    print('Richest 5 customers:')
+    pprint.pprint(top_customers_by_balance(client, 5))
+
+    print('Customers with a balance below 90:')
+    pprint.pprint(customers_below_balance(client, 90))
+
 
 if __name__ == "__main__":
     main(sys.argv)
@@ -0,0 +1,519 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Coroutine versions of the ledger operations of Lessons 2 to 4, for asyncio services.
+#
+# The FaunaDB driver blocks on every query, so an asyncio service has to run it on a thread
+# per in-flight request. AsyncFaunaClient speaks the same HTTP API from the event loop
+# instead: requests are written and read on asyncio streams taken from an
+# AsyncConnectionPool, so thousands of queries can be in flight on one thread. The pool
+# holds at most 'pool_size' keep-alive connections, which is also how many requests are on
+# the wire at once; further queries wait for a connection to be returned. Clients for other
+# secrets made with new_session_client share the pool.
+#
+# Queries are built with the driver's query module and answers and errors are decoded the
+# way the driver does it, so results are the same values and failures raise the same
+# FaunaError subclasses as with FaunaClient.
+#
+# A pool belongs to the event loop it was first used on.
+#
+
+import sys
+import ssl
+import gzip
+import time
+import socket
+import asyncio
+from base64 import b64encode
+from random import uniform
+from requests.structures import CaseInsensitiveDict
+from faunadb import query as q
+from faunadb.client import API_VERSION, _LastTxnTime, _get_or_raise
+from faunadb.errors import FaunaError, UnexpectedError
+from faunadb.request_result import RequestResult
+from faunadb.query import _wrap
+from faunadb._json import parse_json_or_none, to_json
+
+from ledger.balances import customer_balance, customer_data
+from ledger.client import create_database, create_db_client, DEFAULT_POOL_SIZE, DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT
+from Lesson4 import (INSUFFICIENT_FUNDS, TransferStats, create_classes, create_functions, create_indices,
+                     customer_chunks, generate_customers, is_contention_error, random_transfer, transfer_call,
+                     transfer_query)
+
+
+class _StaleConnection(Exception):
+    #
+    # A kept-alive connection was closed by the server before it answered.
+    #
+    pass
+
+
+class AsyncConnectionPool(object):
+    #
+    # Keep-alive HTTP/1.1 connections to one endpoint, at most 'pool_size' of them.
+    #
+    def __init__(self, scheme, domain, port, pool_size=DEFAULT_POOL_SIZE, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT):
+        self.scheme = scheme
+        self.domain = domain
+        self.port = int(port)
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.opened = 0
+        self._idle = []
+        self._slots = None
+
+    async def _connect(self):
+        ssl_context = ssl.create_default_context() if self.scheme == "https" else None
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.domain, self.port, ssl=ssl_context), self.connect_timeout)
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.opened += 1
+        return reader, writer
+
+    async def request(self, method, path, headers, body):
+        #
+        # Send one request and return (status, headers, body) of the answer. A kept-alive
+        # connection the server has closed in the meantime is replaced by a new one.
+        #
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.pool_size)
+        async with self._slots:
+            while True:
+                reused = bool(self._idle)
+                reader, writer = self._idle.pop() if reused else await self._connect()
+                try:
+                    status, resp_headers, content, keep_alive = await asyncio.wait_for(
+                        self._exchange(reader, writer, method, path, headers, body), self.read_timeout)
+                except (_StaleConnection, ConnectionResetError, BrokenPipeError):
+                    writer.close()
+                    if reused:
+                        continue
+                    raise
+                except BaseException:
+                    writer.close()
+                    raise
+                if keep_alive:
+                    self._idle.append((reader, writer))
+                else:
+                    writer.close()
+                return status, resp_headers, content
+
+    async def _exchange(self, reader, writer, method, path, headers, body):
+        head = ["{0} {1} HTTP/1.1".format(method, path),
+                "Host: {0}:{1}".format(self.domain, self.port),
+                "Content-Length: {0}".format(len(body))]
+        head.extend("{0}: {1}".format(name, value) for name, value in headers.items())
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise _StaleConnection()
+        version, status = status_line.decode("latin-1").split(None, 2)[:2]
+        resp_headers = CaseInsensitiveDict()
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            resp_headers[name.strip()] = value.strip()
+
+        connection = resp_headers.get("Connection", "").lower()
+        keep_alive = connection == "keep-alive" or (version == "HTTP/1.1" and connection != "close")
+
+        if resp_headers.get("Transfer-Encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            content = b"".join(chunks)
+        elif "Content-Length" in resp_headers:
+            content = await reader.readexactly(int(resp_headers["Content-Length"]))
+        else:
+            content = await reader.read()
+            keep_alive = False
+
+        if resp_headers.get("Content-Encoding", "").lower() == "gzip":
+            content = gzip.decompress(content)
+        return int(status), resp_headers, content, keep_alive
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        for reader, writer in idle:
+            writer.close()
+        for reader, writer in idle:
+            try:
+                await writer.wait_closed()
+            except (OSError, ssl.SSLError):
+                pass
+
+
+class AsyncFaunaClient(object):
+    #
+    # The asyncio counterpart of FaunaClient: 'await client.query(expr)'.
+    #
+    def __init__(self, secret, domain="db.fauna.com", scheme="https", port=None, pool=None,
+                 pool_size=DEFAULT_POOL_SIZE, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT, observer=None):
+        self.domain = domain
+        self.scheme = scheme
+        self.port = (443 if scheme == "https" else 80) if port is None else int(port)
+        self.pool = pool or AsyncConnectionPool(scheme, domain, self.port, pool_size, connect_timeout,
+                                                read_timeout)
+        self.observer = observer
+        self._last_txn_time = _LastTxnTime()
+        self._headers = {
+            "Authorization": "Basic " + b64encode((secret + ":").encode("utf-8")).decode("ascii"),
+            "Accept-Encoding": "gzip",
+            "Content-Type": "application/json;charset=utf-8",
+            "X-Fauna-Driver": "python",
+            "X-FaunaDB-API-Version": API_VERSION
+        }
+
+    def new_session_client(self, secret):
+        #
+        # A client for another secret (e.g. a database key) on the same connection pool.
+        #
+        return AsyncFaunaClient(secret, self.domain, self.scheme, self.port, pool=self.pool,
+                                observer=self.observer)
+
+    async def query(self, expression, timeout_millis=None):
+        data = _wrap(expression)
+        headers = dict(self._headers)
+        headers.update(self._last_txn_time.request_header)
+        if timeout_millis is not None:
+            headers["X-Query-Timeout"] = str(timeout_millis)
+
+        start_time = time.time()
+        status, resp_headers, content = await self.pool.request("POST", "/", headers, to_json(data).encode("utf-8"))
+        end_time = time.time()
+
+        if "X-Txn-Time" in resp_headers:
+            self._last_txn_time.update_txn_time(int(resp_headers["X-Txn-Time"]))
+
+        response_raw = content.decode("utf-8")
+        response_content = parse_json_or_none(response_raw)
+        request_result = RequestResult("POST", "", None, data, response_raw, response_content, status,
+                                       resp_headers, start_time, end_time)
+        if self.observer is not None:
+            self.observer(request_result)
+
+        if response_content is None:
+            raise UnexpectedError("Invalid JSON.", request_result)
+
+        FaunaError.raise_for_status_code(request_result)
+        return _get_or_raise(request_result, response_content, "resource")
+
+    async def close(self):
+        await self.pool.close()
+
+
+def create_async_db_client(scheme, domain, port, secret, **pool_options):
+    #
+    # Create an asyncio client for the database key, with its own connection pool.
+    #
+    return AsyncFaunaClient(secret, domain, scheme, port, **pool_options)
+
+
+async def query_with_retry(client, expr, stats, max_retries=8, base_backoff=0.01, max_backoff=1.0):
+    #
+    # Lesson4.query_with_retry, waiting on the event loop between attempts.
+    #
+    attempt = 0
+    while True:
+        try:
+            return await client.query(expr)
+        except FaunaError as error:
+            if not is_contention_error(error):
+                raise
+            stats.add(conflicts=1)
+            if attempt >= max_retries:
+                raise
+            attempt += 1
+            stats.add(retries=1)
+            await asyncio.sleep(uniform(0, min(max_backoff, base_backoff * (2 ** attempt))))
+
+
+async def create_customer(client, cust_id, balance):
+    #
+    # Create a customer, returning the new document.
+    #
+    return await client.query(
+        q.create(q.class_("customers"), {"data": {"id": cust_id, "balance": balance}})
+    )
+
+
+async def create_customers(client, num_customers, init_balance, max_chunk_size=500):
+    #
+    # Create customers 1 to 'num_customers', one query per chunk and all the chunks at the
+    # same time. Returns the refs in customer id order.
+    #
+    chunks = customer_chunks(generate_customers(num_customers, init_balance), max_chunk_size)
+    results = await asyncio.gather(*[
+        client.query(q.map_(lambda customer: q.select("ref", q.create(q.class_("customers"), {"data": customer})),
+                            chunk))
+        for chunk in chunks])
+    return [ref for refs in results for ref in refs]
+
+
+async def read_customer(client, cust_id):
+    #
+    # Read the data of one customer.
+    #
+    return await client.query(
+        customer_data(q.get(q.match(q.index("customer_by_id"), cust_id)))
+    )
+
+
+async def read_list_of_customers(client, cust_list):
+    #
+    # Read the data of any number of customers by id, in id order; ids with no customer
+    # are left out.
+    #
+    res = await client.query(
+        q.map_(lambda x: customer_data(q.get(x)),
+               q.paginate(
+                   q.union(
+                       q.map_(lambda y: q.match(q.index("customer_by_id"), y), cust_list)
+                   ),
+                   size=max(1, len(cust_list))
+               )
+               )
+    )
+    return res["data"]
+
+
+async def read_customers_less_than(client, max_cust_id, page_size=64):
+    #
+    # The data of the customers with id < max_cust_id.
+    #
+    rows = []
+    async for page in iterate_pages(client, q.match(q.index("customer_id_filter")),
+                                    lambda x: customer_data(q.get(q.select(1, x))),
+                                    before=[max_cust_id], page_size=page_size):
+        rows.extend(page)
+    return rows
+
+
+async def iterate_pages(client, set_expr, map_lambda=None, after=None, before=None, page_size=64):
+    #
+    # Lesson3.iterate_pages as an async generator: 'async for page in iterate_pages(...)'.
+    # The next page is requested as soon as a page arrives, so it is on its way while the
+    # caller works on the current one. 'after' and 'before' bound the rows the same way.
+    #
+    def page_query(cursor):
+        page = q.paginate(set_expr, after=cursor, size=page_size)
+        if before is not None:
+            page = q.filter_(lambda row: q.lt(q.select(0, row), before[0]), page)
+        if map_lambda is not None:
+            page = q.map_(map_lambda, page)
+        return page
+
+    pending = asyncio.ensure_future(client.query(page_query(after)))
+    try:
+        while True:
+            res = await pending
+            pending = None
+            last = 'after' not in res or (before is not None and res['after'][0] >= before[0])
+            if not last:
+                pending = asyncio.ensure_future(client.query(page_query(res['after'])))
+            yield res['data']
+            if last:
+                return
+    finally:
+        if pending is not None:
+            pending.cancel()
+
+
+async def iterate_rows(client, set_expr, map_lambda=None, **kwargs):
+    #
+    # Same as iterate_pages, one row at a time.
+    #
+    async for page in iterate_pages(client, set_expr, map_lambda, **kwargs):
+        for row in page:
+            yield row
+
+
+async def scan_customers_between(client, min_cust_id, max_cust_id, page_size=64):
+    #
+    # Lazily stream the customers with min_cust_id <= id < max_cust_id from the
+    # 'customer_id_balance_filter' index.
+    #
+    async for cust_id, balance in iterate_rows(client, q.match(q.index("customer_id_balance_filter")),
+                                               after=[min_cust_id], before=[max_cust_id], page_size=page_size):
+        yield {"id": cust_id, "balance": balance}
+
+
+async def read_customers_between(client, min_cust_id, max_cust_id):
+    #
+    # The customers with min_cust_id <= id < max_cust_id, as a list.
+    #
+    return [row async for row in scan_customers_between(client, min_cust_id, max_cust_id)]
+
+
+async def sum_customer_balanaces(client, cust_refs):
+    #
+    # Sum the balances of the customers with these refs (Lesson4.sum_customer_balanaces).
+    #
+    res = await client.query(
+        q.map_(
+            lambda cust_ref: customer_balance(q.get(cust_ref)),
+            cust_refs)
+    )
+    return sum(res)
+
+
+async def sum_balance_range(client, min_cust_id, max_cust_id, page_size=1024,
+                            index_name="customer_id_balance_filter"):
+    #
+    # Lesson4.sum_balance_range: each page of the range is summed by FaunaDB.
+    #
+    balance_sum = 0
+    cursor = [min_cust_id]
+    while True:
+        page = q.filter_(lambda cust_id, balance: q.lt(cust_id, max_cust_id),
+                         q.paginate(q.match(q.index(index_name)), after=cursor, size=page_size))
+        res = await client.query(
+            q.let(
+                {"page": page},
+                {"sum": q.sum(q.map_(lambda cust_id, balance: balance, q.select("data", q.var("page")))),
+                 "after": q.select_with_default("after", q.var("page"), None)}
+            )
+        )
+        balance_sum = balance_sum + res['sum']
+        cursor = res.get('after')
+        if cursor is None or cursor[0] >= max_cust_id:
+            return balance_sum
+
+
+async def sum_customer_balances_indexed(client, min_cust_id, max_cust_id, num_partitions=4, page_size=1024,
+                                        index_name="customer_id_balance_filter"):
+    #
+    # Sum the balances of customers min_cust_id to max_cust_id (inclusive), the partitions
+    # of the id range being summed at the same time.
+    #
+    bounds = [min_cust_id + (max_cust_id + 1 - min_cust_id) * i // num_partitions
+              for i in range(0, num_partitions + 1)]
+    sums = await asyncio.gather(*[sum_balance_range(client, lower, upper, page_size, index_name)
+                                  for lower, upper in zip(bounds, bounds[1:]) if lower < upper])
+    return sum(sums)
+
+
+async def create_transaction(client, num_customers, max_txn_amount, stats=None, use_function=False):
+    #
+    # Apply one random transfer (Lesson4.create_transaction), retrying on contention.
+    # Returns INSUFFICIENT_FUNDS when the source balance is too low.
+    #
+    transaction = random_transfer(num_customers, max_txn_amount)
+    expr = transfer_call(transaction) if use_function else transfer_query(transaction)
+    return await query_with_retry(client, expr, stats if stats is not None else TransferStats())
+
+
+async def run_concurrent_transactions(client, num_customers, max_txn_amount, num_txns, max_in_flight=256,
+                                      use_function=False):
+    #
+    # Apply 'num_txns' random transfers with at most 'max_in_flight' of them pending at a
+    # time, all from the one event loop. Returns the TransferStats summary.
+    #
+    # As in Lesson4.run_concurrent_transactions, transfers that still conflict after the
+    # retries are counted as failed and any other error stops the run: the transfers that
+    # are still pending are cancelled and the error is raised.
+    #
+    stats = TransferStats()
+    limit = asyncio.Semaphore(max_in_flight)
+
+    async def one():
+        async with limit:
+            try:
+                res = await create_transaction(client, num_customers, max_txn_amount, stats, use_function)
+            except FaunaError as error:
+                if not is_contention_error(error):
+                    raise
+                stats.add(failed=1)
+                return
+        if res == INSUFFICIENT_FUNDS:
+            stats.add(insufficient=1)
+        else:
+            stats.add(applied=1)
+
+    tasks = [asyncio.ensure_future(one()) for i in range(0, num_txns)]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    stats.end_time = time.time()
+
+    summary = stats.summary()
+    print('Applied {0} transfers ({1} insufficient funds, {2} failed) with {3} in flight in {4:.2f} seconds: '
+          '{5:.1f} transfers/sec, {6} conflicts'.format(summary["applied"], summary["insufficient"],
+                                                         summary["failed"], max_in_flight, summary["seconds"],
+                                                         summary["transfers_per_sec"], summary["conflicts"]))
+    return summary
+
+
+async def run(scheme, domain, port, db_secret):
+    client = create_async_db_client(scheme, domain, port, db_secret)
+    try:
+        cust_refs = await create_customers(client, 1000, 100, max_chunk_size=100)
+        print('Created {0} customers'.format(len(cust_refs)))
+        print('Read \'customer\' 1: {0}'.format(await read_customer(client, 1)))
+        print('Read \'customer\' 1, 3, 8: {0}'.format(await read_list_of_customers(client, [1, 3, 8])))
+        print('Query for id\'s < 5 : {0}'.format(await read_customers_less_than(client, 5)))
+        print('Query for id\'s >= 4 and < 8 : {0}'.format(await read_customers_between(client, 4, 8)))
+
+        print('Customer Balance Sum: {0}'.format(await sum_customer_balanaces(client, cust_refs)))
+        await run_concurrent_transactions(client, 1000, 10, 2000, max_in_flight=512, use_function=True)
+        print('Customer Balance Sum (index): {0}'.format(await sum_customer_balances_indexed(client, 1, 1000)))
+        print('Opened {0} connections'.format(client.pool.opened))
+    finally:
+        await client.close()
+
+
+def main(argv):
+    #
+    # Same local developer endpoint as the lessons.
+    #
+    scheme = "http"
+    domain = "127.0.0.1"
+    port = "8443"
+    secret = "secret"
+
+    db_secret = create_database(scheme, domain, port, secret, "LedgerAsyncExample")
+
+    client = create_db_client(scheme, domain, port, db_secret)
+    create_classes(client)
+    create_indices(client)
+    create_functions(client)
+
+    asyncio.run(run(scheme, domain, port, db_secret))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,52 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# Reading a customer's balance whether or not the customer is sharded. In the sharded mode
+# of ledger.sharding the customer document only records its number of shards and the balance
+# is the sum of its 'balance_shards'; otherwise the balance is on the document. These are
+# FQL expressions, so a read sums the shards on the server in the same query.
+#
+
+from faunadb import query as q
+
+
+def customer_balance(customer):
+    #
+    # The balance of the customer document 'customer'.
+    #
+    return q.if_(
+        q.contains(["data", "shards"], customer),
+        q.sum(q.map_(lambda balance, ref: balance,
+                     q.select("data", q.paginate(q.match(q.index("balance_shards_by_customer"),
+                                                         q.select(["data", "id"], customer)),
+                                                 size=q.select(["data", "shards"], customer))))),
+        q.select(["data", "balance"], customer)
+    )
+
+
+def customer_data(customer):
+    #
+    # The data of the customer document 'customer', with the balance of a sharded customer
+    # summed over its shards.
+    #
+    return q.if_(
+        q.contains(["data", "shards"], customer),
+        {"id": q.select(["data", "id"], customer),
+         "shards": q.select(["data", "shards"], customer),
+         "balance": customer_balance(customer)},
+        q.select("data", customer)
+    )
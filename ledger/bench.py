@@ -0,0 +1,346 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Benchmarks for the ledger operations of the lessons. Every operation is run against a
+# configurable backend (a live FaunaDB or the in-process stand-in of ledger.fake) and
+# reported with its throughput, p50/p95/p99 latency and the bytes sent and received.
+#
+# The customer count, the transfer batch size and the number of concurrent workers can be
+# swept, and the results are written as JSON so that two runs can be compared:
+#
+#     python -m ledger.bench --customers 100,1000 --batch-sizes 10,50 --concurrency 1,8 \
+#         --output new.json --compare old.json
+#
+# Each result is keyed by (operation, customers, batch_size, concurrency); --compare reports
+# every key whose p50 latency or throughput got worse than the tolerance.
+#
+
+import io
+import sys
+import json
+import time
+import argparse
+import platform
+import threading
+import tracemalloc
+import contextlib
+from random import randint, sample
+from concurrent.futures import ThreadPoolExecutor
+
+import Lesson2
+import Lesson3
+import Lesson4
+from faunadb.query import _wrap
+from faunadb._json import to_json
+from ledger import compact
+from ledger.client import close_clients, create_database, create_db_client
+
+
+class WireMeter(object):
+    #
+    # Counts the bytes of every request and response that goes through a client session.
+    #
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+
+    def attach(self, client):
+        client.session.hooks["response"].append(self.on_response)
+
+    def on_response(self, response, *args, **kwargs):
+        body = response.request.body or b""
+        with self.lock:
+            self.requests += 1
+            self.bytes_out += len(body.encode("utf-8") if isinstance(body, str) else body)
+            self.bytes_in += len(response.content or b"")
+
+    def snapshot(self):
+        with self.lock:
+            return (self.requests, self.bytes_out, self.bytes_in)
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(pct / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def measure(meter, fn, count, concurrency=1):
+    #
+    # Call fn(i) for i in range(count) from 'concurrency' threads and summarize the calls.
+    # Anything the lesson functions print is discarded while they are being measured.
+    #
+    latencies = []
+    lock = threading.Lock()
+    before = meter.snapshot()
+
+    def call(i):
+        start_time = time.perf_counter()
+        fn(i)
+        elapsed = time.perf_counter() - start_time
+        with lock:
+            latencies.append(elapsed)
+
+    start_time = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        if concurrency <= 1:
+            for i in range(0, count):
+                call(i)
+        else:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                list(executor.map(call, range(0, count)))
+    elapsed = time.perf_counter() - start_time
+
+    after = meter.snapshot()
+    latencies.sort()
+    return {
+        "ops": count,
+        "seconds": elapsed,
+        "ops_per_sec": count / elapsed if elapsed > 0 else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "requests": after[0] - before[0],
+        "bytes_out": after[1] - before[1],
+        "bytes_in": after[2] - before[2]
+    }
+
+
+def traced_bytes(fn):
+    #
+    # Peak bytes allocated by fn() on top of what was already allocated.
+    #
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        fn()
+        return tracemalloc.get_traced_memory()[1] - base
+    finally:
+        tracemalloc.stop()
+
+
+def bench_customers(args, num_customers):
+    #
+    # Build a fresh database with 'num_customers' customers and run every operation on it.
+    #
+    results = []
+
+    def record(operation, stats, batch_size=None, concurrency=1, **extra):
+        stats.update(extra)
+        results.append(dict(operation=operation, customers=num_customers, batch_size=batch_size,
+                            concurrency=concurrency, **stats))
+        print('{0:<45} customers={1:<7} batch={2!s:<5} workers={3:<3} {4:>9.1f} ops/s  p50={5:.2f}ms  p99={6:.2f}ms'
+              .format(operation, num_customers, batch_size, concurrency, stats["ops_per_sec"],
+                      stats["p50_ms"], stats["p99_ms"]), file=sys.stderr)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        db_secret = create_database(args.scheme, args.domain, args.port, args.secret, args.db_name)
+        client = create_db_client(args.scheme, args.domain, args.port, db_secret, pool_size=max(args.concurrency) * 2)
+        Lesson4.create_classes(client)
+        Lesson4.create_indices(client)
+        Lesson4.create_functions(client)
+
+    meter = WireMeter()
+    meter.attach(client)
+    repeat = args.repeat
+    cust_refs = []
+
+    stats = measure(meter, lambda i: cust_refs.extend(
+        Lesson4.bulk_load_customers(client, Lesson4.generate_customers(num_customers, 100), report_every=0)), 1)
+    record("lesson4.create_customers", stats, rows_per_sec=num_customers / stats["seconds"])
+
+    #
+    # Lesson2 CRUD on customers that are not part of the data set, so they leave it as it was.
+    #
+    new_id = num_customers + 1
+    record("lesson2.create_customer", measure(meter, lambda i: Lesson2.create_customer(client, new_id + i, 100), repeat))
+    record("lesson2.read_customer", measure(meter, lambda i: Lesson2.read_customer(client, new_id + i), repeat))
+    record("lesson2.update_customer", measure(meter, lambda i: Lesson2.update_customer(client, new_id + i, 200), repeat))
+    record("lesson2.delete_customer", measure(meter, lambda i: Lesson2.delete_customer(client, new_id + i), repeat))
+
+    #
+    # Lesson3 reads.
+    #
+    ids = range(1, num_customers + 1)
+    record("lesson3.read_three_customers", measure(
+        meter, lambda i: Lesson3.read_three_customers(client, *sample(ids, 3)), repeat))
+    record("lesson3.read_list_of_customers", measure(
+        meter, lambda i: Lesson3.read_list_of_customers(client, sample(ids, min(10, num_customers))), repeat))
+    record("lesson3.read_customers_less_than", measure(
+        meter, lambda i: Lesson3.read_customers_less_than(client, randint(1, num_customers)), repeat))
+
+    def between(i):
+        low = randint(1, num_customers)
+        Lesson3.read_customers_between(client, low, low + 10)
+    record("lesson3.read_customers_between", measure(meter, between, repeat))
+    record("lesson3.read_all_customers", measure(
+        meter, lambda i: Lesson3.read_all_customers(client), max(1, repeat // 10)))
+
+    #
+    # Lesson4 balance sums and transfers.
+    #
+    record("lesson4.sum_customer_balanaces", measure(
+        meter, lambda i: Lesson4.sum_customer_balanaces(client, cust_refs), max(1, repeat // 10)))
+    record("lesson4.sum_customer_balances_indexed", measure(
+        meter, lambda i: Lesson4.sum_customer_balances_indexed(client, 1, num_customers), max(1, repeat // 10)))
+
+    for concurrency in args.concurrency:
+        transfer_stats = Lesson4.TransferStats()
+        stats = measure(meter, lambda i: Lesson4.query_with_retry(
+            client, Lesson4.transfer_query(Lesson4.random_transfer(num_customers, 10)), transfer_stats),
+            repeat * concurrency, concurrency)
+        record("lesson4.create_transaction", stats, concurrency=concurrency,
+               conflicts=transfer_stats.conflicts, retries=transfer_stats.retries)
+
+        transfer_stats = Lesson4.TransferStats()
+        stats = measure(meter, lambda i: Lesson4.query_with_retry(
+            client, Lesson4.transfer_call(Lesson4.random_transfer(num_customers, 10)), transfer_stats),
+            repeat * concurrency, concurrency)
+        record("lesson4.create_transaction_with_function", stats, concurrency=concurrency,
+               conflicts=transfer_stats.conflicts, retries=transfer_stats.retries)
+
+    for batch_size in args.batch_sizes:
+        transfer_stats = Lesson4.TransferStats()
+        stats = measure(meter, lambda i: Lesson4.create_transactions_batch(
+            client, [Lesson4.random_transfer(num_customers, 10) for j in range(0, batch_size)],
+            max_batch_size=batch_size, stats=transfer_stats), repeat)
+        record("lesson4.create_transactions_batch", stats, batch_size=batch_size,
+               transfers_per_sec=stats["ops_per_sec"] * batch_size,
+               conflicts=transfer_stats.conflicts, retries=transfer_stats.retries)
+
+        transfer_stats = Lesson4.TransferStats()
+        encoder = compact.TransferEncoder()
+        stats = measure(meter, lambda i: compact.apply_transfer_batch(
+            client, compact.TransferBatch.random(batch_size, num_customers, 10), max_batch_size=batch_size,
+            encoder=encoder, stats=transfer_stats), repeat)
+        record("compact.create_transactions_batch", stats, batch_size=batch_size,
+               transfers_per_sec=stats["ops_per_sec"] * batch_size,
+               conflicts=transfer_stats.conflicts, retries=transfer_stats.retries)
+
+        #
+        # Client side only: build and encode the request body of a batch, from dictionaries and
+        # query objects as Lesson4 does it, and from a TransferBatch.
+        #
+        def encode_dicts():
+            return to_json(_wrap([Lesson4.transfer_call(Lesson4.random_transfer(num_customers, 10))
+                                  for j in range(0, batch_size)]))
+
+        def encode_compact():
+            return encoder.encode(compact.TransferBatch.random(batch_size, num_customers, 10))
+
+        for operation, encode in (("lesson4.encode_transfers", encode_dicts), ("compact.encode_transfers", encode_compact)):
+            stats = measure(meter, lambda i: encode(), repeat)
+            record(operation, stats, batch_size=batch_size,
+                   us_per_transfer=stats["seconds"] * 1e6 / (repeat * batch_size),
+                   bytes_allocated_per_transfer=traced_bytes(encode) / batch_size)
+
+    return results
+
+
+def result_key(result):
+    return (result["operation"], result["customers"], result["batch_size"], result["concurrency"])
+
+
+def compare(baseline, current, tolerance):
+    #
+    # Return a description of every result that is slower than in the baseline by more than
+    # 'tolerance' (0.1 is 10%), either in p50 latency or in throughput.
+    #
+    previous = dict((result_key(r), r) for r in baseline["results"])
+    regressions = []
+    for result in current["results"]:
+        old = previous.get(result_key(result))
+        if old is None:
+            continue
+        if result["p50_ms"] > old["p50_ms"] * (1 + tolerance):
+            regressions.append('{0}: p50 {1:.2f}ms -> {2:.2f}ms'.format(result_key(result), old["p50_ms"], result["p50_ms"]))
+        if result["ops_per_sec"] < old["ops_per_sec"] * (1 - tolerance):
+            regressions.append('{0}: {1:.1f} ops/s -> {2:.1f} ops/s'.format(result_key(result), old["ops_per_sec"], result["ops_per_sec"]))
+    return regressions
+
+
+def int_list(value):
+    return [int(v) for v in value.split(",") if v]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="python -m ledger.bench")
+    parser.add_argument("--backend", choices=["fake", "fauna"], default="fake")
+    parser.add_argument("--scheme", default="http")
+    parser.add_argument("--domain", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8443)
+    parser.add_argument("--secret", default="secret")
+    parser.add_argument("--db-name", default="LedgerBenchmark")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="fake backend: latency per request")
+    parser.add_argument("--conflict-rate", type=float, default=0.0, help="fake backend: injected 409 rate")
+    parser.add_argument("--customers", type=int_list, default=[100])
+    parser.add_argument("--batch-sizes", type=int_list, default=[10, 50])
+    parser.add_argument("--concurrency", type=int_list, default=[1, 8])
+    parser.add_argument("--repeat", type=int, default=50, help="calls per operation")
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    parser.add_argument("--compare", help="JSON results of a previous run to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args(argv[1:])
+
+    fauna = None
+    if args.backend == "fake":
+        from ledger.fake import FakeFauna
+        fauna = FakeFauna(admin_secret=args.secret, latency=args.latency_ms / 1000.0,
+                          conflict_rate=args.conflict_rate)
+        fauna.install(args.scheme, args.domain, args.port)
+
+    results = []
+    for num_customers in args.customers:
+        results.extend(bench_customers(args, num_customers))
+    close_clients()
+
+    report = {
+        "config": {
+            "backend": args.backend,
+            "endpoint": "{0}://{1}:{2}".format(args.scheme, args.domain, args.port),
+            "latency_ms": args.latency_ms,
+            "conflict_rate": args.conflict_rate,
+            "repeat": args.repeat,
+            "python": platform.python_version(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        },
+        "results": results
+    }
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), report, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION {0}'.format(regression), file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
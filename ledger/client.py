@@ -0,0 +1,183 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# One place to build FaunaDB clients. Clients are created once per endpoint and secret and
+# then reused, and every client talking to the same endpoint with the same pool options shares
+# a single HTTP connection pool, so the cost of setting up connections is paid once instead of
+# on every query.
+#
+# The pool is explicit: it holds at most 'pool_size' keep-alive connections and a thread
+# that needs a connection while all of them are busy waits for one to be returned rather
+# than opening (and then throwing away) an extra one. Connect and read timeouts are applied
+# to every request. FaunaClient and the pool are safe to share between threads.
+#
+
+import socket
+import threading
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from faunadb.client import FaunaClient
+from faunadb import query as q
+
+DEFAULT_POOL_SIZE = 16
+DEFAULT_CONNECT_TIMEOUT = 5.0
+DEFAULT_READ_TIMEOUT = 60.0
+
+_lock = threading.Lock()
+_endpoints = {}
+_clients = {}
+_transports = {}
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    #
+    # A requests transport adapter with a blocking connection pool, TCP keep-alive and
+    # default timeouts for requests that do not set their own.
+    #
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT):
+        self.timeout = (connect_timeout, read_timeout)
+        super(PooledHTTPAdapter, self).__init__(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+
+    def init_poolmanager(self, connections, maxsize, block=True, **pool_kwargs):
+        pool_kwargs.setdefault("socket_options",
+                               HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)])
+        super(PooledHTTPAdapter, self).init_poolmanager(connections, maxsize, block, **pool_kwargs)
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        if timeout is None:
+            timeout = self.timeout
+        return super(PooledHTTPAdapter, self).send(request, stream=stream, timeout=timeout, verify=verify,
+                                                   cert=cert, proxies=proxies)
+
+
+def get_client(scheme, domain, port, secret, pool_size=DEFAULT_POOL_SIZE,
+               connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT):
+    #
+    # Return the client for this endpoint, secret and pool options, creating it if needed.
+    # There is one pooled session per endpoint and set of pool options: the first client
+    # asking for them owns it, and clients for other secrets with the same options are
+    # session clients of it and share its connections. A client that asks for a bigger pool
+    # or other timeouts gets a pool of its own rather than silently inheriting another's.
+    #
+    endpoint = (scheme, domain, int(port))
+    options = (int(pool_size), float(connect_timeout), float(read_timeout))
+    with _lock:
+        client = _clients.get((endpoint, options, secret))
+        if client is not None:
+            return client
+
+        base = _endpoints.get((endpoint, options))
+        if base is None:
+            client = FaunaClient(secret=secret, domain=domain, scheme=scheme, port=int(port),
+                                 timeout=read_timeout, pool_connections=1, pool_maxsize=pool_size)
+            client.session.headers["Connection"] = "keep-alive"
+            client.session.mount(scheme + "://",
+                                 PooledHTTPAdapter(pool_size, connect_timeout, read_timeout))
+            if endpoint in _transports:
+                client.session.mount(client.base_url, _transports[endpoint])
+            _endpoints[(endpoint, options)] = client
+        else:
+            client = base.new_session_client(secret=secret)
+
+        _clients[(endpoint, options, secret)] = client
+        return client
+
+
+def set_transport(scheme, domain, port, adapter):
+    #
+    # Send the requests of clients created from now on for this endpoint through the given
+    # requests transport adapter instead of the network, e.g. the in-process stand-in of
+    # ledger.fake. Passing None goes back to the network.
+    #
+    with _lock:
+        if adapter is None:
+            _transports.pop((scheme, domain, int(port)), None)
+        else:
+            _transports[(scheme, domain, int(port))] = adapter
+
+
+def close_clients():
+    #
+    # Drop every cached client and close the shared connection pools.
+    #
+    with _lock:
+        for client in _endpoints.values():
+            client.session.close()
+        _endpoints.clear()
+        _clients.clear()
+
+
+def create_admin_client(scheme, domain, port, secret, **pool_options):
+    #
+    # The admin client is used to create databases and keys.
+    #
+    # If you are using the the FaunaDB-Cloud you will need to replace the value of the
+    # 'secret' with your "secret".
+    #
+    return get_client(scheme, domain, port, secret, **pool_options)
+
+
+def create_db_client(scheme, domain, port, secret, **pool_options):
+    #
+    # Create the DB specific DB client using the DB specific key.
+    #
+    return get_client(scheme, domain, port, secret, **pool_options)
+
+
+def create_database(scheme, domain, port, secret, db_name, recreate=True, db_secret=None):
+    #
+    # The code below creates the Database that will be used for the examples. Please note that
+    # the existence of the database is evaluated, deleted if it exists and recreated with a single
+    # call to the Fauna DB.
+    #
+    # With 'recreate' False an existing database is kept as it is, with its data, so that
+    # a restart only has to bring the schema up to date (see ledger.schema). Pass the secret
+    # printed by the first start as 'db_secret' to reuse its key: no new key is created then
+    # unless the database itself had to be created.
+    #
+    adminClient = create_admin_client(scheme, domain, port, secret)
+    print("Connected to FaunaDB as admin!")
+
+    if recreate:
+        res = adminClient.query(
+            q.if_(
+                q.exists(q.database(db_name)),
+                [q.delete(q.database(db_name)), q.create_database({"name": db_name})],
+                q.create_database({"name": db_name}))
+        )
+        print('DB {0} created: {1}'.format(db_name, res))
+    else:
+        res = adminClient.query(
+            q.if_(
+                q.exists(q.database(db_name)),
+                {"created": False, "database": q.get(q.database(db_name))},
+                {"created": True, "database": q.create_database({"name": db_name})})
+        )
+        print('DB {0} ready: {1}'.format(db_name, res["database"]))
+        if db_secret is not None and not res["created"]:
+            return db_secret
+
+    #
+    # Create a key specific to the database we just created. We will use this to
+    # create a new client we will use in the remainder of the examples.
+    #
+    res = adminClient.query(q.select(["secret"], q.create_key({"database": q.database(db_name), "role": "server"})))
+    print('DB {0} secret: {1}'.format(db_name, res))
+
+    return res
@@ -0,0 +1,312 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# A compact representation of pending transfers and customers, and request bodies written
+# straight from it.
+#
+# Lesson4 describes every transfer with a dictionary holding a 36 character uuid string,
+# turns it into a tree of faunadb.query objects and has the driver encode that tree to JSON,
+# all again for every transfer. At millions of transfers the allocations and the encoding
+# are a large part of the client's CPU time.
+#
+# A TransferBatch keeps a batch as four flat arrays (raw 16 byte uuids, source ids,
+# destination ids, amounts) instead of a dictionary per transfer. A QueryTemplate encodes
+# the query of a transfer once, with placeholders, and afterwards encodes any transfer by
+# pasting its values between the pre-encoded pieces, which produces the same JSON as the
+# driver without building any query objects. The body is sent on the client's own session,
+# so pooling, metrics hooks and ledger.fake work as for client.query.
+#
+#     batch = TransferBatch.random(500, 50, 10)
+#     results = apply_transfer_batch(client, batch)
+#
+# ledger.bench compares the encode time and allocations of both representations.
+#
+
+import os
+import re
+import time
+from array import array
+from random import randint, uniform
+from faunadb import query as q
+from faunadb.errors import FaunaError, UnexpectedError
+from faunadb.request_result import RequestResult
+from faunadb._json import parse_json_or_none, to_json
+
+from Lesson4 import INSUFFICIENT_FUNDS, TransferStats, is_contention_error, transfer_call, transfer_query
+from ledger.metrics import InstrumentedClient
+
+TRANSFER_FIELDS = ["uuid", "sourceCust", "destCust", "amount"]
+CUSTOMER_FIELDS = ["id", "balance"]
+
+
+class QueryTemplate(object):
+    #
+    # The JSON encoding of build(placeholders), split around the placeholders of 'fields'.
+    # encode() takes the already encoded value of each field, in the order of 'fields'.
+    #
+    def __init__(self, build, fields):
+        text = to_json(build(dict((field, "@@{0}@@".format(field)) for field in fields)))
+        pieces = re.split('"@@(' + "|".join(re.escape(field) for field in fields) + ')@@"', text)
+        self.literals = pieces[0::2]
+        self.slots = [fields.index(name) for name in pieces[1::2]]
+
+    def encode(self, values):
+        parts = [self.literals[0]]
+        for slot, literal in zip(self.slots, self.literals[1:]):
+            parts.append(values[slot])
+            parts.append(literal)
+        return "".join(parts)
+
+
+def _uuid4_bytes(count):
+    raw = bytearray(os.urandom(16 * count))
+    for offset in range(0, 16 * count, 16):
+        raw[offset + 6] = raw[offset + 6] & 0x0f | 0x40
+        raw[offset + 8] = raw[offset + 8] & 0x3f | 0x80
+    return raw
+
+
+class TransferBatch(object):
+    #
+    # Transfers held column by column in flat arrays.
+    #
+    __slots__ = ("uuids", "sources", "dests", "amounts")
+
+    def __init__(self):
+        self.uuids = bytearray()
+        self.sources = array("l")
+        self.dests = array("l")
+        self.amounts = array("l")
+
+    def __len__(self):
+        return len(self.sources)
+
+    def append(self, source_id, dest_id, amount, uuid=None):
+        self.uuids += uuid if uuid is not None else _uuid4_bytes(1)
+        self.sources.append(source_id)
+        self.dests.append(dest_id)
+        self.amounts.append(amount)
+
+    @classmethod
+    def random(cls, count, num_customers, max_txn_amount):
+        #
+        # 'count' random transfers, as Lesson4.random_transfer makes them.
+        #
+        batch = cls()
+        batch.uuids = _uuid4_bytes(count)
+        for i in range(0, count):
+            source_id = randint(1, num_customers)
+            dest_id = randint(1, num_customers - 1)
+            if dest_id >= source_id:
+                dest_id += 1
+            batch.sources.append(source_id)
+            batch.dests.append(dest_id)
+            batch.amounts.append(randint(1, max_txn_amount))
+        return batch
+
+    @classmethod
+    def from_transactions(cls, transactions):
+        batch = cls()
+        for transaction in transactions:
+            batch.append(transaction["sourceCust"], transaction["destCust"], transaction["amount"],
+                         bytes.fromhex(transaction["uuid"].replace("-", "")))
+        return batch
+
+    def uuid(self, i):
+        h = self.uuids[16 * i:16 * i + 16].hex()
+        return "{0}-{1}-{2}-{3}-{4}".format(h[0:8], h[8:12], h[12:16], h[16:20], h[20:32])
+
+    def transaction(self, i):
+        #
+        # Transfer 'i' as the dictionary the Lesson4 functions use.
+        #
+        return {"uuid": self.uuid(i), "sourceCust": self.sources[i], "destCust": self.dests[i],
+                "amount": self.amounts[i]}
+
+    def slice(self, start, end):
+        batch = TransferBatch()
+        batch.uuids = self.uuids[16 * start:16 * end]
+        batch.sources = self.sources[start:end]
+        batch.dests = self.dests[start:end]
+        batch.amounts = self.amounts[start:end]
+        return batch
+
+
+class TransferEncoder(object):
+    #
+    # Writes the request body for a TransferBatch: a JSON array with the query of every
+    # transfer, through the stored transfer function or, without 'use_function', inline.
+    #
+    def __init__(self, use_function=True):
+        self.template = QueryTemplate(transfer_call if use_function else transfer_query, TRANSFER_FIELDS)
+
+    def encode(self, batch):
+        literals = self.template.literals
+        slots = self.template.slots
+        hexes = batch.uuids.hex()
+        sources = batch.sources
+        dests = batch.dests
+        amounts = batch.amounts
+        parts = ["["]
+        for i in range(0, len(sources)):
+            h = hexes[32 * i:32 * i + 32]
+            values = ('"' + h[0:8] + "-" + h[8:12] + "-" + h[12:16] + "-" + h[16:20] + "-" + h[20:32] + '"',
+                      str(sources[i]), str(dests[i]), str(amounts[i]))
+            if i:
+                parts.append(",")
+            parts.append(literals[0])
+            for slot, literal in zip(slots, literals[1:]):
+                parts.append(values[slot])
+                parts.append(literal)
+        parts.append("]")
+        return "".join(parts)
+
+
+class CustomerBatch(object):
+    #
+    # Customers to create, as two flat arrays. The balances are kept as integers, or as
+    # doubles when any of them is a float (e.g. the 100.0 of Lesson2 and Lesson3). In the
+    # latter case 'whole' flags the balances that were given as integers, so every balance
+    # is encoded as the driver would encode it: 100 as 100 and 100.0 as 100.0.
+    #
+    __slots__ = ("ids", "balances", "whole")
+
+    def __init__(self, ids=(), balances=()):
+        balances = list(balances)
+        self.ids = array("l", ids)
+        if all(isinstance(b, int) for b in balances):
+            self.balances = array("l", balances)
+            self.whole = None
+        else:
+            self.balances = array("d", balances)
+            self.whole = bytearray(isinstance(b, int) for b in balances)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def balance(self, i):
+        value = self.balances[i]
+        return int(value) if self.whole is not None and self.whole[i] else value
+
+    @classmethod
+    def sequential(cls, num_customers, init_balance, first_id=1):
+        return cls(range(first_id, first_id + num_customers), [init_balance] * num_customers)
+
+
+CUSTOMER_TEMPLATE = QueryTemplate(
+    lambda customer: q.select("ref", q.create(q.class_("customers"),
+                                              {"data": {"id": customer["id"], "balance": customer["balance"]}})),
+    CUSTOMER_FIELDS)
+
+
+def encode_customers(batch, start=0, end=None):
+    end = len(batch) if end is None else end
+    literals = CUSTOMER_TEMPLATE.literals
+    slots = CUSTOMER_TEMPLATE.slots
+    parts = ["["]
+    for i in range(start, end):
+        values = (str(batch.ids[i]), str(batch.balance(i)))
+        if i > start:
+            parts.append(",")
+        parts.append(literals[0])
+        for slot, literal in zip(slots, literals[1:]):
+            parts.append(values[slot])
+            parts.append(literal)
+    parts.append("]")
+    return "".join(parts)
+
+
+def query_body(client, body):
+    #
+    # client.query for a request body that is already encoded: same headers, same
+    # transaction time tracking, same errors. The request goes through the client's session,
+    # and through an InstrumentedClient like a query of its own, so it shows up in the
+    # metrics of the current operation.
+    #
+    if isinstance(client, InstrumentedClient):
+        return client.measure(lambda wrapped: query_body(wrapped, body))
+
+    last_txn_time = client.get_last_txn_time()
+    headers = {"X-Last-Txn-Time": str(last_txn_time)} if last_txn_time is not None else {}
+    start_time = time.time()
+    response = client.session.post(client.base_url + "/", data=body.encode("utf-8"), auth=client.auth,
+                                   headers=headers)
+    end_time = time.time()
+
+    if "X-Txn-Time" in response.headers:
+        client.sync_last_txn_time(int(response.headers["X-Txn-Time"]))
+
+    response_raw = response.text
+    response_content = parse_json_or_none(response_raw)
+    request_result = RequestResult("POST", "", None, body, response_raw, response_content, response.status_code,
+                                   response.headers, start_time, end_time)
+    if client.observer is not None:
+        client.observer(request_result)
+    if response_content is None:
+        raise UnexpectedError("Invalid JSON.", request_result)
+    FaunaError.raise_for_status_code(request_result)
+    if "resource" not in response_content:
+        raise UnexpectedError('Response JSON does not contain expected key "resource"', request_result)
+    return response_content["resource"]
+
+
+def query_body_with_retry(client, body, stats, max_retries=8, base_backoff=0.01, max_backoff=1.0):
+    #
+    # Lesson4.query_with_retry for an encoded body.
+    #
+    attempt = 0
+    while True:
+        try:
+            return query_body(client, body)
+        except FaunaError as error:
+            if not is_contention_error(error):
+                raise
+            stats.add(conflicts=1)
+            if attempt >= max_retries:
+                raise
+            attempt += 1
+            stats.add(retries=1)
+            time.sleep(uniform(0, min(max_backoff, base_backoff * (2 ** attempt))))
+
+
+def apply_transfer_batch(client, batch, max_batch_size=500, encoder=None, stats=None):
+    #
+    # Apply the transfers of a TransferBatch, 'max_batch_size' per query. Returns what each
+    # transfer evaluated to, in order (INSUFFICIENT_FUNDS, ALREADY_APPLIED or the updated
+    # destination customer).
+    #
+    encoder = encoder or TransferEncoder()
+    stats = stats if stats is not None else TransferStats()
+    results = []
+    for start in range(0, len(batch), max_batch_size):
+        chunk = batch.slice(start, min(len(batch), start + max_batch_size))
+        res = query_body_with_retry(client, encoder.encode(chunk), stats)
+        insufficient = sum(1 for txn_res in res if txn_res == INSUFFICIENT_FUNDS)
+        stats.add(applied=len(res) - insufficient, insufficient=insufficient)
+        results.extend(res)
+    return results
+
+
+def create_customer_batch(client, batch, max_chunk_size=500):
+    #
+    # Create the customers of a CustomerBatch, 'max_chunk_size' per query. Returns their refs.
+    #
+    refs = []
+    for start in range(0, len(batch), max_chunk_size):
+        refs.extend(query_body(client, encode_customers(batch, start, min(len(batch), start + max_chunk_size))))
+    return refs
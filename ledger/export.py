@@ -0,0 +1,250 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Streaming export of the transactions ledger, e.g. for a nightly reconciliation:
+#
+#     python -m ledger.export --db-name LedgerExample --output ledger.ndjson \
+#         --start-ts 1546300800000000 --end-ts 1546387200000000 --partitions 4
+#
+# Transactions are read in commit order from the covering 'transactions_by_ts' index, one
+# bounded page at a time, and every page is written out before the next one is asked for,
+# so memory use does not depend on the size of the ledger. The window is given as document
+# timestamps (microseconds): start_ts <= ts < end_ts. The records of rejected transfers
+# (see Lesson4.transfer_expr) are left out on the server, only money that moved is exported.
+#
+# Two formats are written incrementally:
+#
+#   ndjson     one JSON object per transaction and line.
+#   columnar   one JSON line per page holding a column per field, with the timestamps as
+#              deltas from the first one, which is much smaller for large exports. Read it
+#              back with read_columnar.
+#
+# After every page the position in the index and the size of the output are saved to a
+# cursor file next to the output. An export that was interrupted is resumed from there
+# with --resume; anything written after the last saved cursor is cut off first, so no
+# transaction is exported twice or skipped.
+#
+# With --partitions K the window is split into K ranges of timestamps that are exported
+# at the same time, each to its own file (<output>.0, <output>.1, ...) with its own cursor.
+# The ranges are saved to <output>.manifest when the export starts and --resume uses them
+# again, so the partitions resume towards the bounds their cursors were saved for even
+# after new transactions have moved the end of the ledger.
+#
+
+import os
+import sys
+import json
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from faunadb import query as q
+from faunadb._json import parse_json, to_json
+
+from Lesson4 import REJECTED
+from ledger.client import create_database, create_db_client
+from ledger.metrics import tagged
+from ledger.schema import sync_ledger_schema
+
+INDEX_NAME = "transactions_by_ts"
+FIELDS = ["ts", "uuid", "sourceCust", "destCust", "amount", "ref"]
+STATUS = len(FIELDS)
+MAX_TS = 2 ** 62
+
+
+class NdjsonWriter(object):
+    def __init__(self, output):
+        self.output = output
+
+    def write_page(self, rows):
+        for row in rows:
+            self.output.write(json.dumps(row, separators=(",", ":")) + "\n")
+
+
+class ColumnarWriter(object):
+    def __init__(self, output):
+        self.output = output
+
+    def write_page(self, rows):
+        if not rows:
+            return
+        columns = dict((field, [row[field] for row in rows]) for field in FIELDS)
+        ts = columns.pop("ts")
+        columns["ts_delta"] = [t - ts[0] for t in ts]
+        block = {"rows": len(rows), "ts_base": ts[0], "columns": columns}
+        self.output.write(json.dumps(block, separators=(",", ":")) + "\n")
+
+
+WRITERS = {"ndjson": NdjsonWriter, "columnar": ColumnarWriter}
+
+
+def read_columnar(lines):
+    #
+    # The transactions of a columnar export, one dictionary at a time.
+    #
+    for line in lines:
+        block = json.loads(line)
+        columns = block["columns"]
+        for i in range(0, block["rows"]):
+            row = dict((field, columns[field][i]) for field in FIELDS if field != "ts")
+            row["ts"] = block["ts_base"] + columns["ts_delta"][i]
+            yield row
+
+
+def ts_bounds(client):
+    #
+    # The timestamps of the first and the last transaction, or None if there are none.
+    #
+    res = client.query([
+        q.paginate(q.match(q.index(INDEX_NAME)), size=1),
+        q.paginate(q.match(q.index(INDEX_NAME)), before=[MAX_TS], size=1)
+    ])
+    if not res[0]["data"]:
+        return None
+    return res[0]["data"][0][0], res[1]["data"][0][0]
+
+
+def save_cursor(path, cursor):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(to_json(cursor))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_cursor(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return parse_json(f.read())
+
+
+@tagged
+def export_range(client, path, start_ts=None, end_ts=None, fmt="ndjson", page_size=1024, resume=False):
+    #
+    # Export the transactions with start_ts <= ts < end_ts (either bound may be None) to the
+    # file 'path', saving the cursor to 'path.cursor' after every page. Returns the number
+    # of transactions in the file.
+    #
+    cursor_path = path + ".cursor"
+    state = load_cursor(cursor_path) if resume else None
+    if state is None:
+        state = {"after": [start_ts] if start_ts is not None else None, "offset": 0, "rows": 0,
+                 "done": False}
+    if state["done"]:
+        return state["rows"]
+
+    with open(path, "r+" if state["offset"] else "w") as output:
+        output.truncate(state["offset"])
+        output.seek(state["offset"])
+        writer = WRITERS[fmt](output)
+
+        while True:
+            page = q.paginate(q.match(q.index(INDEX_NAME)), after=state["after"], size=page_size)
+            page = q.filter_(lambda row: q.not_(q.equals(q.select(STATUS, row), REJECTED)), page)
+            if end_ts is not None:
+                page = q.filter_(lambda row: q.lt(q.select(0, row), end_ts), page)
+            res = client.query(page)
+
+            rows = [dict(zip(FIELDS, values)) for values in res["data"]]
+            for row in rows:
+                row["ref"] = row["ref"].id()
+            writer.write_page(rows)
+            output.flush()
+            os.fsync(output.fileno())
+
+            after = res.get("after")
+            state = {"after": after, "offset": output.tell(), "rows": state["rows"] + len(rows),
+                     "done": after is None or (end_ts is not None and after[0] >= end_ts)}
+            save_cursor(cursor_path, state)
+            if state["done"]:
+                return state["rows"]
+
+
+@tagged
+def export_transactions(client, path, start_ts=None, end_ts=None, fmt="ndjson", partitions=1, page_size=1024,
+                        resume=False):
+    #
+    # Export the window to 'path', or with several partitions to 'path.0' ... 'path.K-1',
+    # the partitions being exported at the same time. Returns the number of transactions.
+    #
+    # A partitioned export resumes with the ranges saved in 'path.manifest' by the run it
+    # continues and refuses to resume without them.
+    #
+    if partitions <= 1:
+        return export_range(client, path, start_ts, end_ts, fmt, page_size, resume)
+
+    manifest_path = path + ".manifest"
+    if resume:
+        manifest = load_cursor(manifest_path)
+        if manifest is None:
+            raise ValueError('Can not resume the export to {0}: {1} is missing, export again without '
+                             'resume'.format(path, manifest_path))
+        if manifest["partitions"] != partitions or manifest["format"] != fmt:
+            raise ValueError('Can not resume the export to {0} with {1} {2} partitions, it was started with '
+                             '{3} {4} partitions'.format(path, partitions, fmt, manifest["partitions"],
+                                                          manifest["format"]))
+        splits = manifest["splits"]
+    else:
+        bounds = ts_bounds(client)
+        if bounds is None:
+            return 0
+        lower = bounds[0] if start_ts is None else max(start_ts, bounds[0])
+        upper = bounds[1] + 1 if end_ts is None else min(end_ts, bounds[1] + 1)
+        if lower >= upper:
+            return 0
+        splits = [lower + (upper - lower) * i // partitions for i in range(0, partitions + 1)]
+        save_cursor(manifest_path, {"partitions": partitions, "format": fmt, "splits": splits})
+
+    with ThreadPoolExecutor(max_workers=partitions) as executor:
+        counts = executor.map(lambda i: export_range(client, "{0}.{1}".format(path, i), splits[i], splits[i + 1],
+                                                     fmt, page_size, resume),
+                              range(0, partitions))
+        return sum(counts)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="python -m ledger.export")
+    parser.add_argument("--scheme", default="http")
+    parser.add_argument("--domain", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8443)
+    parser.add_argument("--secret", default="secret")
+    parser.add_argument("--db-name", default="LedgerExample")
+    parser.add_argument("--db-secret", default=None,
+                        help="key secret printed by an earlier run, reused instead of creating a new key")
+    parser.add_argument("--output", required=True)
+    parser.add_argument("--format", choices=sorted(WRITERS), default="ndjson")
+    parser.add_argument("--start-ts", type=int, default=None, help="first timestamp (microseconds) to export")
+    parser.add_argument("--end-ts", type=int, default=None, help="timestamp (microseconds) to stop before")
+    parser.add_argument("--partitions", type=int, default=1)
+    parser.add_argument("--page-size", type=int, default=1024)
+    parser.add_argument("--resume", action="store_true", help="continue from the saved cursors")
+    args = parser.parse_args(argv[1:])
+
+    db_secret = create_database(args.scheme, args.domain, args.port, args.secret, args.db_name, recreate=False,
+                                db_secret=args.db_secret)
+    client = create_db_client(args.scheme, args.domain, args.port, db_secret)
+    sync_ledger_schema(client)
+
+    count = export_transactions(client, args.output, args.start_ts, args.end_ts, args.format, args.partitions,
+                                args.page_size, args.resume)
+    print('Exported {0} transactions to {1}'.format(count, args.output))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
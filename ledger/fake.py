@@ -0,0 +1,1368 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# An in-process stand-in for a FaunaDB server. It evaluates the subset of FQL used by the
+# lessons and the ledger package so the examples can be run, benchmarked and regression
+# tested without a live database.
+#
+# The stand-in plugs in underneath the real driver: it is mounted on the requests session of
+# a FaunaClient as a transport adapter (or served over HTTP with 'serve'), so the driver
+# still encodes every query and decodes every response exactly as it would against FaunaDB.
+#
+# Every request is evaluated in three steps. The query is evaluated against the current
+# state while holding the store lock, recording the version of every document it read and
+# buffering every document it writes and every class, index, function, database and key it
+# creates or deletes. The lock is then released while the injected latency elapses.
+# Finally the lock is taken again and, if any document that was read or written or any
+# schema entry that was changed has been committed by another request in the meantime, the
+# request fails with the same 409 "contended transaction" error FaunaDB returns; otherwise
+# the writes are applied. A request that fails leaves nothing behind, schema included.
+#
+# Any lesson can be run against the stand-in with, for example:
+#
+#     python -m ledger.fake Lesson4 --latency-ms 2
+#
+
+import sys
+import json
+import time
+import argparse
+import importlib
+import base64
+import random
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from requests.adapters import BaseAdapter
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+
+from faunadb._json import parse_json, to_json
+from faunadb.objects import Ref, Native, Query, FaunaTime, SetRef
+from ledger.client import close_clients, set_transport
+
+DEFAULT_PAGE_SIZE = 64
+
+
+class FakeFaunaError(Exception):
+    #
+    # Raised while evaluating a query, carries the HTTP status and the FaunaDB error code.
+    #
+    def __init__(self, status, code, description):
+        super(FakeFaunaError, self).__init__(description)
+        self.status = status
+        self.code = code
+        self.description = description
+
+
+def _bad_request(description, code="invalid argument"):
+    return FakeFaunaError(400, code, description)
+
+
+def _not_found(description, code="instance not found"):
+    return FakeFaunaError(404, code, description)
+
+
+def _ref_key(ref):
+    #
+    # Hashable (class name, id) identity of a document Ref.
+    #
+    cls = ref.collection()
+    return (cls.id() if cls is not None else None, ref.id())
+
+
+def _sort_key(value):
+    #
+    # Total order over FQL values used for index entries and cursors. Values of different
+    # types are ordered by type first, like FaunaDB does.
+    #
+    if value is None:
+        return (0,)
+    if isinstance(value, bool):
+        return (1, value)
+    if isinstance(value, (int, float)):
+        return (2, value)
+    if isinstance(value, str):
+        return (3, value)
+    if isinstance(value, Ref):
+        cls, ref_id = _ref_key(value)
+        return (4, cls or "", int(ref_id) if ref_id.isdigit() else 0, ref_id)
+    if isinstance(value, (list, tuple)):
+        return (5, tuple(_sort_key(v) for v in value))
+    if isinstance(value, FaunaTime):
+        return (6, value.value)
+    return (7, repr(value))
+
+
+class _Reversed(object):
+    #
+    # Wraps a sort key to order it backwards, for index values declared with "reverse".
+    #
+    __slots__ = ("key",)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+    def __le__(self, other):
+        return other.key <= self.key
+
+    def __gt__(self, other):
+        return other.key > self.key
+
+    def __ge__(self, other):
+        return other.key >= self.key
+
+
+def _freeze(value):
+    if isinstance(value, Ref):
+        return ("@ref",) + _ref_key(value)
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    return value
+
+
+def _path_get(doc, path):
+    value = doc
+    for part in path:
+        if isinstance(value, dict) and part in value:
+            value = value[part]
+        elif isinstance(value, list) and isinstance(part, int) and 0 <= part < len(value):
+            value = value[part]
+        else:
+            return None
+    return value
+
+
+def _copy(value):
+    if isinstance(value, dict):
+        return {k: _copy(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_copy(v) for v in value]
+    return value
+
+
+def _merge(target, params):
+    #
+    # Update semantics: objects are merged recursively and a null value removes the field.
+    #
+    result = dict(target)
+    for key, value in params.items():
+        if value is None:
+            result.pop(key, None)
+        elif isinstance(value, dict) and isinstance(result.get(key), dict):
+            result[key] = _merge(result[key], value)
+        else:
+            result[key] = _copy(value)
+    return result
+
+
+class _Lambda(object):
+    def __init__(self, params, expr):
+        self.params = params
+        self.expr = expr
+
+
+class _Index(object):
+    #
+    # An index is kept as term -> {document key: entry}, with a lazily rebuilt sorted list
+    # per term. Each entry is (sort key, returned value, cursor).
+    #
+    def __init__(self, name, source, terms, values, unique, ts):
+        self.name = name
+        self.source = source
+        self.terms = [t["field"] if isinstance(t["field"], list) else [t["field"]] for t in terms]
+        self.values = [v["field"] if isinstance(v["field"], list) else [v["field"]] for v in values]
+        self.reverse = [bool(v.get("reverse")) for v in values]
+        self.unique = unique
+        self.ts = ts
+        self.entries = {}
+        self.sorted = {}
+        self.unique_keys = {}
+
+    def term_key(self, doc):
+        terms = tuple(_path_get(doc, path) for path in self.terms)
+        if self.terms and any(t is None for t in terms):
+            return None
+        return _freeze(terms)
+
+    def entry(self, doc):
+        if self.values:
+            values = [_path_get(doc, path) for path in self.values]
+        else:
+            values = [doc["ref"]]
+        cursor = list(values)
+        if not any(path == ["ref"] for path in self.values):
+            cursor.append(doc["ref"])
+        value = values[0] if len(values) == 1 else values
+        return (self.cursor_key(cursor), value, cursor)
+
+    def cursor_key(self, cursor):
+        if not any(self.reverse):
+            return _sort_key(cursor)
+        return (5, tuple(_Reversed(_sort_key(v)) if i < len(self.reverse) and self.reverse[i] else _sort_key(v)
+                         for i, v in enumerate(cursor)))
+
+    def unique_key(self, doc):
+        term = self.term_key(doc)
+        if term is None:
+            return None
+        return (term, _freeze(self.entry(doc)[1]))
+
+    def add(self, doc):
+        term = self.term_key(doc)
+        if term is None:
+            return
+        self.entries.setdefault(term, {})[_ref_key(doc["ref"])] = self.entry(doc)
+        self.sorted.pop(term, None)
+        if self.unique:
+            self.unique_keys[self.unique_key(doc)] = _ref_key(doc["ref"])
+
+    def remove(self, doc):
+        term = self.term_key(doc)
+        if term is None:
+            return
+        self.entries.get(term, {}).pop(_ref_key(doc["ref"]), None)
+        self.sorted.pop(term, None)
+        if self.unique:
+            self.unique_keys.pop(self.unique_key(doc), None)
+
+    def lookup(self, term):
+        if term not in self.sorted:
+            self.sorted[term] = sorted(self.entries.get(term, {}).values(), key=lambda e: e[0])
+        return self.sorted[term]
+
+    def term_from_match(self, terms):
+        if terms is None:
+            return ()
+        if len(self.terms) == 1 or not isinstance(terms, list):
+            return _freeze((terms,))
+        return _freeze(tuple(terms))
+
+    def to_doc(self):
+        doc = {"ref": Ref(self.name, Native.INDEXES), "ts": self.ts, "active": True,
+               "partitions": 1, "name": self.name, "source": Ref(self.source, Native.COLLECTIONS),
+               "unique": self.unique}
+        if self.terms:
+            doc["terms"] = [{"field": path} for path in self.terms]
+        if self.values:
+            doc["values"] = [dict({"field": path}, **({"reverse": True} if reverse else {}))
+                             for path, reverse in zip(self.values, self.reverse)]
+        return doc
+
+
+class _Database(object):
+    def __init__(self, name, ts):
+        self.name = name
+        self.ts = ts
+        self.classes = {}
+        self.indexes = {}
+        self.functions = {}
+        self.documents = {}
+        self.versions = {}
+        self.next_id = 1000000
+
+
+class _Set(object):
+    #
+    # Lazily evaluated set of index entries. 'key' maps a cursor to the sort key of the
+    # entries, for pagination.
+    #
+    def __init__(self, entries, description, key=_sort_key):
+        self.entries = entries
+        self.description = description
+        self.key = key
+
+
+class _Txn(object):
+    #
+    # The reads and the buffered writes of one request. Schema changes are buffered in
+    # 'schema', which maps (kind, name) to the new definition or to None for a deletion, for
+    # the 'classes', 'indexes' and 'functions' of the database and the 'databases' and 'keys'
+    # of the stand-in. 'schema_base' keeps the definition each of them replaced.
+    #
+    def __init__(self, fauna, db, ts):
+        self.fauna = fauna
+        self.db = db
+        self.ts = ts
+        self.reads = {}
+        self.writes = {}
+        self.schema = {}
+        self.schema_base = {}
+
+    def read(self, key):
+        if key in self.writes:
+            return self.writes[key]
+        self.reads.setdefault(key, self.db.versions.get(key, 0))
+        return self.db.documents.get(key)
+
+    def write(self, key, doc):
+        self.reads.setdefault(key, self.db.versions.get(key, 0))
+        self.writes[key] = doc
+
+    def committed(self, kind):
+        if kind == "databases":
+            return self.fauna.databases
+        if kind == "keys":
+            return self.fauna.keys
+        return getattr(self.db, kind)
+
+    def schema_get(self, kind, name):
+        if (kind, name) in self.schema:
+            return self.schema[(kind, name)]
+        return self.committed(kind).get(name)
+
+    def schema_names(self, kind):
+        names = set(self.committed(kind))
+        for (change_kind, name), value in self.schema.items():
+            if change_kind != kind:
+                continue
+            if value is None:
+                names.discard(name)
+            else:
+                names.add(name)
+        return sorted(names)
+
+    def schema_write(self, kind, name, value):
+        self.schema_base.setdefault((kind, name), self.committed(kind).get(name))
+        self.schema[(kind, name)] = value
+
+
+class FakeFauna(object):
+    #
+    # 'latency' is either a number of seconds or a callable returning one, and is applied to
+    # every request. 'conflict_rate' is the probability that a request that writes fails with
+    # an injected 409 on top of the real read/write conflicts detected between requests.
+    #
+    def __init__(self, admin_secret="secret", latency=0.0, conflict_rate=0.0, seed=None):
+        self.admin_secret = admin_secret
+        self.latency = latency
+        self.conflict_rate = conflict_rate
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.root = _Database(None, 0)
+        self.databases = {}
+        self.keys = {}
+        self.clock = int(time.time() * 1000000)
+        self.stats = {"requests": 0, "bytes_in": 0, "bytes_out": 0, "conflicts": 0, "errors": 0}
+
+    #
+    # Transport entry points.
+    #
+    def execute(self, secret, body):
+        #
+        # Evaluate one request body and return (status, headers, response body).
+        #
+        if isinstance(body, bytes):
+            body = body.decode("utf-8")
+        with self.lock:
+            self.stats["requests"] += 1
+            self.stats["bytes_in"] += len(body or "")
+
+        status, headers, content = self._execute(secret, body)
+
+        with self.lock:
+            self.stats["bytes_out"] += len(content)
+            if status == 409:
+                self.stats["conflicts"] += 1
+            elif status >= 400:
+                self.stats["errors"] += 1
+        return status, headers, content
+
+    def _execute(self, secret, body):
+        if secret == self.admin_secret:
+            db = self.root
+        elif secret in self.keys:
+            db = self.databases.get(self.keys[secret])
+            if db is None:
+                return self._error(401, "unauthorized", "Unauthorized")
+        else:
+            return self._error(401, "unauthorized", "Unauthorized")
+
+        try:
+            expr = parse_json(body) if body else None
+        except ValueError:
+            return self._error(400, "invalid expression", "Request body is not valid JSON.")
+
+        with self.lock:
+            self.clock += 1
+            txn = _Txn(self, db, self.clock)
+            try:
+                result = self.eval(txn, expr, {})
+            except FakeFaunaError as error:
+                return self._error(error.status, error.code, error.description)
+
+        delay = self.latency() if callable(self.latency) else self.latency
+        if delay:
+            time.sleep(delay)
+
+        with self.lock:
+            if txn.writes and self.conflict_rate and self.random.random() < self.conflict_rate:
+                return self._error(409, "contended transaction", "Transaction was aborted due to detection of concurrent modification.")
+            # A read-only query has read one consistent snapshot, like FaunaDB serves it.
+            for key, version in (txn.reads.items() if txn.writes else ()):
+                if db.versions.get(key, 0) != version:
+                    return self._error(409, "contended transaction", "Transaction was aborted due to detection of concurrent modification.")
+            try:
+                self._commit(txn)
+            except FakeFaunaError as error:
+                return self._error(error.status, error.code, error.description)
+
+        content = to_json({"resource": _finalize(result)})
+        return 200, {"Content-Type": "application/json;charset=utf-8", "X-Txn-Time": str(txn.ts)}, content
+
+    def _error(self, status, code, description):
+        content = json.dumps({"errors": [{"position": [], "code": code, "description": description}]})
+        return status, {"Content-Type": "application/json;charset=utf-8"}, content
+
+    def adapter(self):
+        return FakeFaunaAdapter(self)
+
+    def mount(self, client):
+        #
+        # Route every request of a FaunaClient to this stand-in.
+        #
+        client.session.mount(client.base_url, self.adapter())
+        return client
+
+    def install(self, scheme="http", domain="127.0.0.1", port=8443):
+        #
+        # Make every client that ledger.client builds for this endpoint talk to the stand-in,
+        # so code that creates its own clients (the lessons' main functions) runs unchanged.
+        #
+        close_clients()
+        set_transport(scheme, domain, port, self.adapter())
+        return self
+
+    def serve(self, host="127.0.0.1", port=0):
+        #
+        # Serve the stand-in over HTTP in a background thread so other processes can use it.
+        # Returns the server, whose 'server_address' gives the bound port.
+        #
+        fauna = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length)
+                status, headers, content = fauna.execute(_secret_from_header(self.headers.get("Authorization")), body)
+                data = content.encode("utf-8")
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                data = b'{"resource":"Scope write is OK"}'
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        return server
+
+    #
+    # Commit.
+    #
+    def _commit(self, txn):
+        db = txn.db
+        for change, base in txn.schema_base.items():
+            if txn.committed(change[0]).get(change[1]) is not base:
+                raise FakeFaunaError(409, "contended transaction",
+                                     "Transaction was aborted due to detection of concurrent modification.")
+
+        for name, index in db.indexes.items():
+            if not index.unique:
+                continue
+            seen = {}
+            for key, doc in txn.writes.items():
+                if doc is None or key[0] != index.source:
+                    continue
+                unique_key = index.unique_key(doc)
+                if unique_key is None:
+                    continue
+                owner = index.unique_keys.get(unique_key)
+                if owner is not None and owner != key:
+                    old = txn.writes.get(owner, db.documents.get(owner))
+                    if old is not None and index.unique_key(old) == unique_key:
+                        raise _bad_request("document is not unique.", "instance not unique")
+                if seen.setdefault(unique_key, key) != key:
+                    raise _bad_request("document is not unique.", "instance not unique")
+
+        for (kind, name), value in txn.schema.items():
+            self._commit_schema(txn, kind, name, value)
+
+        for key, doc in txn.writes.items():
+            old = db.documents.get(key)
+            for index in db.indexes.values():
+                if index.source != key[0]:
+                    continue
+                if old is not None:
+                    index.remove(old)
+                if doc is not None:
+                    index.add(doc)
+            if doc is None:
+                db.documents.pop(key, None)
+            else:
+                db.documents[key] = doc
+            db.versions[key] = txn.ts
+
+    def _commit_schema(self, txn, kind, name, value):
+        db = txn.db
+        base = txn.schema_base[(kind, name)]
+        if value is base:
+            return
+        if kind == "classes" and base is not None:
+            # Dropping a class drops its documents.
+            for key in [k for k in db.documents if k[0] == name]:
+                doc = db.documents.pop(key)
+                for index in db.indexes.values():
+                    if index.source == name:
+                        index.remove(doc)
+                db.versions[key] = txn.ts
+        if kind == "indexes" and value is not None:
+            for key, doc in db.documents.items():
+                if key[0] == value.source:
+                    value.add(doc)
+        committed = txn.committed(kind)
+        if value is None:
+            committed.pop(name, None)
+        else:
+            committed[name] = value
+
+    #
+    # Evaluation.
+    #
+    def eval(self, txn, expr, env):
+        if isinstance(expr, list):
+            return [self.eval(txn, e, env) for e in expr]
+        if not isinstance(expr, dict):
+            return expr
+        for key in expr:
+            handler = _FORMS.get(key)
+            if handler is not None:
+                return handler(self, txn, expr, env)
+        raise _bad_request("No form/function found, or invalid argument keys: {0}.".format(sorted(expr)),
+                           "invalid expression")
+
+    def apply(self, txn, fn, args, env):
+        if not isinstance(fn, _Lambda):
+            raise _bad_request("Lambda expected.")
+        scope = dict(env)
+        if isinstance(fn.params, list):
+            if not isinstance(args, list) or len(args) != len(fn.params):
+                raise _bad_request("Lambda expects an array with {0} elements.".format(len(fn.params)))
+            scope.update(zip(fn.params, args))
+        else:
+            scope[fn.params] = args
+        return self.eval(txn, fn.expr, scope)
+
+    def new_id(self, db):
+        db.next_id += 1
+        return str(db.next_id)
+
+    def set_entries(self, txn, value):
+        if isinstance(value, _Set):
+            return value.entries()
+        raise _bad_request("Set expected.")
+
+    def get_doc(self, txn, ref):
+        db = txn.db
+        if isinstance(ref, _Set):
+            entries = ref.entries()
+            if not entries:
+                raise _not_found("Set not found.")
+            ref = entries[0][1]
+            if isinstance(ref, list):
+                ref = ref[-1]
+        if not isinstance(ref, Ref):
+            raise _bad_request("Ref or Set expected.")
+        cls = ref.collection()
+        if cls is None or cls == Native.COLLECTIONS:
+            return self._schema_doc(txn, ref)
+        if cls == Native.INDEXES:
+            index = txn.schema_get("indexes", ref.id())
+            if index is None:
+                raise _not_found("Index not found.")
+            return index.to_doc()
+        if cls == Native.FUNCTIONS:
+            fn = txn.schema_get("functions", ref.id())
+            if fn is None:
+                raise _not_found("Function not found.")
+            return fn
+        if cls == Native.DATABASES:
+            target = txn.schema_get("databases", ref.id()) if db is self.root else None
+            if target is None:
+                raise _not_found("Database not found.")
+            return {"ref": ref, "ts": target.ts, "name": target.name}
+        doc = txn.read(_ref_key(ref))
+        if doc is None:
+            raise _not_found("Document not found.")
+        return doc
+
+    def _schema_doc(self, txn, ref):
+        cls = txn.schema_get("classes", ref.id())
+        if cls is None:
+            raise _not_found("Class not found.")
+        return cls
+
+    def exists(self, txn, ref):
+        try:
+            self.get_doc(txn, ref)
+            return True
+        except FakeFaunaError as error:
+            if error.status == 404:
+                return False
+            raise
+
+
+def _finalize(value):
+    #
+    # Convert evaluation-only values into something the driver can decode.
+    #
+    if isinstance(value, _Set):
+        return SetRef(value.description)
+    if isinstance(value, _Lambda):
+        return Query({"lambda": value.params, "expr": value.expr})
+    if isinstance(value, dict):
+        return {k: _finalize(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_finalize(v) for v in value]
+    return value
+
+
+def _secret_from_header(header):
+    if not header or not header.startswith("Basic "):
+        return None
+    decoded = base64.b64decode(header[6:]).decode("utf-8")
+    return decoded.split(":", 1)[0]
+
+
+class FakeFaunaAdapter(BaseAdapter):
+    #
+    # A requests transport adapter that answers FaunaClient requests from a FakeFauna.
+    #
+    def __init__(self, fauna):
+        super(FakeFaunaAdapter, self).__init__()
+        self.fauna = fauna
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        secret = _secret_from_header(request.headers.get("Authorization"))
+        if request.method == "GET":
+            status, headers, content = 200, {}, '{"resource":"Scope write is OK"}'
+        else:
+            status, headers, content = self.fauna.execute(secret, request.body)
+
+        response = Response()
+        response.status_code = status
+        response.headers = CaseInsensitiveDict(headers)
+        response._content = content.encode("utf-8")
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        response.reason = "OK" if status == 200 else "Error"
+        return response
+
+    def close(self):
+        pass
+
+
+#
+# FQL forms. Each handler receives the fake, the transaction, the raw expression and the
+# variable environment.
+#
+
+def _arg(fauna, txn, expr, key, env):
+    return fauna.eval(txn, expr.get(key), env)
+
+
+def _varargs(value):
+    return value if isinstance(value, list) else [value]
+
+
+def _form_object(fauna, txn, expr, env):
+    return {k: fauna.eval(txn, v, env) for k, v in expr["object"].items()}
+
+
+def _form_let(fauna, txn, expr, env):
+    scope = dict(env)
+    bindings = expr["let"]
+    if isinstance(bindings, dict):
+        bindings = [{k: v} for k, v in bindings.items()]
+    for binding in bindings:
+        for name, value in binding.items():
+            scope[name] = fauna.eval(txn, value, scope)
+    return fauna.eval(txn, expr["in"], scope)
+
+
+def _form_var(fauna, txn, expr, env):
+    name = expr["var"]
+    if name not in env:
+        raise _bad_request("Variable '{0}' is not defined.".format(name), "unbound variable")
+    return env[name]
+
+
+def _form_if(fauna, txn, expr, env):
+    condition = _arg(fauna, txn, expr, "if", env)
+    if not isinstance(condition, bool):
+        raise _bad_request("Boolean expected.")
+    return fauna.eval(txn, expr["then"] if condition else expr["else"], env)
+
+
+def _form_do(fauna, txn, expr, env):
+    result = None
+    for e in _varargs(expr["do"]):
+        result = fauna.eval(txn, e, env)
+    return result
+
+
+def _form_lambda(fauna, txn, expr, env):
+    return _Lambda(expr["lambda"], expr["expr"])
+
+
+def _form_query(fauna, txn, expr, env):
+    fn = expr["query"]
+    if isinstance(fn, Query):
+        return fn
+    return Query(fn)
+
+
+def _form_call(fauna, txn, expr, env):
+    ref = _arg(fauna, txn, expr, "call", env)
+    fn = fauna.get_doc(txn, ref)
+    body = fn["body"].value
+    args = fauna.eval(txn, expr.get("arguments"), env)
+    return fauna.apply(txn, _Lambda(body["lambda"], body["expr"]), args, {})
+
+
+def _collection_items(value):
+    if isinstance(value, dict) and "data" in value:
+        return value["data"], value
+    if isinstance(value, list):
+        return value, None
+    raise _bad_request("Array or Page expected.")
+
+
+def _with_page(items, page):
+    if page is None:
+        return items
+    result = dict(page)
+    result["data"] = items
+    return result
+
+
+def _form_map(fauna, txn, expr, env):
+    fn = _arg(fauna, txn, expr, "map", env)
+    items, page = _collection_items(_arg(fauna, txn, expr, "collection", env))
+    return _with_page([fauna.apply(txn, fn, item, env) for item in items], page)
+
+
+def _form_foreach(fauna, txn, expr, env):
+    fn = _arg(fauna, txn, expr, "foreach", env)
+    collection = _arg(fauna, txn, expr, "collection", env)
+    items, page = _collection_items(collection)
+    for item in items:
+        fauna.apply(txn, fn, item, env)
+    return collection
+
+
+def _form_filter(fauna, txn, expr, env):
+    fn = _arg(fauna, txn, expr, "filter", env)
+    items, page = _collection_items(_arg(fauna, txn, expr, "collection", env))
+    kept = []
+    for item in items:
+        keep = fauna.apply(txn, fn, item, env)
+        if not isinstance(keep, bool):
+            raise _bad_request("Boolean expected.")
+        if keep:
+            kept.append(item)
+    return _with_page(kept, page)
+
+
+def _form_take(fauna, txn, expr, env):
+    number = _arg(fauna, txn, expr, "take", env)
+    items, page = _collection_items(_arg(fauna, txn, expr, "collection", env))
+    return _with_page(items[:number], page)
+
+
+def _form_drop(fauna, txn, expr, env):
+    number = _arg(fauna, txn, expr, "drop", env)
+    items, page = _collection_items(_arg(fauna, txn, expr, "collection", env))
+    return _with_page(items[number:], page)
+
+
+def _form_append(fauna, txn, expr, env):
+    elements = _arg(fauna, txn, expr, "append", env)
+    collection = _arg(fauna, txn, expr, "collection", env)
+    return collection + elements
+
+
+def _form_prepend(fauna, txn, expr, env):
+    elements = _arg(fauna, txn, expr, "prepend", env)
+    collection = _arg(fauna, txn, expr, "collection", env)
+    return elements + collection
+
+
+def _select(path, value, has_default, default):
+    for part in _varargs(path):
+        if isinstance(value, dict) and part in value:
+            value = value[part]
+        elif isinstance(value, list) and isinstance(part, int) and 0 <= part < len(value):
+            value = value[part]
+        elif isinstance(value, Ref) and part in ("id", "collection", "class"):
+            value = value.id() if part == "id" else value.collection()
+        else:
+            if has_default:
+                return default
+            raise _not_found("Value not found at path {0}.".format(path), "value not found")
+    return value
+
+
+def _form_select(fauna, txn, expr, env):
+    path = _arg(fauna, txn, expr, "select", env)
+    value = _arg(fauna, txn, expr, "from", env)
+    has_default = "default" in expr
+    default = _arg(fauna, txn, expr, "default", env) if has_default else None
+    return _select(path, value, has_default, default)
+
+
+def _form_contains(fauna, txn, expr, env):
+    path = _arg(fauna, txn, expr, "contains", env)
+    value = _arg(fauna, txn, expr, "in", env)
+    try:
+        _select(path, value, False, None)
+        return True
+    except FakeFaunaError:
+        return False
+
+
+def _index_for(fauna, txn, value):
+    if not isinstance(value, Ref) or value.collection() != Native.INDEXES:
+        raise _bad_request("Index ref expected.")
+    index = txn.schema_get("indexes", value.id())
+    if index is None:
+        raise _not_found("Index not found.", "invalid ref")
+    return index
+
+
+def _form_match(fauna, txn, expr, env):
+    index = _index_for(fauna, txn, _arg(fauna, txn, expr, "match", env))
+    term = index.term_from_match(_arg(fauna, txn, expr, "terms", env) if "terms" in expr else None)
+    return _Set(lambda: index.lookup(term), {"match": index.name}, index.cursor_key)
+
+
+def _form_union(fauna, txn, expr, env):
+    sets = _varargs(_arg(fauna, txn, expr, "union", env))
+
+    def entries():
+        merged = {}
+        for s in sets:
+            for entry in fauna.set_entries(txn, s):
+                merged.setdefault(_freeze(entry[2]), entry)
+        return sorted(merged.values(), key=lambda e: e[0])
+
+    return _Set(entries, {"union": len(sets)})
+
+
+def _form_intersection(fauna, txn, expr, env):
+    sets = _varargs(_arg(fauna, txn, expr, "intersection", env))
+
+    def entries():
+        result = None
+        for s in sets:
+            current = {_freeze(e[2]): e for e in fauna.set_entries(txn, s)}
+            result = current if result is None else {k: v for k, v in result.items() if k in current}
+        return sorted((result or {}).values(), key=lambda e: e[0])
+
+    return _Set(entries, {"intersection": len(sets)})
+
+
+def _form_distinct(fauna, txn, expr, env):
+    source = _arg(fauna, txn, expr, "distinct", env)
+
+    def entries():
+        seen = set()
+        result = []
+        for entry in fauna.set_entries(txn, source):
+            key = _freeze(entry[1])
+            if key not in seen:
+                seen.add(key)
+                result.append(entry)
+        return result
+
+    return _Set(entries, {"distinct": True})
+
+
+def _form_range(fauna, txn, expr, env):
+    source = _arg(fauna, txn, expr, "range", env)
+    lower = _sort_key(_varargs(_arg(fauna, txn, expr, "from", env)))
+    upper = _sort_key(_varargs(_arg(fauna, txn, expr, "to", env)))
+
+    def entries():
+        result = []
+        for entry in fauna.set_entries(txn, source):
+            key = _sort_key(entry[2][:len(upper[1])])
+            low_key = _sort_key(entry[2][:len(lower[1])])
+            if low_key >= lower and key <= upper:
+                result.append(entry)
+        return result
+
+    return _Set(entries, {"range": True})
+
+
+def _schema_set(kind):
+    def form(fauna, txn, expr, env):
+        def entries():
+            if kind == "classes":
+                names, native = txn.schema_names("classes"), Native.COLLECTIONS
+            elif kind == "indexes":
+                names, native = txn.schema_names("indexes"), Native.INDEXES
+            elif kind == "functions":
+                names, native = txn.schema_names("functions"), Native.FUNCTIONS
+            else:
+                names, native = txn.schema_names("databases") if txn.db is fauna.root else [], Native.DATABASES
+            result = []
+            for name in names:
+                ref = Ref(name, native)
+                result.append((_sort_key([ref]), ref, [ref]))
+            return result
+
+        return _Set(entries, {kind: None})
+    return form
+
+
+def _form_paginate(fauna, txn, expr, env):
+    source = _arg(fauna, txn, expr, "paginate", env)
+    size = _arg(fauna, txn, expr, "size", env) if "size" in expr else DEFAULT_PAGE_SIZE
+    after = _arg(fauna, txn, expr, "after", env) if "after" in expr else None
+    before = _arg(fauna, txn, expr, "before", env) if "before" in expr else None
+    if isinstance(source, Ref):
+        doc = fauna.get_doc(txn, source)
+        return {"data": [doc["ref"]]}
+    entries = fauna.set_entries(txn, source)
+    keys = [e[0] for e in entries]
+
+    if before is not None and after is None:
+        end = bisect_left(keys, source.key(_varargs(before)))
+        start = max(0, end - size)
+    else:
+        start = bisect_left(keys, source.key(_varargs(after))) if after is not None else 0
+        end = min(len(entries), start + size)
+        if before is not None:
+            end = min(end, bisect_left(keys, source.key(_varargs(before))))
+
+    page = {"data": [_copy(e[1]) for e in entries[start:end]]}
+    if start > 0:
+        page["before"] = list(entries[start][2]) if start < len(entries) else list(_varargs(before))
+    if end < len(entries):
+        page["after"] = list(entries[end][2])
+    return page
+
+
+def _form_get(fauna, txn, expr, env):
+    return fauna.get_doc(txn, _arg(fauna, txn, expr, "get", env))
+
+
+def _form_exists(fauna, txn, expr, env):
+    return fauna.exists(txn, _arg(fauna, txn, expr, "exists", env))
+
+
+def _class_name(value):
+    if isinstance(value, Ref) and value.collection() in (None, Native.COLLECTIONS):
+        return value.id()
+    raise _bad_request("Class ref expected.")
+
+
+def _form_create(fauna, txn, expr, env):
+    target = _arg(fauna, txn, expr, "create", env)
+    params = _arg(fauna, txn, expr, "params", env) or {}
+    if isinstance(target, Ref) and target.collection() == Native.INDEXES:
+        return _create_index(fauna, txn, params)
+    cls = _class_name(target)
+    if txn.schema_get("classes", cls) is None:
+        raise _bad_request("Class '{0}' does not exist.".format(cls), "invalid ref")
+    ref_id = str(params["id"]) if "id" in params else fauna.new_id(txn.db)
+    ref = Ref(ref_id, Ref(cls, Native.COLLECTIONS))
+    key = _ref_key(ref)
+    if txn.read(key) is not None:
+        raise _bad_request("Document already exists.", "instance already exists")
+    doc = {"ref": ref, "ts": txn.ts, "data": _copy(params.get("data") or {})}
+    txn.write(key, doc)
+    return doc
+
+
+def _form_update(fauna, txn, expr, env):
+    ref = _arg(fauna, txn, expr, "update", env)
+    params = _arg(fauna, txn, expr, "params", env) or {}
+    if not isinstance(ref, Ref):
+        raise _bad_request("Ref expected.")
+    old = fauna.get_doc(txn, ref)
+    doc = {"ref": old["ref"], "ts": txn.ts, "data": _merge(old.get("data") or {}, params.get("data") or {})}
+    txn.write(_ref_key(ref), doc)
+    return doc
+
+
+def _form_replace(fauna, txn, expr, env):
+    ref = _arg(fauna, txn, expr, "replace", env)
+    params = _arg(fauna, txn, expr, "params", env) or {}
+    old = fauna.get_doc(txn, ref)
+    doc = {"ref": old["ref"], "ts": txn.ts, "data": _copy(params.get("data") or {})}
+    txn.write(_ref_key(ref), doc)
+    return doc
+
+
+def _form_delete(fauna, txn, expr, env):
+    ref = _arg(fauna, txn, expr, "delete", env)
+    db = txn.db
+    if not isinstance(ref, Ref):
+        raise _bad_request("Ref expected.")
+    cls = ref.collection()
+    if cls == Native.DATABASES:
+        target = txn.schema_get("databases", ref.id()) if db is fauna.root else None
+        if target is None:
+            raise _not_found("Database not found.")
+        txn.schema_write("databases", ref.id(), None)
+        for secret in txn.schema_names("keys"):
+            if txn.schema_get("keys", secret) == ref.id():
+                txn.schema_write("keys", secret, None)
+        return {"ref": ref, "ts": target.ts, "name": target.name}
+    if cls == Native.INDEXES:
+        index = txn.schema_get("indexes", ref.id())
+        if index is None:
+            raise _not_found("Index not found.")
+        txn.schema_write("indexes", ref.id(), None)
+        return index.to_doc()
+    if cls == Native.FUNCTIONS:
+        fn = txn.schema_get("functions", ref.id())
+        if fn is None:
+            raise _not_found("Function not found.")
+        txn.schema_write("functions", ref.id(), None)
+        return fn
+    if cls is None or cls == Native.COLLECTIONS:
+        doc = txn.schema_get("classes", ref.id())
+        if doc is None:
+            raise _not_found("Class not found.")
+        txn.schema_write("classes", ref.id(), None)
+        return doc
+    doc = fauna.get_doc(txn, ref)
+    txn.write(_ref_key(ref), None)
+    return doc
+
+
+def _form_create_class(fauna, txn, expr, env):
+    params = fauna.eval(txn, expr.get("create_class", expr.get("create_collection")), env)
+    name = params["name"]
+    if txn.schema_get("classes", name) is not None:
+        raise _bad_request("Class already exists.", "instance already exists")
+    doc = {"ref": Ref(name, Native.COLLECTIONS), "ts": txn.ts, "history_days": 30, "name": name}
+    txn.schema_write("classes", name, doc)
+    return doc
+
+
+def _create_index(fauna, txn, params):
+    name = params["name"]
+    if txn.schema_get("indexes", name) is not None:
+        raise _bad_request("Index already exists.", "instance already exists")
+    source = _class_name(params["source"])
+    terms = params.get("terms") or []
+    values = params.get("values") or []
+    if isinstance(terms, dict):
+        terms = [terms]
+    if isinstance(values, dict):
+        values = [values]
+    # The index is built from the documents of its class when the request commits.
+    index = _Index(name, source, terms, values, bool(params.get("unique")), txn.ts)
+    txn.schema_write("indexes", name, index)
+    return index.to_doc()
+
+
+def _form_create_index(fauna, txn, expr, env):
+    return _create_index(fauna, txn, _arg(fauna, txn, expr, "create_index", env))
+
+
+def _form_create_function(fauna, txn, expr, env):
+    params = _arg(fauna, txn, expr, "create_function", env)
+    name = params["name"]
+    if txn.schema_get("functions", name) is not None:
+        raise _bad_request("Function already exists.", "instance already exists")
+    body = params["body"]
+    if not isinstance(body, Query):
+        raise _bad_request("Query expected.")
+    doc = {"ref": Ref(name, Native.FUNCTIONS), "ts": txn.ts, "name": name, "body": body}
+    txn.schema_write("functions", name, doc)
+    return doc
+
+
+def _form_create_database(fauna, txn, expr, env):
+    params = _arg(fauna, txn, expr, "create_database", env)
+    name = params["name"]
+    if txn.db is not fauna.root:
+        raise FakeFaunaError(403, "permission denied", "Insufficient privileges to perform the action.")
+    if txn.schema_get("databases", name) is not None:
+        raise _bad_request("Database already exists.", "instance already exists")
+    txn.schema_write("databases", name, _Database(name, txn.ts))
+    return {"ref": Ref(name, Native.DATABASES), "ts": txn.ts, "name": name}
+
+
+def _form_create_key(fauna, txn, expr, env):
+    params = _arg(fauna, txn, expr, "create_key", env)
+    database = params.get("database")
+    if (txn.db is not fauna.root or not isinstance(database, Ref)
+            or txn.schema_get("databases", database.id()) is None):
+        raise _bad_request("Database ref expected.", "invalid ref")
+    key_id = fauna.new_id(fauna.root)
+    secret = "fake-{0}-{1}".format(database.id(), key_id)
+    txn.schema_write("keys", secret, database.id())
+    return {"ref": Ref(key_id, Native.KEYS), "ts": txn.ts, "database": database,
+            "role": params.get("role"), "secret": secret, "hashed_secret": secret}
+
+
+def _named_ref(native, key):
+    def form(fauna, txn, expr, env):
+        return Ref(_arg(fauna, txn, expr, key, env), native)
+    return form
+
+
+def _form_ref(fauna, txn, expr, env):
+    cls = _arg(fauna, txn, expr, "ref", env)
+    ref_id = _arg(fauna, txn, expr, "id", env)
+    if isinstance(cls, str):
+        return Ref(cls, None)
+    return Ref(str(ref_id), cls)
+
+
+def _numbers(fauna, txn, expr, key, env):
+    values = _varargs(_arg(fauna, txn, expr, key, env))
+    for value in values:
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise _bad_request("Number expected.")
+    return values
+
+
+def _arith(op):
+    def form(fauna, txn, expr, env):
+        key = next(iter(expr))
+        values = _numbers(fauna, txn, expr, key, env)
+        result = values[0]
+        for value in values[1:]:
+            result = op(result, value)
+        return result
+    return form
+
+
+def _divide(a, b):
+    if b == 0:
+        raise _bad_request("Illegal division by zero.")
+    if isinstance(a, int) and isinstance(b, int):
+        return int(a / b)
+    return a / b
+
+
+def _compare(op):
+    def form(fauna, txn, expr, env):
+        key = next(iter(expr))
+        values = [_sort_key(v) for v in _varargs(_arg(fauna, txn, expr, key, env))]
+        return all(op(a, b) for a, b in zip(values, values[1:]))
+    return form
+
+
+def _form_equals(fauna, txn, expr, env):
+    values = [_freeze(v) for v in _varargs(_arg(fauna, txn, expr, "equals", env))]
+    return all(v == values[0] for v in values)
+
+
+def _form_and(fauna, txn, expr, env):
+    return all(_varargs(_arg(fauna, txn, expr, "and", env)))
+
+
+def _form_or(fauna, txn, expr, env):
+    return any(_varargs(_arg(fauna, txn, expr, "or", env)))
+
+
+def _form_not(fauna, txn, expr, env):
+    return not _arg(fauna, txn, expr, "not", env)
+
+
+def _aggregate_items(fauna, txn, expr, key, env):
+    value = _arg(fauna, txn, expr, key, env)
+    if isinstance(value, _Set):
+        return [e[1] for e in value.entries()]
+    items, page = _collection_items(value)
+    return items
+
+
+def _form_sum(fauna, txn, expr, env):
+    return sum(_aggregate_items(fauna, txn, expr, "sum", env))
+
+
+def _form_count(fauna, txn, expr, env):
+    return len(_aggregate_items(fauna, txn, expr, "count", env))
+
+
+def _form_mean(fauna, txn, expr, env):
+    items = _aggregate_items(fauna, txn, expr, "mean", env)
+    if not items:
+        raise _bad_request("Non-empty array expected.")
+    return sum(items) / float(len(items))
+
+
+def _form_is_empty(fauna, txn, expr, env):
+    return not _aggregate_items(fauna, txn, expr, "is_empty", env)
+
+
+def _form_is_nonempty(fauna, txn, expr, env):
+    return bool(_aggregate_items(fauna, txn, expr, "is_nonempty", env))
+
+
+def _form_abort(fauna, txn, expr, env):
+    raise _bad_request(_arg(fauna, txn, expr, "abort", env), "transaction aborted")
+
+
+def _form_concat(fauna, txn, expr, env):
+    separator = _arg(fauna, txn, expr, "separator", env) or ""
+    return separator.join(_varargs(_arg(fauna, txn, expr, "concat", env)))
+
+
+def _form_to_string(fauna, txn, expr, env):
+    return str(_arg(fauna, txn, expr, "to_string", env))
+
+
+def _form_new_id(fauna, txn, expr, env):
+    return fauna.new_id(txn.db)
+
+
+_FORMS = {
+    "object": _form_object,
+    "let": _form_let,
+    "var": _form_var,
+    "if": _form_if,
+    "do": _form_do,
+    "lambda": _form_lambda,
+    "query": _form_query,
+    "call": _form_call,
+    "map": _form_map,
+    "foreach": _form_foreach,
+    "filter": _form_filter,
+    "take": _form_take,
+    "drop": _form_drop,
+    "append": _form_append,
+    "prepend": _form_prepend,
+    "select": _form_select,
+    "contains": _form_contains,
+    "match": _form_match,
+    "union": _form_union,
+    "intersection": _form_intersection,
+    "distinct": _form_distinct,
+    "range": _form_range,
+    "classes": _schema_set("classes"),
+    "collections": _schema_set("classes"),
+    "indexes": _schema_set("indexes"),
+    "functions": _schema_set("functions"),
+    "databases": _schema_set("databases"),
+    "paginate": _form_paginate,
+    "get": _form_get,
+    "exists": _form_exists,
+    "create": _form_create,
+    "update": _form_update,
+    "replace": _form_replace,
+    "delete": _form_delete,
+    "create_class": _form_create_class,
+    "create_collection": _form_create_class,
+    "create_index": _form_create_index,
+    "create_function": _form_create_function,
+    "create_database": _form_create_database,
+    "create_key": _form_create_key,
+    "class": _named_ref(Native.COLLECTIONS, "class"),
+    "collection": _named_ref(Native.COLLECTIONS, "collection"),
+    "index": _named_ref(Native.INDEXES, "index"),
+    "function": _named_ref(Native.FUNCTIONS, "function"),
+    "database": _named_ref(Native.DATABASES, "database"),
+    "ref": _form_ref,
+    "add": _arith(lambda a, b: a + b),
+    "subtract": _arith(lambda a, b: a - b),
+    "multiply": _arith(lambda a, b: a * b),
+    "divide": _arith(_divide),
+    "modulo": _arith(lambda a, b: a % b),
+    "lt": _compare(lambda a, b: a < b),
+    "lte": _compare(lambda a, b: a <= b),
+    "gt": _compare(lambda a, b: a > b),
+    "gte": _compare(lambda a, b: a >= b),
+    "equals": _form_equals,
+    "and": _form_and,
+    "or": _form_or,
+    "not": _form_not,
+    "sum": _form_sum,
+    "count": _form_count,
+    "mean": _form_mean,
+    "is_empty": _form_is_empty,
+    "is_nonempty": _form_is_nonempty,
+    "abort": _form_abort,
+    "concat": _form_concat,
+    "to_string": _form_to_string,
+    "new_id": _form_new_id,
+}
+
+
+def main(argv):
+    #
+    # Run the main function of a lesson (or of any module taking argv) against a fresh
+    # stand-in installed on 127.0.0.1:8443, the endpoint the lessons use. With --serve the
+    # stand-in really listens on that port, for code that does not go through the driver's
+    # HTTP session (e.g. ledger.aio).
+    #
+    parser = argparse.ArgumentParser(prog="python -m ledger.fake")
+    parser.add_argument("module", help="module whose main(argv) is run, e.g. Lesson4")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="latency added to every request")
+    parser.add_argument("--conflict-rate", type=float, default=0.0,
+                        help="probability of an injected 409 for requests that write")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--serve", action="store_true", help="listen on 127.0.0.1:8443 instead of in-process")
+    args, rest = parser.parse_known_args(argv[1:])
+
+    fauna = FakeFauna(latency=args.latency_ms / 1000.0, conflict_rate=args.conflict_rate, seed=args.seed)
+    if args.serve:
+        server = fauna.serve("127.0.0.1", 8443)
+    else:
+        fauna.install()
+    importlib.import_module(args.module).main([args.module] + rest)
+    print('Stand-in stats: {0}'.format(fauna.stats))
+    if args.serve:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,139 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Hedged requests for idempotent queries, to cut the tail latency of transfers.
+#
+# A Hedger sends a query and, if no answer has come back after the 'percentile' latency of
+# the recent queries (p95 by default), sends the same query a second time and returns
+# whichever answer comes first. Only a few percent of the queries are sent twice, but a
+# query stuck behind a slow connection or node no longer waits for it.
+#
+# Sending a query twice is only safe when applying it twice has the effect of applying it
+# once. Transfers are (see Lesson4.transfer_expr): the first attempt to commit records the
+# outcome, applied or rejected, under the transfer's uuid, and the other finds that record,
+# writes nothing and answers with the recorded outcome, or fails on the unique uuid index
+# and is ignored in favour of the other answer. Whichever answer comes first is therefore
+# the outcome recorded for the uuid, and a transfer rejected by one attempt can not be
+# applied by the other after a credit landed in between, so
+#
+#     hedger = Hedger()
+#     Lesson4.run_concurrent_transactions(client, 50, 10, 1000, apply_transfer=hedger.apply_transfer)
+#
+# never debits a customer twice.
+#
+
+import time
+import threading
+from bisect import insort
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from Lesson4 import apply_idempotent_transfer
+
+
+class LatencyTracker(object):
+    #
+    # The latencies of the last 'window' queries, kept sorted so that a percentile is a
+    # lookup. Until 'min_samples' latencies are known there is no percentile.
+    #
+    def __init__(self, window=1024, min_samples=32):
+        self.lock = threading.Lock()
+        self.window = window
+        self.min_samples = min_samples
+        self.recent = deque()
+        self.sorted = []
+
+    def record(self, seconds):
+        with self.lock:
+            self.recent.append(seconds)
+            insort(self.sorted, seconds)
+            if len(self.recent) > self.window:
+                oldest = self.recent.popleft()
+                del self.sorted[self.sorted.index(oldest)]
+
+    def percentile(self, pct):
+        with self.lock:
+            if len(self.sorted) < self.min_samples:
+                return None
+            return self.sorted[min(len(self.sorted) - 1, int(len(self.sorted) * pct / 100.0))]
+
+
+class Hedger(object):
+    #
+    # Sends idempotent queries with a hedge after the 'percentile' latency, never earlier
+    # than 'min_delay' seconds. The queries run on a pool of 'max_workers' threads.
+    #
+    def __init__(self, percentile=95, min_delay=0.001, window=1024, min_samples=32, max_workers=64,
+                 use_function=False):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.use_function = use_function
+        self.tracker = LatencyTracker(window, min_samples)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.lock = threading.Lock()
+        self.queries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def _send(self, client, expr):
+        start_time = time.time()
+        res = client.query(expr)
+        self.tracker.record(time.time() - start_time)
+        return res
+
+    def query(self, client, expr):
+        #
+        # Run 'expr', hedged. If both attempts fail the error of the last one is raised.
+        #
+        with self.lock:
+            self.queries += 1
+        primary = self.executor.submit(self._send, client, expr)
+        delay = self.tracker.percentile(self.percentile)
+        if delay is None or wait([primary], timeout=max(self.min_delay, delay)).done:
+            return primary.result()
+
+        hedge = self.executor.submit(self._send, client, expr)
+        with self.lock:
+            self.hedges += 1
+        pending = [primary, hedge]
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        with self.lock:
+                            self.hedge_wins += 1
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def apply_transfer(self, client, transaction, stats):
+        #
+        # An 'apply_transfer' for Lesson4.run_concurrent_transactions.
+        #
+        return apply_idempotent_transfer(client, transaction, stats, self.use_function,
+                                         query=lambda expr: self.query(client, expr))
+
+    def stats(self):
+        with self.lock:
+            return {"queries": self.queries, "hedges": self.hedges, "hedge_wins": self.hedge_wins,
+                    "hedge_delay": self.tracker.percentile(self.percentile)}
+
+    def close(self):
+        self.executor.shutdown(wait=True)
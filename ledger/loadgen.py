@@ -0,0 +1,271 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# A multi-process load generator for the Lesson4 transfers. Generating the random
+# transfers and encoding their queries costs enough CPU that a single Python process runs
+# out of core before the database runs out of capacity, so the load is spread over
+# --processes worker processes, each with its own client, connection pool and threads:
+#
+#     python -m ledger.loadgen --processes 8 --threads 16 --rate 5000 --duration 60
+#
+# With --rate the transfers are sent open loop: transfer i of a process is due at
+# start + i / (rate / processes) whether or not the earlier ones have been answered, and
+# its latency is measured from when it was due, so a database that falls behind shows up
+# as growing latency instead of a silently lower request rate. Without --rate every thread
+# sends its next transfer as soon as the previous one is answered. The run stops after
+# --duration seconds or --transfers transfers.
+#
+# Every process draws the customers and amounts of its transfers from a random.Random
+# seeded with --seed and its index, so a run can be repeated with the same transfers. Their
+# uuids are new on every run: a rerun with --keep-database applies its transfers again
+# instead of having them answered with ALREADY_APPLIED. Transfers that are answered with
+# ALREADY_APPLIED anyway are counted as duplicates, not as applied. The per-process
+# counters and latencies are merged into one JSON report.
+#
+
+import sys
+import json
+import time
+import argparse
+import platform
+import threading
+import multiprocessing
+from random import Random
+
+from faunadb import query as q
+from faunadb.errors import FaunaError
+
+from Lesson4 import (ALREADY_APPLIED, INSUFFICIENT_FUNDS, TransferStats, create_classes, create_customers,
+                     create_functions, create_indices, create_missing_customers, query_with_retry, random_transfer,
+                     transfer_call, transfer_query)
+from ledger.bench import percentile
+from ledger.client import close_clients, create_database, create_db_client
+from ledger.schema import sync_ledger_schema
+
+
+def run_worker(config, index, db_secret, barrier, results):
+    #
+    # The body of one worker process. Waits at 'barrier' so all the processes start
+    # together and puts its counters and latencies on 'results'.
+    #
+    rng = Random("{0}/{1}".format(config["seed"], index))
+    client = create_db_client(config["scheme"], config["domain"], config["port"], db_secret,
+                              pool_size=config["threads"])
+    build_query = transfer_call if config["use_function"] else transfer_query
+    stats = TransferStats()
+    lock = threading.Lock()
+    latencies = []
+    service_times = []
+    next_slot = [0]
+
+    processes = config["processes"]
+    rate = config["rate"] / float(processes) if config["rate"] else None
+    limit = None
+    if config["transfers"]:
+        limit = config["transfers"] // processes + (1 if index < config["transfers"] % processes else 0)
+
+    barrier.wait()
+    start_time = time.time()
+    stats.start_time = start_time
+    deadline = start_time + config["duration"] if config["duration"] else None
+
+    def next_transfer():
+        with lock:
+            slot = next_slot[0]
+            if limit is not None and slot >= limit:
+                return None
+            due = start_time + slot / rate if rate else time.time()
+            if deadline is not None and due >= deadline:
+                return None
+            next_slot[0] = slot + 1
+            return due, random_transfer(config["customers"], config["max_amount"], rng)
+
+    def send():
+        while True:
+            item = next_transfer()
+            if item is None:
+                return
+            due, transaction = item
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            sent = time.time()
+            try:
+                res = query_with_retry(client, build_query(transaction), stats)
+            except FaunaError:
+                stats.add(failed=1)
+                continue
+            done = time.time()
+            if res == INSUFFICIENT_FUNDS:
+                stats.add(insufficient=1)
+            elif res == ALREADY_APPLIED:
+                stats.add(duplicates=1)
+            else:
+                stats.add(applied=1)
+            with lock:
+                latencies.append((done - due) * 1000.0)
+                service_times.append((done - sent) * 1000.0)
+
+    threads = [threading.Thread(target=send) for i in range(0, config["threads"])]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats.end_time = time.time()
+    close_clients()
+
+    results.put({"process": index, "summary": stats.summary(), "latency_ms": latencies,
+                 "service_ms": service_times})
+
+
+def latency_summary(values):
+    values = sorted(values)
+    return {"p50": percentile(values, 50), "p95": percentile(values, 95), "p99": percentile(values, 99),
+            "max": values[-1] if values else 0.0}
+
+
+def merge_results(config, results):
+    #
+    # Merge the per-process results into one report. The processes start together, so the
+    # run lasts as long as the slowest of them.
+    #
+    results = sorted(results, key=lambda result: result["process"])
+    seconds = max(result["summary"]["seconds"] for result in results)
+    totals = {}
+    for name in ("transfers", "applied", "insufficient", "duplicates", "conflicts", "retries", "failed"):
+        totals[name] = sum(result["summary"][name] for result in results)
+    totals["seconds"] = seconds
+    totals["transfers_per_sec"] = totals["transfers"] / seconds if seconds > 0 else 0.0
+    totals["target_rate"] = config["rate"]
+    totals["latency_ms"] = latency_summary([v for result in results for v in result["latency_ms"]])
+    totals["service_ms"] = latency_summary([v for result in results for v in result["service_ms"]])
+
+    return {
+        "config": config,
+        "total": totals,
+        "processes": [{"process": result["process"],
+                       "transfers": result["summary"]["transfers"],
+                       "conflicts": result["summary"]["conflicts"],
+                       "transfers_per_sec": result["summary"]["transfers_per_sec"],
+                       "latency_ms": latency_summary(result["latency_ms"])} for result in results]
+    }
+
+
+def run_load(config, db_secret):
+    #
+    # Start the worker processes, wait for them and return the merged report.
+    #
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(config["processes"])
+    results = context.Queue()
+    workers = [context.Process(target=run_worker, args=(config, index, db_secret, barrier, results))
+               for index in range(0, config["processes"])]
+    for worker in workers:
+        worker.start()
+    collected = [results.get() for worker in workers]
+    for worker in workers:
+        worker.join()
+    return merge_results(config, collected)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="python -m ledger.loadgen")
+    parser.add_argument("--backend", choices=["fake", "fauna"], default="fauna")
+    parser.add_argument("--scheme", default="http")
+    parser.add_argument("--domain", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8443)
+    parser.add_argument("--secret", default="secret")
+    parser.add_argument("--db-name", default="LedgerLoad")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="fake backend: latency per request")
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--threads", type=int, default=8, help="concurrent transfers per process")
+    parser.add_argument("--customers", type=int, default=1000)
+    parser.add_argument("--max-amount", type=int, default=10)
+    parser.add_argument("--rate", type=float, default=None, help="target transfers per second, all processes")
+    parser.add_argument("--duration", type=float, default=None, help="seconds to run")
+    parser.add_argument("--transfers", type=int, default=None, help="transfers to send, all processes")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--use-function", action="store_true", help="call the stored transfer function")
+    parser.add_argument("--keep-database", action="store_true",
+                        help="reuse the database and its customers, only creating what is missing")
+    parser.add_argument("--db-secret", default=None,
+                        help="with --keep-database, the key secret printed by an earlier run to reuse")
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    args = parser.parse_args(argv[1:])
+    if not args.duration and not args.transfers:
+        args.duration = 10.0
+
+    server = None
+    if args.backend == "fake":
+        from ledger.fake import FakeFauna
+        server = FakeFauna(admin_secret=args.secret, latency=args.latency_ms / 1000.0).serve(args.domain, args.port)
+
+    db_secret = create_database(args.scheme, args.domain, args.port, args.secret, args.db_name,
+                                recreate=not args.keep_database, db_secret=args.db_secret)
+    client = create_db_client(args.scheme, args.domain, args.port, db_secret)
+    if args.keep_database:
+        sync_ledger_schema(client)
+        if not client.query(q.exists(q.match(q.index("customer_by_id"), args.customers))):
+            create_missing_customers(client, args.customers, 100)
+    else:
+        create_classes(client)
+        create_indices(client)
+        create_functions(client)
+        create_customers(client, args.customers, 100)
+    close_clients()
+
+    config = {
+        "backend": args.backend,
+        "scheme": args.scheme,
+        "domain": args.domain,
+        "port": args.port,
+        "processes": args.processes,
+        "threads": args.threads,
+        "customers": args.customers,
+        "max_amount": args.max_amount,
+        "rate": args.rate,
+        "duration": args.duration,
+        "transfers": args.transfers,
+        "seed": args.seed,
+        "use_function": args.use_function,
+        "python": platform.python_version(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    }
+    report = run_load(config, db_secret)
+    if server is not None:
+        server.shutdown()
+
+    total = report["total"]
+    print('Sent {0} transfers from {1} processes in {2:.2f} seconds: {3:.1f} transfers/sec, '
+          'p50 {4:.1f} ms, p99 {5:.1f} ms, {6} conflicts'.format(total["transfers"], args.processes,
+                                                                 total["seconds"], total["transfers_per_sec"],
+                                                                 total["latency_ms"]["p50"],
+                                                                 total["latency_ms"]["p99"], total["conflicts"]),
+          file=sys.stderr)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
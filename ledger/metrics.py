@@ -0,0 +1,323 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Per-operation instrumentation of client.query. Wrap a client with InstrumentedClient and
+# pass the wrapper to the lesson functions in its place:
+#
+#     instrument_lessons()
+#     metrics = QueryMetrics()
+#     client = InstrumentedClient(create_db_client(...), metrics)
+#     Lesson4.create_transaction(client, 50, 10)
+#     print(metrics.to_prometheus())
+#
+# Every query is tagged with a logical operation name, e.g. 'create_transaction' or
+# 'create_customers'. A ledger operation is a function taking the client as its first
+# argument and wrapped with tagged(): it is handed client.tagged(name), a view of the
+# InstrumentedClient that counts every query made through it under the operation's name,
+# whichever thread makes it. Helpers such as a retry loop are counted under the operation
+# that called them, and an operation called from another one is counted under its own
+# name, the innermost operation wins. Queries made outside of any operation are counted
+# under the name of the enclosing metrics.operation("...") block on their thread, or as
+# 'query'.
+#
+# The lessons are kept free of instrumentation: instrument_lessons() wraps their ledger
+# operations, listed in LESSON_OPERATIONS, with tagged() in place, so they are named that
+# way when they are called through their module (Lesson4.create_transaction(...)) or from
+# within it. The ledger package declares its own operations with @tagged.
+#
+# For each operation we keep a latency histogram, request and response size histograms
+# (the encoded bodies, counted from the HTTP exchange so nothing is encoded twice), error
+# and conflict counters and an in-flight gauge. Recording is a few counter updates under a
+# lock, cheap enough to leave on all the time. The data can be exported as Prometheus text
+# or as a JSON snapshot.
+#
+
+import json
+import time
+import importlib
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+SIZE_BUCKETS = [64, 256, 1024, 4096, 16384, 65536, 262144, 1048576]
+
+_local = threading.local()
+
+
+def _operation_stack():
+    stack = getattr(_local, "operations", None)
+    if stack is None:
+        stack = _local.operations = []
+    return stack
+
+
+@contextmanager
+def operation(name):
+    #
+    # Tag every query made inside the block, on this thread, with 'name', unless it is made
+    # by a tagged operation. Blocks can be nested and the innermost name wins.
+    #
+    stack = _operation_stack()
+    stack.append(name)
+    try:
+        yield
+    finally:
+        stack.pop()
+
+
+def current_operation():
+    stack = getattr(_local, "operations", None)
+    return stack[-1] if stack else None
+
+
+def tagged(fn, name=None):
+    #
+    # Wrap a function taking the client as its first argument so that, given an
+    # InstrumentedClient, its queries are counted under 'name' (the function's name by
+    # default). Usable as a decorator. Any other client is passed on unchanged.
+    #
+    name = name or fn.__name__
+
+    @wraps(fn)
+    def wrapper(client, *args, **kwargs):
+        if isinstance(client, InstrumentedClient):
+            client = client.tagged(name)
+        return fn(client, *args, **kwargs)
+    wrapper.operation_name = name
+    return wrapper
+
+
+LESSON_OPERATIONS = {
+    "Lesson2": ["create_schema", "create_customer", "read_customer", "update_customer", "delete_customer"],
+    "Lesson3": ["create_schema", "create_customers", "read_customer", "read_three_customers", "get_customers",
+                "read_list_of_customers", "read_customers_less_than", "scan_customers_between",
+                "read_customers_between", "read_all_customers", "scan_partitioned",
+                "read_all_customers_partitioned"],
+    "Lesson4": ["create_classes", "create_indices", "create_customer", "create_customers",
+                "create_missing_customers", "sum_balance_range", "sum_customer_balances_indexed",
+                "scan_customers_by_balance", "top_customers_by_balance", "customers_below_balance",
+                "customers_at_or_above_balance", "customers_in_balance_range", "bulk_load_customers",
+                "sum_customer_balanaces", "create_functions", "create_transaction",
+                "create_transaction_with_function", "apply_idempotent_transfer", "run_concurrent_transactions",
+                "create_transactions_batch"]
+}
+
+
+def instrument_lessons(operations=None):
+    #
+    # Wrap the ledger operations of the lessons with tagged(), in their modules. Calling it
+    # again does not wrap them twice.
+    #
+    for module_name, names in (operations or LESSON_OPERATIONS).items():
+        module = importlib.import_module(module_name)
+        for name in names:
+            fn = getattr(module, name)
+            if getattr(fn, "operation_name", None) is None:
+                setattr(module, name, tagged(fn))
+
+
+class Histogram(object):
+    #
+    # A cumulative histogram with fixed upper bounds, like a Prometheus histogram.
+    #
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + [float("inf")], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def snapshot(self):
+        return {"count": self.count, "sum": self.sum,
+                "buckets": [["+Inf" if bound == float("inf") else bound, count] for bound, count in self.cumulative()]}
+
+
+class OperationMetrics(object):
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.request_bytes = Histogram(SIZE_BUCKETS)
+        self.response_bytes = Histogram(SIZE_BUCKETS)
+        self.errors = 0
+        self.conflicts = 0
+        self.in_flight = 0
+
+    def snapshot(self):
+        return {"latency_seconds": self.latency.snapshot(),
+                "request_bytes": self.request_bytes.snapshot(),
+                "response_bytes": self.response_bytes.snapshot(),
+                "errors": self.errors,
+                "conflicts": self.conflicts,
+                "in_flight": self.in_flight}
+
+
+class QueryMetrics(object):
+    def __init__(self, prefix="ledger_query"):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.operations = {}
+
+    def operation(self, name):
+        #
+        # Tag every query made inside the block with 'name', see operation() above.
+        #
+        return operation(name)
+
+    def current_operation(self):
+        return current_operation()
+
+    def _get(self, name):
+        metrics = self.operations.get(name)
+        if metrics is None:
+            metrics = self.operations[name] = OperationMetrics()
+        return metrics
+
+    def start(self, name):
+        with self.lock:
+            self._get(name).in_flight += 1
+
+    def finish(self, name, seconds, request_bytes=None, response_bytes=None, status=None, failed=False):
+        with self.lock:
+            metrics = self._get(name)
+            metrics.in_flight -= 1
+            metrics.latency.observe(seconds)
+            if request_bytes is not None:
+                metrics.request_bytes.observe(request_bytes)
+            if response_bytes is not None:
+                metrics.response_bytes.observe(response_bytes)
+            if status == 409:
+                metrics.conflicts += 1
+            elif failed:
+                metrics.errors += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {"timestamp": time.time(),
+                    "operations": dict((name, m.snapshot()) for name, m in self.operations.items())}
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), sort_keys=True)
+
+    def to_prometheus(self):
+        #
+        # Render the metrics in the Prometheus text exposition format.
+        #
+        lines = []
+        with self.lock:
+            operations = sorted(self.operations.items())
+
+            def histogram(metric, help_text, attribute):
+                lines.append('# HELP {0} {1}'.format(metric, help_text))
+                lines.append('# TYPE {0} histogram'.format(metric))
+                for name, m in operations:
+                    h = getattr(m, attribute)
+                    for bound, count in h.cumulative():
+                        le = "+Inf" if bound == float("inf") else repr(bound)
+                        lines.append('{0}_bucket{{operation="{1}",le="{2}"}} {3}'.format(metric, name, le, count))
+                    lines.append('{0}_sum{{operation="{1}"}} {2}'.format(metric, name, h.sum))
+                    lines.append('{0}_count{{operation="{1}"}} {2}'.format(metric, name, h.count))
+
+            def scalar(metric, kind, help_text, attribute):
+                lines.append('# HELP {0} {1}'.format(metric, help_text))
+                lines.append('# TYPE {0} {1}'.format(metric, kind))
+                for name, m in operations:
+                    lines.append('{0}{{operation="{1}"}} {2}'.format(metric, name, getattr(m, attribute)))
+
+            histogram(self.prefix + "_latency_seconds", "Latency of client.query calls.", "latency")
+            histogram(self.prefix + "_request_bytes", "Size of the encoded query.", "request_bytes")
+            histogram(self.prefix + "_response_bytes", "Size of the response body.", "response_bytes")
+            scalar(self.prefix + "_errors_total", "counter", "Queries that failed, conflicts excluded.", "errors")
+            scalar(self.prefix + "_conflicts_total", "counter", "Queries that failed with a 409 conflict.", "conflicts")
+            scalar(self.prefix + "_in_flight", "gauge", "Queries currently running.", "in_flight")
+        return "\n".join(lines) + "\n"
+
+
+def _record_exchange(response, *args, **kwargs):
+    #
+    # requests response hook: remember the body sizes of the exchange for the query that is
+    # running on this thread.
+    #
+    exchange = getattr(_local, "exchange", None)
+    if exchange is not None:
+        body = response.request.body or b""
+        exchange["request_bytes"] = len(body.encode("utf-8") if isinstance(body, str) else body)
+        exchange["response_bytes"] = len(response.content or b"")
+        exchange["status"] = response.status_code
+    return response
+
+
+class InstrumentedClient(object):
+    #
+    # Drop-in replacement for a FaunaClient that records every query in a QueryMetrics.
+    # Everything other than query is passed through to the wrapped client.
+    #
+    def __init__(self, client, metrics, operation=None):
+        self.client = client
+        self.metrics = metrics
+        self.operation = operation
+        hooks = client.session.hooks["response"]
+        if _record_exchange not in hooks:
+            hooks.append(_record_exchange)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def tagged(self, operation):
+        #
+        # A view of this client counting its queries under 'operation'.
+        #
+        return InstrumentedClient(self.client, self.metrics, operation)
+
+    def query(self, expression, timeout_millis=None, operation=None):
+        return self.measure(lambda client: client.query(expression, timeout_millis), operation)
+
+    def measure(self, call, operation=None):
+        #
+        # Record call(client) on the wrapped client as one query, for requests that are not
+        # made with client.query (see ledger.compact.query_body).
+        #
+        name = operation or self.operation or current_operation() or "query"
+        exchange = {}
+        _local.exchange = exchange
+        self.metrics.start(name)
+        start_time = time.perf_counter()
+        failed = False
+        try:
+            return call(self.client)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            _local.exchange = None
+            self.metrics.finish(name, time.perf_counter() - start_time, exchange.get("request_bytes"),
+                                exchange.get("response_bytes"), exchange.get("status"), failed)
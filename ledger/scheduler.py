@@ -0,0 +1,147 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# A conflict-aware scheduler in front of the Lesson4 transfers.
+#
+# Transfers that touch the same customer in different concurrent requests serialize on that
+# customer's document and all but one of them have to be retried. The scheduler takes a
+# stream of pending transfers and groups them into waves of batches such that no customer
+# appears in two batches of the same wave. The batches of a wave are sent concurrently, one
+# request each, and transfers that would have overlapped with another batch are queued for
+# the next wave. Inside a batch the same customer can appear several times, the batch is a
+# single transaction that applies its transfers in order.
+#
+
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from ledger.metrics import tagged
+from Lesson4 import INSUFFICIENT_FUNDS, TransferStats, query_with_retry, transfer_call, transfer_query
+
+
+def plan_wave(pending, max_batch_size, max_batches):
+    #
+    # Take transfers from the front of 'pending' to fill at most 'max_batches' batches of at
+    # most 'max_batch_size' transfers whose customers do not overlap between batches. A
+    # transfer joins the batch that already owns one of its customers, or the emptiest batch
+    # if neither customer is owned yet. Transfers that can't be placed are left in 'pending',
+    # in order, ahead of anything not looked at yet. Returns the batches and the number of
+    # transfers that were deferred.
+    #
+    batches = []
+    owner = {}
+    deferred = []
+    looked_at = 0
+    capacity = max_batch_size * max_batches
+
+    while pending and sum(len(b) for b in batches) < capacity:
+        transaction = pending.popleft()
+        looked_at += 1
+        owners = set(owner[c] for c in (transaction["sourceCust"], transaction["destCust"]) if c in owner)
+
+        if len(owners) > 1:
+            target = None
+        elif owners:
+            target = owners.pop()
+            if len(batches[target]) >= max_batch_size:
+                target = None
+        elif len(batches) < max_batches:
+            batches.append([])
+            target = len(batches) - 1
+        else:
+            open_batches = [i for i in range(0, len(batches)) if len(batches[i]) < max_batch_size]
+            target = min(open_batches, key=lambda i: len(batches[i])) if open_batches else None
+
+        if target is None:
+            deferred.append(transaction)
+            if len(deferred) >= capacity:
+                break
+            continue
+
+        batches[target].append(transaction)
+        owner[transaction["sourceCust"]] = target
+        owner[transaction["destCust"]] = target
+
+    pending.extendleft(reversed(deferred))
+    return batches, len(deferred)
+
+
+@tagged
+def run_scheduled_transfers(client, transfers, max_batch_size=50, max_concurrency=8, use_function=False):
+    #
+    # Apply a stream of transfers through the scheduler. The stream is read lazily, a window
+    # of twice what one wave can hold at a time. Returns the results, one
+    # {"transaction", "applied"} per transfer in the order they were applied, and a report of
+    # how well the transfers could be batched.
+    #
+    build_query = transfer_call if use_function else transfer_query
+    stats = TransferStats()
+    stream = iter(transfers)
+    pending = deque()
+    window = max_batch_size * max_concurrency * 2
+    results = []
+    results_lock = threading.Lock()
+    waves = 0
+    num_batches = 0
+    deferrals = 0
+
+    def apply_batch(batch):
+        res = query_with_retry(client, [build_query(transaction) for transaction in batch], stats)
+        applied = [txn_res != INSUFFICIENT_FUNDS for txn_res in res]
+        stats.add(applied=applied.count(True), insufficient=applied.count(False))
+        with results_lock:
+            results.extend({"transaction": t, "applied": a} for t, a in zip(batch, applied))
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        while True:
+            for transaction in stream:
+                pending.append(transaction)
+                if len(pending) >= window:
+                    break
+            if not pending:
+                break
+
+            batches, deferred = plan_wave(pending, max_batch_size, max_concurrency)
+            waves += 1
+            num_batches += len(batches)
+            deferrals += deferred
+            for future in [executor.submit(apply_batch, batch) for batch in batches]:
+                future.result()
+    stats.end_time = time.time()
+
+    summary = stats.summary()
+    report = {
+        "transfers": summary["transfers"],
+        "waves": waves,
+        "batches": num_batches,
+        "deferrals": deferrals,
+        "avg_batch_size": summary["transfers"] / float(num_batches) if num_batches else 0.0,
+        "batch_fill": summary["transfers"] / float(num_batches * max_batch_size) if num_batches else 0.0,
+        "batches_per_wave": num_batches / float(waves) if waves else 0.0,
+        "conflicts": summary["conflicts"],
+        "retries": summary["retries"],
+        "transfers_per_sec": summary["transfers_per_sec"]
+    }
+    print('Scheduled {0} transfers in {1} waves of {2:.1f} batches ({3:.0%} full), {4} deferrals, '
+          '{5} conflicts, {6:.1f} transfers/sec'.format(report["transfers"], waves, report["batches_per_wave"],
+                                                        report["batch_fill"], deferrals, report["conflicts"],
+                                                        report["transfers_per_sec"]))
+
+    return results, report
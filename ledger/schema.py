@@ -0,0 +1,184 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Incremental schema setup. Instead of dropping the database and creating every class,
+# index and function again on each start, sync_schema reads what the database already has
+# in one query, creates only what is missing and waits for new indexes to become active,
+# so a restart against an up to date database costs a single round trip and keeps the data.
+#
+# The desired schema is given as the same definitions that q.create_class, q.create_index
+# and q.create_function take, e.g. Lesson4.CLASSES, Lesson4.INDEXES and
+# Lesson4.function_definitions(). An existing index whose source, terms, values or
+# uniqueness differ from its definition is reported, never changed: that needs a rebuild,
+# which is a decision for whoever changed the definition.
+#
+#     python -m ledger.schema --db-name LedgerExample
+#
+# brings the database of the lessons up to date with Lesson4's schema.
+#
+
+import sys
+import time
+import argparse
+from faunadb import query as q
+from faunadb.objects import Ref
+
+from ledger.client import create_database, create_db_client
+
+MAX_PAGE_SIZE = 100000
+
+
+def read_schema(client):
+    #
+    # The names of the existing classes and functions and the definitions of the existing
+    # indexes, in one query.
+    #
+    res = client.query({
+        "classes": q.paginate(q.classes(), size=MAX_PAGE_SIZE),
+        "indexes": q.map_(lambda ref: q.get(ref), q.paginate(q.indexes(), size=MAX_PAGE_SIZE)),
+        "functions": q.paginate(q.functions(), size=MAX_PAGE_SIZE)
+    })
+    return {
+        "classes": set(ref.id() for ref in res["classes"]["data"]),
+        "indexes": dict((index["name"], index) for index in res["indexes"]["data"]),
+        "functions": set(ref.id() for ref in res["functions"]["data"])
+    }
+
+
+def _fields(fields):
+    if fields is None:
+        return []
+    if isinstance(fields, dict):
+        fields = [fields]
+    return [(tuple(field["field"]) if isinstance(field["field"], list) else (field["field"],),
+             bool(field.get("reverse"))) for field in fields]
+
+
+def _source_name(source):
+    if isinstance(source, Ref):
+        return source.id()
+    # q.class_("name") or q.collection("name")
+    return list(source.to_fauna_json().values())[0]
+
+
+def index_signature(definition):
+    #
+    # What makes two definitions of an index equivalent: its source class, its terms and
+    # values (and their order) and whether it is unique. Works on both definitions given to
+    # q.create_index and index documents read back from the database.
+    #
+    return (_source_name(definition["source"]), _fields(definition.get("terms")),
+            _fields(definition.get("values")), bool(definition.get("unique")))
+
+
+def plan_schema(existing, classes=(), indexes=(), functions=()):
+    #
+    # The definitions that are missing from 'existing' (as returned by read_schema) and the
+    # names of the indexes whose existing definition differs from the desired one.
+    #
+    return {
+        "classes": [definition for definition in classes if definition["name"] not in existing["classes"]],
+        "indexes": [definition for definition in indexes if definition["name"] not in existing["indexes"]],
+        "functions": [definition for definition in functions if definition["name"] not in existing["functions"]],
+        "mismatched": [definition["name"] for definition in indexes
+                       if definition["name"] in existing["indexes"] and
+                       index_signature(definition) != index_signature(existing["indexes"][definition["name"]])]
+    }
+
+
+def wait_for_indexes(client, names, timeout=60.0, poll_interval=0.05, max_poll_interval=1.0):
+    #
+    # Wait until every named index is active (built), asking for all of them in one query
+    # per poll and polling less and less often, up to 'max_poll_interval' seconds apart.
+    #
+    deadline = time.time() + timeout
+    pending = list(names)
+    while pending:
+        active = client.query(q.map_(lambda name: q.select("active", q.get(q.index(name))), pending))
+        pending = [name for name, is_active in zip(pending, active) if not is_active]
+        if not pending:
+            break
+        if time.time() + poll_interval > deadline:
+            raise TimeoutError('Indexes not active after {0} seconds: {1}'.format(timeout, pending))
+        time.sleep(poll_interval)
+        poll_interval = min(max_poll_interval, poll_interval * 2)
+
+
+def sync_schema(client, classes=(), indexes=(), functions=(), wait=True, timeout=60.0):
+    #
+    # Create the missing classes, indexes and functions and wait for the new indexes to be
+    # active. Everything missing is created in one query, except that indexes on classes
+    # created by the same sync go in a second query once their classes exist. Returns the
+    # plan that was applied.
+    #
+    plan = plan_schema(read_schema(client), classes, indexes, functions)
+
+    creates = ([q.create_class(definition) for definition in plan["classes"]] +
+               [q.create_function(definition) for definition in plan["functions"]])
+    index_creates = [q.create_index(definition) for definition in plan["indexes"]]
+    if plan["classes"]:
+        if creates:
+            client.query(creates)
+        if index_creates:
+            client.query(index_creates)
+    elif creates or index_creates:
+        client.query(creates + index_creates)
+
+    if wait and plan["indexes"]:
+        wait_for_indexes(client, [definition["name"] for definition in plan["indexes"]], timeout)
+
+    for name in plan["mismatched"]:
+        print('Index \'{0}\' exists with a different definition, left unchanged'.format(name))
+    print('Schema sync created {0} classes, {1} indexes and {2} functions'.format(
+        len(plan["classes"]), len(plan["indexes"]), len(plan["functions"])))
+
+    return plan
+
+
+def sync_ledger_schema(client, wait=True, timeout=60.0):
+    #
+    # Bring a database up to date with the schema of Lesson4.
+    #
+    import Lesson4
+    return sync_schema(client, Lesson4.CLASSES, Lesson4.INDEXES, Lesson4.function_definitions(), wait, timeout)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="python -m ledger.schema")
+    parser.add_argument("--scheme", default="http")
+    parser.add_argument("--domain", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8443)
+    parser.add_argument("--secret", default="secret")
+    parser.add_argument("--db-name", default="LedgerExample")
+    parser.add_argument("--db-secret", default=None,
+                        help="key secret printed by an earlier run, reused instead of creating a new key")
+    parser.add_argument("--timeout", type=float, default=60.0, help="seconds to wait for new indexes")
+    args = parser.parse_args(argv[1:])
+
+    db_secret = create_database(args.scheme, args.domain, args.port, args.secret, args.db_name, recreate=False,
+                                db_secret=args.db_secret)
+    client = create_db_client(args.scheme, args.domain, args.port, db_secret)
+
+    start_time = time.time()
+    sync_ledger_schema(client, timeout=args.timeout)
+    print('Schema of {0} in sync after {1:.3f} seconds'.format(args.db_name, time.time() - start_time))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,225 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Optional sharded balances for hot customer accounts.
+#
+# In this mode a customer's balance is not kept on the customer document but spread over
+# 'num_shards' documents of the 'balance_shards' class, each holding {id, shard, balance}.
+# A transfer debits one randomly chosen shard of the source and credits one randomly chosen
+# shard of the destination, so concurrent transfers touching the same customer usually touch
+# different documents and do not conflict. Throughput on a hot account grows with the number
+# of shards.
+#
+# Every shard is kept from going negative, which keeps the sum from going negative. When the
+# chosen source shard can not cover the amount on its own, the transfer falls back to a
+# query that reads all the source's shards, checks the amount against their total and
+# spreads what is left after the debit evenly over the shards again, so that the next
+# transfers find enough in whichever shard they pick. That fallback touches every shard of
+# the customer and is the only path that does.
+#
+# The reads that get customer documents (Lesson3's reads, Lesson4.sum_customer_balanaces and
+# their ledger.aio versions) sum a sharded customer's balance over its shards through
+# ledger.balances. The covering indexes on the customers hold no balance in this mode: sum
+# the balances with sum_sharded_balances and read one with read_sharded_balance instead of
+# scan_customers_between or sum_customer_balances_indexed.
+#
+
+from random import randrange
+from faunadb import query as q
+
+import Lesson4
+from ledger.metrics import tagged
+from Lesson4 import INSUFFICIENT_FUNDS, customer_chunks, query_with_retry, run_concurrent_transactions
+
+
+@tagged
+def create_shard_schema(client):
+    #
+    # The class holding the shards, an index to find a given shard of a customer, one to
+    # read all the shard balances of a customer and a covering index to aggregate them.
+    #
+    client.query(q.create_class({"name": "balance_shards"}))
+    res = client.query([
+        q.create_index({
+            "name": "balance_shard_by_id",
+            "source": q.class_("balance_shards"),
+            "unique": True,
+            "terms": [{"field": ["data", "id"]}, {"field": ["data", "shard"]}]
+        }),
+        q.create_index({
+            "name": "balance_shards_by_customer",
+            "source": q.class_("balance_shards"),
+            "terms": [{"field": ["data", "id"]}],
+            "values": [{"field": ["data", "balance"]}, {"field": ["ref"]}]
+        }),
+        q.create_index({
+            "name": "balance_shard_id_balance_filter",
+            "source": q.class_("balance_shards"),
+            "values": [{"field": ["data", "id"]}, {"field": ["data", "balance"]}]
+        })
+    ])
+    print('Create \'balance_shards\' class and shard indices')
+
+    return res
+
+
+@tagged
+def create_sharded_customers(client, num_customers, init_balance, num_shards, max_chunk_size=500):
+    #
+    # Create customers 1 to 'num_customers' with their balance split evenly over
+    # 'num_shards' shards. The customer documents only record how many shards they have.
+    #
+    share = float(init_balance) / num_shards
+
+    def documents():
+        for cust_id in range(1, num_customers + 1):
+            yield {"customer": True, "id": cust_id, "shards": num_shards}
+            for shard in range(0, num_shards):
+                yield {"id": cust_id, "shard": shard,
+                       "balance": init_balance - share * (num_shards - 1) if shard == num_shards - 1 else share}
+
+    for chunk in customer_chunks(documents(), max_chunk_size):
+        client.query([
+            q.create(q.class_("customers"), {"data": {"id": doc["id"], "shards": doc["shards"]}})
+            if "customer" in doc else
+            q.create(q.class_("balance_shards"), {"data": doc})
+            for doc in chunk
+        ])
+    print('Create {0} customers with {1} balance shards each'.format(num_customers, num_shards))
+
+
+def get_shard(cust_id, shard_num):
+    return q.get(q.match(q.index("balance_shard_by_id"), [cust_id, shard_num]))
+
+
+def sharded_transfer_query(transaction, source_shard, dest_shard):
+    #
+    # Move the amount from one shard of the source to one shard of the destination, if
+    # that source shard can cover it.
+    #
+    amount = transaction["amount"]
+    data = dict(transaction, sourceShard=source_shard, destShard=dest_shard)
+
+    return q.let(
+        {"source_shard": get_shard(transaction["sourceCust"], source_shard),
+         "dest_shard": get_shard(transaction["destCust"], dest_shard)},
+        q.let(
+            {"new_source_balance": q.subtract(q.select(["data", "balance"], q.var("source_shard")), amount),
+             "new_dest_balance": q.add(q.select(["data", "balance"], q.var("dest_shard")), amount)},
+            q.if_(
+                q.gte(q.var("new_source_balance"), 0),
+                q.do(
+                    q.create(q.class_("transactions"), {"data": data}),
+                    q.update(q.select("ref", q.var("source_shard")),
+                             {"data": {"txnID": transaction["uuid"], "balance": q.var("new_source_balance")}}),
+                    q.update(q.select("ref", q.var("dest_shard")),
+                             {"data": {"txnID": transaction["uuid"], "balance": q.var("new_dest_balance")}})
+                ),
+                INSUFFICIENT_FUNDS
+            )
+        )
+    )
+
+
+def rebalancing_transfer_query(transaction, num_shards, source_shard, dest_shard):
+    #
+    # The fallback transfer: check the amount against the total of all the source's shards
+    # and, if it is covered, split the remaining balance evenly over them. 'source_shard'
+    # also takes the remainder of the division, so integer balances stay exact.
+    #
+    amount = transaction["amount"]
+    data = dict(transaction, sourceShard=source_shard, destShard=dest_shard)
+    names = ["shard_{0}".format(i) for i in range(0, num_shards)]
+
+    bindings = dict((names[i], get_shard(transaction["sourceCust"], i)) for i in range(0, num_shards))
+    bindings["dest_shard"] = get_shard(transaction["destCust"], dest_shard)
+
+    updates = [q.update(q.select("ref", q.var(names[i])),
+                        {"data": {"txnID": transaction["uuid"],
+                                  "balance": q.var("remainder_share") if i == source_shard else q.var("share")}})
+               for i in range(0, num_shards)]
+
+    return q.let(
+        bindings,
+        q.let(
+            {"new_source_balance": q.subtract(q.add(*[q.select(["data", "balance"], q.var(name)) for name in names]),
+                                              amount),
+             "new_dest_balance": q.add(q.select(["data", "balance"], q.var("dest_shard")), amount)},
+            q.if_(
+                q.gte(q.var("new_source_balance"), 0),
+                q.let(
+                    {"share": q.divide(q.var("new_source_balance"), num_shards)},
+                    q.let(
+                        {"remainder_share": q.subtract(q.var("new_source_balance"),
+                                                       q.multiply(q.var("share"), num_shards - 1))},
+                        q.do(*([q.create(q.class_("transactions"), {"data": data})] + updates + [
+                            q.update(q.select("ref", q.var("dest_shard")),
+                                     {"data": {"txnID": transaction["uuid"], "balance": q.var("new_dest_balance")}})
+                        ]))
+                    )
+                ),
+                INSUFFICIENT_FUNDS
+            )
+        )
+    )
+
+
+@tagged
+def create_sharded_transaction(client, transaction, num_shards, stats):
+    #
+    # Apply a transfer in sharded mode, retrying contention. Returns the result of the
+    # query, INSUFFICIENT_FUNDS only if the source's total balance can not cover the amount.
+    #
+    source_shard = randrange(0, num_shards)
+    dest_shard = randrange(0, num_shards)
+    res = query_with_retry(client, sharded_transfer_query(transaction, source_shard, dest_shard), stats)
+    if res == INSUFFICIENT_FUNDS and num_shards > 1:
+        res = query_with_retry(client, rebalancing_transfer_query(transaction, num_shards, source_shard, dest_shard),
+                               stats)
+    return res
+
+
+@tagged
+def run_sharded_transactions(client, num_customers, max_txn_amount, num_txns, num_shards, num_workers=8):
+    #
+    # The concurrent transfer driver of Lesson4 in sharded mode.
+    #
+    return run_concurrent_transactions(
+        client, num_customers, max_txn_amount, num_txns, num_workers,
+        apply_transfer=lambda c, transaction, stats: create_sharded_transaction(c, transaction, num_shards, stats))
+
+
+@tagged
+def read_sharded_balance(client, cust_id, num_shards):
+    #
+    # The balance of a customer, summed over its shards by the database.
+    #
+    return client.query(
+        q.sum(q.map_(lambda balance, ref: balance,
+                     q.select("data", q.paginate(q.match(q.index("balance_shards_by_customer"), cust_id),
+                                                 size=num_shards))))
+    )
+
+
+@tagged
+def sum_sharded_balances(client, min_cust_id, max_cust_id, num_partitions=4):
+    #
+    # The sum of all the balances, aggregated from the covering index over the shards.
+    #
+    return Lesson4.sum_customer_balances_indexed(client, min_cust_id, max_cust_id, num_partitions,
+                                                 index_name="balance_shard_id_balance_filter")
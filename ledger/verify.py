@@ -0,0 +1,211 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Incremental check that transfers conserve money, without re-reading every customer.
+#
+# A BalanceVerifier starts from known balances (the initial balance given to the customers
+# at creation, or one read of them) and is told about every transfer result. From those it
+# keeps the balance each customer should have and the set of customers that changed since
+# the last check. check() reads only the changed customers, plus optionally a random sample
+# of the others, and reports every customer whose balance is not what the transfers say it
+# should be. The cost of a check follows the number of changes, not the number of customers.
+#
+# Checks can run while transfers are in flight. A customer with a transfer whose outcome
+# is not known yet, or with a transfer sent while it was being read, is left for the next
+# check. That needs begin() to be called before a transfer is sent, as apply_transfer does;
+# results recorded without it must not race a check. A customer involved in a transfer
+# that failed in a way that leaves its outcome unknown is re-read and its balance taken as
+# the new expectation ('resynced').
+#
+#     verifier = BalanceVerifier.from_initial(50, 100)
+#     Lesson4.run_concurrent_transactions(client, 50, 10, 1000, apply_transfer=verifier.apply_transfer)
+#     verifier.check(client)
+#
+
+import sys
+import threading
+from random import sample
+
+import Lesson3
+from Lesson4 import (INSUFFICIENT_FUNDS, apply_idempotent_transfer, create_classes, create_customers,
+                     create_functions, create_indices, run_concurrent_transactions)
+from ledger.client import create_database, create_db_client
+
+
+class BalanceVerifier(object):
+    def __init__(self, balances):
+        self.lock = threading.Lock()
+        self.expected = dict(balances)
+        self.changed = set()
+        self.in_flight = {}
+        self.epochs = {}
+        self.unknown = set()
+        self.recorded = set()
+
+    @classmethod
+    def from_initial(cls, num_customers, init_balance):
+        #
+        # For customers 1 to 'num_customers' created with 'init_balance' (e.g. by
+        # Lesson4.create_customers) and not touched since.
+        #
+        return cls(dict((cust_id, init_balance) for cust_id in range(1, num_customers + 1)))
+
+    @classmethod
+    def from_database(cls, client, cust_ids):
+        #
+        # Start from the current balances of 'cust_ids', read once.
+        #
+        customers = Lesson3.get_customers(client, cust_ids)
+        return cls(dict((customer["id"], customer["balance"]) for customer in customers if customer is not None))
+
+    def begin(self, transaction):
+        #
+        # A transfer between these customers is being sent.
+        #
+        with self.lock:
+            for cust_id in (transaction["sourceCust"], transaction["destCust"]):
+                self.in_flight[cust_id] = self.in_flight.get(cust_id, 0) + 1
+                self.epochs[cust_id] = self.epochs.get(cust_id, 0) + 1
+
+    def _end(self, transaction):
+        for cust_id in (transaction["sourceCust"], transaction["destCust"]):
+            count = self.in_flight.pop(cust_id) - 1
+            if count:
+                self.in_flight[cust_id] = count
+
+    def record(self, transaction, result, started=False):
+        #
+        # The result of a transfer: what the query returned, or a boolean "applied" like the
+        # results of Lesson4.create_transactions_batch. A transfer is counted once per uuid,
+        # so a retry answered with ALREADY_APPLIED is only counted if the first attempt was
+        # not. 'started' says begin() was called for it.
+        #
+        applied = result if isinstance(result, bool) else result != INSUFFICIENT_FUNDS
+        with self.lock:
+            if started:
+                self._end(transaction)
+            if not applied or transaction["uuid"] in self.recorded:
+                return
+            self.recorded.add(transaction["uuid"])
+            amount = transaction["amount"]
+            for cust_id, delta in ((transaction["sourceCust"], -amount), (transaction["destCust"], amount)):
+                if cust_id in self.expected:
+                    self.expected[cust_id] += delta
+                self.changed.add(cust_id)
+                self.epochs[cust_id] = self.epochs.get(cust_id, 0) + 1
+
+    def record_results(self, results):
+        #
+        # The results of Lesson4.create_transactions_batch or ledger.scheduler.
+        #
+        for res in results:
+            self.record(res["transaction"], res["applied"])
+
+    def fail(self, transaction, started=False):
+        #
+        # A transfer failed without saying whether it was applied.
+        #
+        with self.lock:
+            if started:
+                self._end(transaction)
+            for cust_id in (transaction["sourceCust"], transaction["destCust"]):
+                self.unknown.add(cust_id)
+                self.epochs[cust_id] = self.epochs.get(cust_id, 0) + 1
+
+    def apply_transfer(self, client, transaction, stats):
+        #
+        # An 'apply_transfer' for Lesson4.run_concurrent_transactions that records the
+        # results of the transfers as they are applied.
+        #
+        self.begin(transaction)
+        try:
+            res = apply_idempotent_transfer(client, transaction, stats)
+        except Exception:
+            self.fail(transaction, started=True)
+            raise
+        self.record(transaction, res, started=True)
+        return res
+
+    def check(self, client, sample_size=0):
+        #
+        # Read the changed customers that have no transfer in flight, plus 'sample_size'
+        # random unchanged ones, and compare them with their expected balances. Returns a
+        # report whose 'drift' maps the id of every customer that is off to its expected
+        # and actual balance. Customers that match are not read again until they change.
+        #
+        with self.lock:
+            to_check = [cust_id for cust_id in self.changed | self.unknown if cust_id not in self.in_flight]
+            deferred = len(self.changed | self.unknown) - len(to_check)
+            unchanged = [cust_id for cust_id in self.expected
+                         if cust_id not in self.changed and cust_id not in self.in_flight]
+            sampled = sample(unchanged, min(sample_size, len(unchanged)))
+            epochs = [self.epochs.get(cust_id, 0) for cust_id in to_check + sampled]
+
+        customers = Lesson3.get_customers(client, to_check + sampled)
+
+        drift = {}
+        resynced = []
+        with self.lock:
+            for cust_id, epoch, customer in zip(to_check + sampled, epochs, customers):
+                if cust_id in self.in_flight or self.epochs.get(cust_id, 0) != epoch:
+                    deferred += 1
+                    continue
+                actual = customer["balance"] if customer is not None else None
+                if cust_id in self.unknown:
+                    self.unknown.discard(cust_id)
+                    self.changed.discard(cust_id)
+                    self.expected[cust_id] = actual
+                    resynced.append(cust_id)
+                elif cust_id not in self.expected or self.expected[cust_id] == actual:
+                    self.changed.discard(cust_id)
+                else:
+                    drift[cust_id] = {"expected": self.expected[cust_id], "actual": actual}
+
+        report = {"checked": len(to_check), "sampled": len(sampled), "deferred": deferred,
+                  "resynced": sorted(resynced), "drift": drift}
+        if drift:
+            print('Balance drift on customers {0}'.format(sorted(drift)))
+        print('Checked {0} changed and {1} sampled customers ({2} deferred): {3}'.format(
+            report["checked"], report["sampled"], deferred, "OK" if not drift else "{0} drifted".format(len(drift))))
+        return report
+
+
+def main(argv):
+    #
+    # The Lesson4 transfers, verified incrementally instead of by summing every balance.
+    #
+    scheme = "http"
+    domain = "127.0.0.1"
+    port = "8443"
+    secret = "secret"
+
+    db_secret = create_database(scheme, domain, port, secret, "LedgerVerifyExample")
+    client = create_db_client(scheme, domain, port, db_secret)
+    create_classes(client)
+    create_indices(client)
+    create_functions(client)
+    create_customers(client, 1000, 100)
+
+    verifier = BalanceVerifier.from_initial(1000, 100)
+    for i in range(0, 3):
+        run_concurrent_transactions(client, 1000, 10, 500, num_workers=8, apply_transfer=verifier.apply_transfer)
+        verifier.check(client, sample_size=20)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,248 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Write-behind submission of transfers with group commit.
+#
+# Instead of every caller of create_transaction waiting a full round trip for its own
+# query, callers hand their transfers to a TransferWriter and get a Future back. A
+# background flusher takes the queued transfers and commits them together, as one query
+# of up to 'max_batch_size' transfers, as soon as that many are waiting or the oldest has
+# waited 'max_delay' seconds. Up to 'max_in_flight' such queries run at a time. A transfer
+# waits a few milliseconds more, but the database sees one request per batch, which raises
+# the sustained transfer rate by about the batch size.
+#
+# The queue holds at most 'max_queue' transfers. When the database does not keep up it
+# fills and submit() blocks (or, with a timeout, raises queue.Full), so producers are slowed
+# down instead of memory growing without bound.
+#
+#     with TransferWriter(client) as writer:
+#         futures = [writer.submit(random_transfer(50, 10)) for i in range(0, 1000)]
+#     applied = [f.result() != INSUFFICIENT_FUNDS for f in futures]
+#
+# Each future resolves to what the transfer evaluated to, as create_transaction returns
+# it: INSUFFICIENT_FUNDS, ALREADY_APPLIED or the updated destination customer. A batch that
+# fails for another reason than contention is retried one transfer at a time, so a bad
+# transfer only fails its own future. A transfer whose future is cancelled before the
+# flusher takes it into a batch is dropped; once it is in a batch it can not be cancelled.
+#
+
+import sys
+import time
+import queue
+import threading
+from concurrent.futures import Future, InvalidStateError
+
+from faunadb.errors import FaunaError
+
+from Lesson4 import (INSUFFICIENT_FUNDS, TransferStats, create_classes, create_customers, create_functions,
+                     create_indices, is_contention_error, query_with_retry, random_transfer, transfer_call,
+                     transfer_query)
+from ledger.client import create_database, create_db_client
+
+_CLOSE = object()
+
+
+def _resolve(future, result=None, error=None):
+    #
+    # Resolve a future that nothing else may have resolved or cancelled in the meantime,
+    # without letting one such future stop the others of its batch from being resolved.
+    #
+    try:
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+    except InvalidStateError:
+        pass
+
+
+class TransferWriter(object):
+    def __init__(self, client, max_batch_size=50, max_delay=0.005, max_queue=10000, max_in_flight=4,
+                 use_function=False, max_retries=8):
+        self.client = client
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.max_retries = max_retries
+        self.build_query = transfer_call if use_function else transfer_query
+        self.stats = TransferStats()
+        self.lock = threading.Lock()
+        self.submit_lock = threading.Lock()
+        self.batches = 0
+        self.pending = queue.Queue(maxsize=max_queue)
+        self.slots = threading.BoundedSemaphore(max_in_flight)
+        self.workers = []
+        self.closed = False
+        self.flusher = threading.Thread(target=self._flush_loop)
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def submit(self, transaction, timeout=None):
+        #
+        # Queue a transfer and return the Future of its result. Blocks while the queue is
+        # full, for at most 'timeout' seconds if given. The closed check and the put happen
+        # under one lock, so nothing can be queued behind the close marker.
+        #
+        if not self.submit_lock.acquire(timeout=-1 if timeout is None else timeout):
+            raise queue.Full
+        try:
+            if self.closed:
+                raise RuntimeError("TransferWriter is closed")
+            future = Future()
+            self.pending.put((transaction, future), timeout=timeout)
+        finally:
+            self.submit_lock.release()
+        return future
+
+    def _flush_loop(self):
+        closing = False
+        while not closing:
+            item = self.pending.get()
+            if item is _CLOSE:
+                break
+            batch = [item] if item[1].set_running_or_notify_cancel() else []
+            deadline = time.time() + self.max_delay
+            while len(batch) < self.max_batch_size:
+                try:
+                    item = self.pending.get(timeout=max(0.0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                if item is _CLOSE:
+                    closing = True
+                    break
+                if item[1].set_running_or_notify_cancel():
+                    batch.append(item)
+            if not batch:
+                continue
+
+            self.slots.acquire()
+            worker = threading.Thread(target=self._commit, args=(batch,))
+            worker.daemon = True
+            self.workers = [w for w in self.workers if w.is_alive()] + [worker]
+            worker.start()
+
+    def _commit(self, batch):
+        try:
+            with self.lock:
+                self.batches += 1
+            try:
+                results = query_with_retry(self.client, [self.build_query(t) for t, f in batch], self.stats,
+                                           max_retries=self.max_retries)
+            except FaunaError as error:
+                if len(batch) == 1 or is_contention_error(error):
+                    self._fail(batch, error)
+                    return
+                results = []
+                for transaction, future in batch:
+                    try:
+                        results.append(query_with_retry(self.client, self.build_query(transaction), self.stats,
+                                                        max_retries=self.max_retries))
+                    except FaunaError as single_error:
+                        results.append(single_error)
+            except Exception as error:
+                self._fail(batch, error)
+                return
+
+            for (transaction, future), res in zip(batch, results):
+                if isinstance(res, Exception):
+                    self.stats.add(failed=1)
+                    _resolve(future, error=res)
+                    continue
+                if res == INSUFFICIENT_FUNDS:
+                    self.stats.add(insufficient=1)
+                else:
+                    self.stats.add(applied=1)
+                _resolve(future, res)
+        finally:
+            self.slots.release()
+
+    def _fail(self, batch, error):
+        self.stats.add(failed=len(batch))
+        for transaction, future in batch:
+            _resolve(future, error=error)
+
+    def close(self):
+        #
+        # Commit everything that was submitted and stop the flusher. Transfers that are still
+        # queued once the flusher has stopped fail instead of waiting forever.
+        #
+        with self.submit_lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.pending.put(_CLOSE)
+        self.flusher.join()
+        for worker in self.workers:
+            worker.join()
+        while True:
+            try:
+                item = self.pending.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _CLOSE:
+                self._fail([item], RuntimeError("TransferWriter is closed"))
+        self.stats.end_time = time.time()
+
+    def summary(self):
+        summary = self.stats.summary()
+        summary["batches"] = self.batches
+        summary["avg_batch_size"] = (summary["transfers"] + summary["failed"]) / float(self.batches) \
+            if self.batches else 0.0
+        return summary
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def main(argv):
+    #
+    # 8 threads submitting transfers one at a time, group committed.
+    #
+    scheme = "http"
+    domain = "127.0.0.1"
+    port = "8443"
+    secret = "secret"
+
+    db_secret = create_database(scheme, domain, port, secret, "LedgerWriteBehindExample")
+    client = create_db_client(scheme, domain, port, db_secret)
+    create_classes(client)
+    create_indices(client)
+    create_functions(client)
+    create_customers(client, 1000, 100)
+
+    with TransferWriter(client, use_function=True) as writer:
+        def produce():
+            for i in range(0, 500):
+                writer.submit(random_transfer(1000, 10)).result()
+
+        producers = [threading.Thread(target=produce) for i in range(0, 8)]
+        for producer in producers:
+            producer.start()
+        for producer in producers:
+            producer.join()
+
+    summary = writer.summary()
+    print('Group committed {0} transfers in {1} batches ({2:.1f} per batch): {3:.1f} transfers/sec, '
+          '{4} conflicts, {5} failed'.format(summary["transfers"], summary["batches"], summary["avg_batch_size"],
+                                             summary["transfers_per_sec"], summary["conflicts"], summary["failed"]))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
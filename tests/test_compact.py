@@ -0,0 +1,50 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# The request bodies written by ledger.compact must be exactly what the driver encodes for
+# the same queries.
+#
+
+from faunadb import query as q
+from faunadb._json import to_json
+
+from Lesson4 import transfer_call, transfer_query
+from ledger.compact import CustomerBatch, TransferBatch, TransferEncoder, encode_customers
+
+
+def driver_customers(ids, balances):
+    return to_json([q.select("ref", q.create(q.class_("customers"), {"data": {"id": cust_id, "balance": balance}}))
+                    for cust_id, balance in zip(ids, balances)])
+
+
+def test_encode_customers_matches_driver():
+    for balances in ([100, 250, 0], [100.0, 12.5, 0.1], [100, 100.5, 7, 1e20]):
+        ids = list(range(1, len(balances) + 1))
+        assert encode_customers(CustomerBatch(ids, balances)) == driver_customers(ids, balances)
+
+
+def test_encode_customers_range():
+    batch = CustomerBatch.sequential(10, 100.0)
+    assert encode_customers(batch, 3, 6) == driver_customers([4, 5, 6], [100.0] * 3)
+
+
+def test_encode_transfers_matches_driver():
+    batch = TransferBatch.random(20, 50, 10)
+    transactions = [batch.transaction(i) for i in range(0, len(batch))]
+    assert TransferEncoder().encode(batch) == to_json([transfer_call(t) for t in transactions])
+    assert TransferEncoder(use_function=False).encode(batch) == to_json([transfer_query(t) for t in transactions])
@@ -0,0 +1,71 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# The stand-in commits a request entirely or not at all, schema changes included.
+#
+
+import pytest
+from faunadb import query as q
+from faunadb.errors import BadRequest
+
+from ledger.client import close_clients, create_database, create_db_client
+from ledger.fake import FakeFauna
+
+
+@pytest.fixture
+def client():
+    FakeFauna().install()
+    db_secret = create_database("http", "127.0.0.1", 8443, "secret", "FakeTest")
+    yield create_db_client("http", "127.0.0.1", 8443, db_secret)
+    close_clients()
+
+
+def test_failed_query_leaves_no_schema(client):
+    with pytest.raises(BadRequest):
+        client.query([
+            q.create_class({"name": "customers"}),
+            q.create_index({"name": "customer_by_id", "source": q.class_("customers"),
+                            "terms": [{"field": ["data", "id"]}]}),
+            q.create_function({"name": "noop", "body": q.query(lambda x: x)}),
+            q.create_class({"name": "customers"})
+        ])
+    assert client.query(q.paginate(q.classes()))["data"] == []
+    assert client.query(q.paginate(q.indexes()))["data"] == []
+    assert client.query(q.paginate(q.functions()))["data"] == []
+
+
+def test_schema_is_visible_within_and_after_the_query(client):
+    client.query([
+        q.create_class({"name": "customers"}),
+        q.create_index({"name": "customer_by_id", "source": q.class_("customers"),
+                        "terms": [{"field": ["data", "id"]}]}),
+        q.create(q.class_("customers"), {"data": {"id": 1}})
+    ])
+    client.query(q.create(q.class_("customers"), {"data": {"id": 2}}))
+    doc = client.query(q.get(q.match(q.index("customer_by_id"), 1)))
+    assert doc["data"] == {"id": 1}
+    assert client.query(q.exists(q.match(q.index("customer_by_id"), 2)))
+
+
+def test_failed_query_keeps_dropped_class(client):
+    client.query(q.create_class({"name": "customers"}))
+    ref = client.query(q.create(q.class_("customers"), {"data": {"id": 1}}))["ref"]
+    with pytest.raises(BadRequest):
+        client.query([q.delete(q.class_("customers")), q.create_class({"name": "customers"}),
+                      q.create_class({"name": "customers"})])
+    assert client.query(q.get(ref))["data"] == {"id": 1}
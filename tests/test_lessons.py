@@ -0,0 +1,42 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Smoke test: the lessons run from start to finish against the stand-in.
+#
+
+import pytest
+
+import Lesson2
+import Lesson3
+import Lesson4
+from ledger.client import close_clients
+from ledger.fake import FakeFauna
+
+
+@pytest.fixture
+def fauna():
+    fauna = FakeFauna().install()
+    yield fauna
+    close_clients()
+
+
+@pytest.mark.parametrize("lesson", [Lesson2, Lesson3, Lesson4], ids=lambda lesson: lesson.__name__)
+def test_lesson_runs(fauna, lesson):
+    lesson.main([lesson.__name__])
+    assert fauna.stats["requests"] > 0
+    assert fauna.stats["errors"] == 0
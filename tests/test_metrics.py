@@ -0,0 +1,74 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+#
+# Queries are counted under the innermost ledger operation that made them, also when the
+# operation hands them off to worker threads.
+#
+
+import pytest
+from faunadb import query as q
+
+import Lesson3
+import Lesson4
+from ledger.client import close_clients, create_database, create_db_client
+from ledger.fake import FakeFauna
+from ledger.metrics import InstrumentedClient, QueryMetrics, instrument_lessons, operation
+
+
+@pytest.fixture
+def client():
+    FakeFauna().install()
+    instrument_lessons()
+    db_secret = create_database("http", "127.0.0.1", 8443, "secret", "MetricsTest")
+    yield create_db_client("http", "127.0.0.1", 8443, db_secret)
+    close_clients()
+
+
+def counts(metrics):
+    return dict((name, m["latency_seconds"]["count"]) for name, m in metrics.snapshot()["operations"].items())
+
+
+def test_nested_operation_is_counted_under_its_own_name(client):
+    Lesson3.create_schema(client)
+    Lesson3.create_customers(client)
+    metrics = QueryMetrics()
+    Lesson3.read_list_of_customers(InstrumentedClient(client, metrics), list(range(1, 21)) * 30)
+    assert counts(metrics) == {"get_customers": 1}
+
+
+def test_worker_threads_keep_the_operation_name(client):
+    Lesson4.create_classes(client)
+    Lesson4.create_indices(client)
+    Lesson4.create_customers(client, 50, 100)
+    metrics = QueryMetrics()
+    instrumented = InstrumentedClient(client, metrics)
+    Lesson4.run_concurrent_transactions(instrumented, 50, 10, 40, num_workers=4)
+    Lesson4.sum_customer_balances_indexed(instrumented, 1, 50)
+    names = counts(metrics)
+    assert names["apply_idempotent_transfer"] >= 40
+    assert names["sum_balance_range"] == 4
+    assert "query" not in names and "run_concurrent_transactions" not in names
+
+
+def test_untagged_queries_use_the_enclosing_block(client):
+    metrics = QueryMetrics()
+    instrumented = InstrumentedClient(client, metrics)
+    with operation("ping"):
+        instrumented.query(q.add(1, 2))
+    instrumented.query(q.add(1, 2))
+    assert counts(metrics) == {"ping": 1, "query": 1}